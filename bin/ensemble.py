@@ -0,0 +1,7 @@
+
+
+from sent_order.cli import ensemble as cli
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,45 +1,6 @@
 
 
-import click
-
-from sent_order.models import pick_next as model
-from sent_order import cuda
-
-
-@click.group()
-def cli():
-    pass
-
-
-@cli.command()
-@click.argument('train_path', type=click.Path())
-@click.argument('model_path', type=click.Path())
-@click.option('--train_skim', type=int, default=1000000)
-@click.option('--lr', type=float, default=1e-3)
-@click.option('--epochs', type=int, default=1000)
-@click.option('--epoch_size', type=int, default=1000)
-@click.option('--batch_size', type=int, default=20)
-@click.option('--lstm_dim', type=int, default=500)
-@click.option('--lin_dim', type=int, default=500)
-@click.option('--gpu', type=int, default=2)
-def train(*args, **kwargs):
-    with cuda.gpu(kwargs.pop('gpu')):
-        model.train(*args, **kwargs)
-
-
-@cli.command()
-@click.argument('test_path', type=click.Path())
-@click.argument('s_encoder_path', type=click.Path())
-@click.argument('r_encoder_path', type=click.Path())
-@click.argument('classifier_path', type=click.Path())
-@click.argument('gp_path', type=click.Path())
-@click.option('--test_skim', type=int, default=10000)
-@click.option('--map_source', default='cuda:2')
-@click.option('--map_target', default='cuda:2')
-@click.option('--gpu', type=int, default=2)
-def predict(*args, **kwargs):
-    with cuda.gpu(kwargs.pop('gpu')):
-        model.predict(*args, **kwargs)
+from sent_order.cli import pick_next as cli
 
 
 if __name__ == '__main__':
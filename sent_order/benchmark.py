@@ -0,0 +1,595 @@
+
+
+import numpy as np
+
+import os
+import sys
+import time
+import random
+import platform
+import threading
+import ujson
+
+
+def lengths(rng, mean, max_size, size):
+    """Draw 1 + Poisson lengths, clipped to [1, max_size].
+    """
+    return np.clip(1 + rng.poisson(max(mean-1, 0), size), 1, max_size)
+
+
+def write_vectors(path, vocab_size=5000, dim=300, seed=0):
+    """Write random word vectors in the KeyedVectors format.
+    """
+    from gensim.models import KeyedVectors
+
+    rng = np.random.RandomState(seed)
+
+    kv = KeyedVectors(dim)
+
+    kv.add_vectors(
+        [f'w{i}' for i in range(vocab_size)],
+        rng.randn(vocab_size, dim).astype(np.float32),
+    )
+
+    kv.save(path)
+
+
+def write_corpus(root, abstracts=1000, sents_mean=6, sents_max=20,
+    tokens_mean=25, tokens_max=80, vocab_size=5000, oov=0.05, seed=0):
+    """Write abstracts as JSON lines, with Poisson sentence / token counts.
+
+    Args:
+        oov (float): Fraction of tokens missing from the vectors.
+    """
+    rng = np.random.RandomState(seed)
+
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, 'abstracts.json'), 'w') as fh:
+
+        sizes = lengths(rng, sents_mean, sents_max, abstracts)
+
+        for size in sizes:
+
+            sents = []
+            for n in lengths(rng, tokens_mean, tokens_max, size):
+
+                tokens = [f'w{i}' for i in rng.randint(vocab_size, size=n)]
+
+                tokens = [
+                    'oov' if r < oov else t
+                    for t, r in zip(tokens, rng.rand(n))
+                ]
+
+                sents.append(dict(token=tokens))
+
+            fh.write(ujson.dumps(dict(sentences=sents)) + '\n')
+
+
+def setup_data(root, vocab_size=5000, vectors_dtype='float16', **kwargs):
+    """Write vectors + corpus, point the models at the vectors.
+
+    Returns: corpus path
+    """
+    os.makedirs(root, exist_ok=True)
+
+    vectors_path = os.path.join(root, 'vectors.bin')
+    corpus_path = os.path.join(root, 'corpus')
+
+    write_vectors(vectors_path, vocab_size)
+    write_corpus(corpus_path, vocab_size=vocab_size, **kwargs)
+
+    # Read by LazyVectors.read(), when the models are imported.
+    os.environ['SENT_ORDER_VECTORS'] = vectors_path
+    os.environ['SENT_ORDER_VECTORS_DTYPE'] = vectors_dtype
+
+    return corpus_path
+
+
+def seed_all(seed):
+    import torch
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def time_call(func, repeats=10, warmup=1, seed=0):
+    """Time repeated calls, after warmup.
+
+    Returns: dict of seconds stats.
+    """
+    seed_all(seed)
+
+    for _ in range(warmup):
+        func()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return dict(
+        repeats=repeats,
+        min=min(times),
+        median=float(np.median(times)),
+        mean=float(np.mean(times)),
+    )
+
+
+def train_benchmarks(corpus_path, batch_size=20, lstm_dim=100, lin_dim=100):
+    """Forward + backward on a random batch, for each model.
+    """
+    from torch import nn
+    from sent_order.models import pairs, pick_next, context_regression, \
+        kt_regression
+
+    corpus = pairs.Corpus(corpus_path)
+    kt_corpus = kt_regression.Corpus(corpus_path)
+
+    s_encoder = pairs.Encoder(300, lstm_dim)
+    classifier = pairs.Classifier(4*lstm_dim, lin_dim)
+
+    def pairs_step():
+        batch = corpus.random_batch(batch_size)
+        y_pred, y = pairs.train_batch(batch, s_encoder, classifier)
+        nn.NLLLoss()(y_pred, y).backward()
+
+    yield 'train_batch.pairs', pairs_step
+
+    s_encoder = pick_next.Encoder(300, lstm_dim)
+    r_encoder = pick_next.Encoder(2*lstm_dim, lstm_dim)
+    classifier = pick_next.Classifier(8*lstm_dim+2, lin_dim)
+
+    def pick_next_step():
+        batch = pick_next.Batch(corpus.random_batch(batch_size).abstracts)
+        y_pred, y = pick_next.train_batch(batch, s_encoder, r_encoder,
+            classifier)
+        nn.NLLLoss()(y_pred, y).backward()
+
+    yield 'train_batch.pick_next', pick_next_step
+
+    sent_encoder = context_regression.Encoder(300, lstm_dim)
+    graf_encoder = context_regression.Encoder(2*lstm_dim, lstm_dim)
+    regressor = context_regression.Regressor(4*lstm_dim, lin_dim)
+
+    def context_step():
+        batch = context_regression.Batch(
+            corpus.random_batch(batch_size).abstracts)
+        y, y_pred = context_regression.train_batch(batch, sent_encoder,
+            graf_encoder, regressor)
+        nn.MSELoss()(y_pred, y).backward()
+
+    yield 'train_batch.context_regression', context_step
+
+    kt_encoder = kt_regression.SentenceEncoder(300, lstm_dim)
+    kt_regressor = kt_regression.Regressor(2*lstm_dim, lin_dim)
+
+    def kt_step():
+        batch = kt_corpus.random_batch(batch_size)
+        y_pred, y = kt_regression.train_batch(batch, kt_encoder, kt_regressor)
+        nn.MSELoss()(y_pred, y).backward()
+
+    yield 'train_batch.kt_regression', kt_step
+
+
+def decoder_benchmarks(corpus_path, abstracts=20, lstm_dim=100, lin_dim=100,
+    beam_size=100):
+    """Decode a fixed set of encoded abstracts, with each predict decoder.
+    """
+    import torch
+    from sent_order.models import pairs, pick_next, context_regression, \
+        kt_regression
+
+    corpus = pairs.Corpus(corpus_path)
+
+    # Multi-sentence abstracts, in input order.
+    batch = pairs.Batch([
+        ab for ab in corpus.abstracts
+        if len(ab.sentences) > 1
+    ][:abstracts])
+
+    def encode(encoder):
+        with torch.no_grad():
+            x, reorder = batch.packed_sentence_tensor()
+            return list(batch.unpack_sentences(encoder(x, reorder)))
+
+    def decode_all(func, grafs, *args, **kwargs):
+        def run():
+            with torch.no_grad():
+                for sents in grafs:
+                    func(sents, *args, **kwargs)
+        return run
+
+    grafs = encode(pairs.Encoder(300, lstm_dim))
+    classifier = pairs.Classifier(4*lstm_dim, lin_dim)
+
+    yield 'decode.pairs.beam_search', decode_all(
+        pairs.beam_search, grafs, classifier, beam_size)
+
+    grafs = encode(pick_next.Encoder(300, lstm_dim))
+    r_encoder = pick_next.Encoder(2*lstm_dim, lstm_dim)
+    classifier = pick_next.Classifier(8*lstm_dim+2, lin_dim)
+
+    yield 'decode.pick_next.order_greedy', decode_all(
+        pick_next.order_greedy, grafs, r_encoder, classifier)
+
+    yield 'decode.pick_next.order_beam_search', decode_all(
+        pick_next.order_beam_search, grafs, r_encoder, classifier, beam_size)
+
+    grafs = encode(context_regression.Encoder(300, lstm_dim).encode_packed)
+    graf_encoder = context_regression.Encoder(2*lstm_dim, lstm_dim)
+    regressor = context_regression.Regressor(4*lstm_dim, lin_dim)
+
+    yield 'decode.context_regression.regress_sents', decode_all(
+        context_regression.regress_sents, grafs, graf_encoder, regressor)
+
+    kt_batch = kt_regression.Batch([
+        graf for graf in kt_regression.Corpus(corpus_path).grafs
+        if len(graf.sentences) > 1
+    ][:abstracts])
+
+    with torch.no_grad():
+        sents = kt_regression.encode_batch(
+            kt_batch, kt_regression.SentenceEncoder(300, lstm_dim))
+        grafs = list(kt_batch.unpack_sentences(sents))
+
+    regressor = kt_regression.Regressor(2*lstm_dim, lin_dim)
+
+    for name, decoder in sorted(kt_regression.DECODERS.items()):
+        yield f'decode.kt_regression.{name}', decode_all(
+            decoder, grafs, regressor)
+
+
+def encoder_benchmarks(corpus_path, batch_size=100, lstm_dim=100):
+    """Sentence encoders on one packed batch - forward, and forward + backward.
+    """
+    import torch
+    from sent_order.models import pairs
+    from sent_order.utils import pad_and_pack
+    from sent_order.encoders import ENCODERS, sentence_encoder
+    from sent_order import device
+
+    corpus = pairs.Corpus(corpus_path)
+
+    sents = [
+        device.move(s.tensor())
+        for ab in corpus.abstracts[:batch_size]
+        for s in ab.sentences
+    ]
+
+    x, reorder = pad_and_pack(sents, 50)
+
+    for name in ('lstm', *ENCODERS):
+
+        encoder = device.move(
+            sentence_encoder(name, pairs.Encoder, 300, lstm_dim))
+
+        def forward(encoder=encoder):
+            with torch.no_grad():
+                encoder(x, reorder)
+
+        def backward(encoder=encoder):
+            encoder(x, reorder).sum().backward()
+
+        yield f'encode.{name}', forward
+        yield f'encode_backward.{name}', backward
+
+
+def util_benchmarks(corpus_path, batch_size=100):
+    """Padding, perm samplers, and metrics.
+    """
+    from sent_order.models import pairs
+    from sent_order.utils import pad_and_pack
+    from sent_order import device
+    from sent_order.metrics import Metrics
+    from sent_order import perms
+
+    corpus = pairs.Corpus(corpus_path)
+
+    abstracts = corpus.abstracts[:batch_size]
+
+    def embed():
+        return [
+            device.move(s.tensor())
+            for ab in abstracts
+            for s in ab.sentences
+        ]
+
+    sents = embed()
+
+    yield 'embed.pad_and_pack', lambda: pad_and_pack(embed(), 50)
+
+    yield 'utils.pad_and_pack', lambda: pad_and_pack(sents, 50)
+
+    sizes = range(2, 11)
+
+    def sample_uniform():
+        for size in sizes:
+            perms.sample_uniform_perms_array(size)
+
+    def sample_at_dist():
+        for size in sizes:
+            perms.sample_perms_at_dist_array(size, random.random())
+
+    def random_at_dist():
+        for _ in range(100):
+            perms.random_perm_at_dist(40, random.randint(0, 780))
+
+    yield 'perms.sample_uniform_perms_array', sample_uniform
+    yield 'perms.sample_perms_at_dist_array', sample_at_dist
+    yield 'perms.random_perm_at_dist', random_at_dist
+
+    # Random predictions for every abstract, x10.
+    rng = np.random.RandomState(0)
+
+    gold_pred = [
+        (list(range(len(ab.sentences))),
+            rng.permutation(len(ab.sentences)).tolist())
+        for ab in corpus.abstracts * 10
+    ]
+
+    yield 'metrics.report', lambda: Metrics(gold_pred).report()
+
+
+def meta():
+    """Environment, for comparing reports.
+    """
+    import torch
+    from sent_order import device
+
+    return dict(
+        time=time.time(),
+        python=sys.version,
+        platform=platform.platform(),
+        torch=torch.__version__,
+        numpy=np.__version__,
+        vectors_dtype=os.environ.get('SENT_ORDER_VECTORS_DTYPE'),
+        device=device.DEVICE.name,
+        threads=torch.get_num_threads(),
+        interop_threads=torch.get_num_interop_threads(),
+        cpus=sorted(os.sched_getaffinity(0)),
+    )
+
+
+def run(root, repeats=10, only=None, batch_size=20, decode_size=20,
+    lstm_dim=100, lin_dim=100, beam_size=100, **corpus_kwargs):
+    """Generate data, run all benchmarks.
+
+    Args:
+        only (str): Only run benchmarks whose names contain this.
+
+    Returns: report dict
+    """
+    corpus_path = setup_data(root, **corpus_kwargs)
+
+    suites = [
+        train_benchmarks(corpus_path, batch_size, lstm_dim, lin_dim),
+        decoder_benchmarks(corpus_path, decode_size, lstm_dim, lin_dim,
+            beam_size),
+        encoder_benchmarks(corpus_path, lstm_dim=lstm_dim),
+        util_benchmarks(corpus_path),
+    ]
+
+    results = {}
+
+    for suite in suites:
+        for name, func in suite:
+
+            if only and only not in name:
+                continue
+
+            results[name] = time_call(func, repeats)
+            print(name, results[name]['median'])
+
+    return dict(
+        meta=meta(),
+        config=dict(
+            repeats=repeats,
+            batch_size=batch_size,
+            decode_size=decode_size,
+            lstm_dim=lstm_dim,
+            lin_dim=lin_dim,
+            beam_size=beam_size,
+            **corpus_kwargs,
+        ),
+        results=results,
+    )
+
+
+def compare(old, new):
+    """Median ratios, new / old, for benchmarks in both reports.
+
+    Returns: {name: (old median, new median, ratio)}
+    """
+    return {
+        name: (
+            old['results'][name]['median'],
+            new['results'][name]['median'],
+            new['results'][name]['median'] / old['results'][name]['median'],
+        )
+        for name in sorted(new['results'])
+        if name in old['results']
+    }
+
+
+class PeakMemory:
+
+    def __init__(self, interval=0.005):
+        """Poll resident memory in a thread, track the peak over a block.
+        """
+        self.interval = interval
+
+    @staticmethod
+    def rss():
+        """Resident bytes, or None off Linux.
+        """
+        try:
+            with open('/proc/self/statm') as fh:
+                pages = int(fh.read().split()[1])
+
+        except OSError:
+            return None
+
+        return pages * os.sysconf('SC_PAGE_SIZE')
+
+    def poll(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+
+        self.start = self.peak = self.rss()
+
+        if self.start is not None:
+            self.done = threading.Event()
+            self.thread = threading.Thread(target=self.poll, daemon=True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+
+        if self.start is not None:
+            self.done.set()
+            self.thread.join()
+            self.peak = max(self.peak, self.rss())
+
+    @property
+    def mb(self):
+        """Peak growth over the block, in MB.
+        """
+        if self.start is not None:
+            return (self.peak - self.start) / 2**20
+
+
+def scaling_decoders(lstm_dim=100, lin_dim=100, beams=(1, 10, 100)):
+    """Decoders to sweep, on random models.
+
+    Beam search always runs the beam (exhaustive_size=0), so it can be
+    compared against the exact solver at the same lengths.
+
+    Yields: (model, decoder, beam size, exact solver, func)
+    """
+    from sent_order.models import pairs, pick_next, context_regression
+
+    pairs_classifier = pairs.Classifier(4*lstm_dim, lin_dim)
+
+    def pairs_exact(ab):
+        return pairs.exhaustive_order(ab, pairs_classifier)[0][0]
+
+    for beam_size in beams:
+        yield 'pairs', 'beam_search', beam_size, pairs_exact, \
+            lambda ab, k=beam_size: pairs.beam_search(
+                ab, pairs_classifier, k, 0)[0][0]
+
+    yield 'pairs', 'exhaustive', None, None, pairs_exact
+
+    r_encoder = pick_next.Encoder(2*lstm_dim, lstm_dim)
+    next_classifier = pick_next.Classifier(8*lstm_dim+2, lin_dim)
+
+    def pick_next_exact(ab):
+        return pick_next.exhaustive_order(
+            ab, r_encoder, next_classifier)[0][0]
+
+    yield 'pick_next', 'order_greedy', None, pick_next_exact, \
+        lambda ab: pick_next.order_greedy(ab, r_encoder, next_classifier)
+
+    for beam_size in beams:
+        yield 'pick_next', 'order_beam_search', beam_size, pick_next_exact, \
+            lambda ab, k=beam_size: pick_next.order_beam_search(
+                ab, r_encoder, next_classifier, k, 0)[0][0]
+
+    yield 'pick_next', 'exhaustive', None, None, pick_next_exact
+
+    graf_encoder = context_regression.Encoder(2*lstm_dim, lstm_dim)
+    regressor = context_regression.Regressor(4*lstm_dim, lin_dim)
+
+    def regress(ab):
+        pred = context_regression.regress_sents(ab, graf_encoder, regressor)
+        return np.argsort(np.array(pred).flatten()).tolist()
+
+    # No exact solver - positions are regressed independently.
+    yield 'context_regression', 'regress_sents', None, None, regress
+
+
+def scaling(sizes=(3, 5, 7, 10, 15, 20, 30, 40), beams=(1, 10, 100),
+    samples=5, exact_max=8, lstm_dim=100, lin_dim=100, seed=0):
+    """Sweep decoders over abstract length and beam width.
+
+    For each (decoder, n, beam), decode `samples` random abstracts and
+    record seconds per abstract, model calls / beam expansions / perms
+    scored per abstract, peak memory growth, and - up to exact_max - the
+    mean KT between the decoded and the exact highest-scoring order.
+
+    Yields: row dicts
+    """
+    import torch
+    from sent_order import timers
+    from sent_order import device
+    from sent_order.metrics import kendall_taus
+
+    seed_all(seed)
+
+    decoders = list(scaling_decoders(lstm_dim, lin_dim, beams))
+
+    for n in sizes:
+
+        # Random sentence encodings, shared by all decoders.
+        abstracts = [
+            device.floats(torch.randn(n, 2*lstm_dim))
+            for _ in range(samples)
+        ]
+
+        # Exact orders, by solver.
+        gold = {}
+
+        for model, decoder, beam_size, exact, func in decoders:
+
+            if decoder == 'exhaustive' and n > exact_max:
+                continue
+
+            # Warm up allocator / thread pools.
+            with torch.no_grad():
+                func(abstracts[0])
+
+            with torch.no_grad(), timers.collect() as stats, \
+                PeakMemory() as memory:
+
+                start = time.perf_counter()
+                orders = [func(ab) for ab in abstracts]
+                seconds = time.perf_counter() - start
+
+            kt = None
+
+            if exact and n <= exact_max:
+
+                if exact not in gold:
+                    with torch.no_grad():
+                        gold[exact] = [exact(ab) for ab in abstracts]
+
+                # Positions of each sentence, in each order.
+                kt = float(kendall_taus(
+                    np.argsort(np.array(gold[exact]), 1),
+                    np.argsort(np.array(orders), 1),
+                ).mean())
+
+            yield dict(
+                model=model,
+                decoder=decoder,
+                n=n,
+                beam_size=beam_size,
+                seconds=seconds / samples,
+                peak_mb=memory.mb,
+                kt_vs_exact=kt,
+                **{
+                    name: stats.counters.get(name, 0) / samples
+                    for name in (
+                        'classifier_calls',
+                        'regressor_calls',
+                        'beam_expansions',
+                        'perms_scored',
+                    )
+                },
+            )
@@ -0,0 +1,313 @@
+
+
+import os
+import copy
+import torch
+import attr
+import ujson
+import pickle
+import inspect
+import importlib
+
+from torch import nn
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+
+from sent_order import device, distributed
+
+
+def cpu_state(state):
+    """Deep-copy a (nested) state dict onto the CPU.
+    """
+    if torch.is_tensor(state):
+        return state.detach().cpu().clone()
+
+    if isinstance(state, dict):
+        return state.__class__((k, cpu_state(v)) for k, v in state.items())
+
+    if isinstance(state, (list, tuple)):
+        return state.__class__(cpu_state(v) for v in state)
+
+    return copy.deepcopy(state)
+
+
+def atomic_save(obj, path):
+    """Write to a temp file, then rename over the target.
+    """
+    tmp_path = f'{path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def hparams(module):
+    """Constructor args for a module.
+
+    Modules can set an `hparams` dict. Otherwise, infer (input dim, hidden
+    dim) from the first layer, and lin1 or the LSTM.
+    """
+    if hasattr(module, 'hparams'):
+        return dict(module.hparams)
+
+    first = next(module.children())
+
+    if isinstance(first, nn.LSTM):
+        input_dim = first.input_size
+    else:
+        input_dim = first.in_features
+
+    if hasattr(module, 'lin1'):
+        hidden_dim = module.lin1.out_features
+    else:
+        hidden_dim = module.lstm.hidden_size
+
+    names = list(inspect.signature(type(module)).parameters)
+
+    return dict(zip(names, [input_dim, hidden_dim]))
+
+
+def model_state(module, state_dict=None):
+    """Class path, constructor args, and weights - no pickled code.
+    """
+    cls = type(module)
+
+    return dict(
+        cls=f'{cls.__module__}.{cls.__name__}',
+        hparams=hparams(module),
+        state_dict=(
+            cpu_state(module.state_dict())
+            if state_dict is None else state_dict
+        ),
+    )
+
+
+def load_model(path, map_location=None, legacy=False):
+    """Load a model file onto the current device.
+
+    Weights are memory-mapped, and the module is built on the meta device
+    and takes the loaded tensors as-is.
+
+    Args:
+        legacy (bool): Unpickle a whole module with map_location. This runs
+            arbitrary code - only for trusted files, via export.
+    """
+    if legacy:
+        model = torch.load(path, map_location=map_location,
+            weights_only=False)
+
+        return device.move(model)
+
+    try:
+        state = torch.load(path, map_location='cpu', mmap=True,
+            weights_only=True)
+
+    except pickle.UnpicklingError as e:
+        raise ValueError(
+            f'{path} is not a state_dict model file. Convert pickled '
+            'modules with `sent-order checkpoints export`.'
+        ) from e
+
+    module_path, name = state['cls'].rsplit('.', 1)
+
+    if not module_path.startswith('sent_order.'):
+        raise ValueError(f'Unknown model class: {state["cls"]}')
+
+    cls = getattr(importlib.import_module(module_path), name)
+
+    with torch.device('meta'):
+        model = cls(**state['hparams'])
+
+    model.load_state_dict(state['state_dict'], assign=True)
+
+    return device.move(model)
+
+
+def export(src, dst, map_location=None):
+    """Convert a trusted pickled module to the state_dict + hparams format.
+    """
+    model = load_model(src, map_location, legacy=True)
+    atomic_save(model_state(model), dst)
+
+
+def load_run(root, keys, epoch=None, map_location=None):
+    """Load a training run's model files.
+
+    Args:
+        root (str): Checkpoints directory.
+        keys (list of str): Model keys.
+        epoch (int): Default: the best epoch in the manifest.
+
+    Returns: list of modules, in key order.
+    """
+    if epoch is None:
+        with open(os.path.join(root, 'checkpoints.json')) as fh:
+            epoch = ujson.load(fh)['best']['epoch']
+
+    return [
+        load_model(os.path.join(root, f'{key}.{epoch}.pt'), map_location)
+        for key in keys
+    ]
+
+
+@attr.s
+class Checkpoints:
+
+    root = attr.ib()
+
+    # {key: module}
+    models = attr.ib()
+
+    optimizer = attr.ib()
+
+    # Keep the last K epochs, plus the best.
+    keep = attr.ib(default=5)
+
+    # Continue the run in root.
+    resume = attr.ib(default=False)
+
+    # Clear a previous run in root, instead of refusing to start.
+    overwrite = attr.ib(default=False)
+
+    def __attrs_post_init__(self):
+        """Load or reset the manifest, set up the writer thread.
+        """
+        os.makedirs(self.root, exist_ok=True)
+
+        self.manifest_path = os.path.join(self.root, 'checkpoints.json')
+
+        if self.resume and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as fh:
+                self.manifest = ujson.load(fh)
+
+        elif os.path.exists(self.manifest_path) and not self.overwrite:
+            raise ValueError(
+                f'{self.root} has a previous run. '
+                'Pass --resume to continue it, or --overwrite to replace it.'
+            )
+
+        else:
+            self.manifest = dict(epochs=[], best=None)
+
+            if self.overwrite and distributed.is_main():
+                self.clear()
+
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = None
+
+    def state_path(self, epoch):
+        return os.path.join(self.root, f'state.{epoch}.pt')
+
+    def model_path(self, key, epoch):
+        return os.path.join(self.root, f'{key}.{epoch}.pt')
+
+    def save(self, epoch, metric):
+        """Snapshot weights and optimizer state, write in the background.
+
+        Args:
+            epoch (int)
+            metric (float): Lower is better.
+        """
+        state = dict(
+            epoch=epoch,
+            metric=metric,
+            models={
+                key: cpu_state(model.state_dict())
+                for key, model in self.models.items()
+            },
+            optimizer=cpu_state(self.optimizer.state_dict()),
+        )
+
+        # One write in flight.
+        self.wait()
+
+        self.pending = self.executor.submit(self.write, state)
+
+    def write(self, state):
+        """Write state + module files, update manifest, prune old epochs.
+        """
+        epoch = state['epoch']
+
+        atomic_save(state, self.state_path(epoch))
+
+        # Standalone model files, for the predict commands.
+        for key, model in self.models.items():
+            atomic_save(
+                model_state(model, state['models'][key]),
+                self.model_path(key, epoch),
+            )
+
+        epochs = [e for e in self.manifest['epochs'] if e != epoch] + [epoch]
+
+        best = self.manifest['best']
+
+        if best is None or state['metric'] < best['metric']:
+            best = dict(epoch=epoch, metric=state['metric'])
+
+        keep = set(epochs[-self.keep:]) | {best['epoch']}
+
+        for e in epochs:
+            if e not in keep:
+                self.remove(e)
+
+        self.manifest = dict(
+            epochs=[e for e in epochs if e in keep],
+            best=best,
+        )
+
+        with open(f'{self.manifest_path}.tmp', 'w') as fh:
+            ujson.dump(self.manifest, fh)
+
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+
+    def remove(self, epoch):
+        """Delete an epoch's files.
+        """
+        paths = [self.state_path(epoch)] + [
+            self.model_path(key, epoch) for key in self.models
+        ]
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        """Delete a previous run's manifest, state, and model files.
+        """
+        paths = [self.manifest_path] + glob(self.state_path('*')) + [
+            path
+            for key in self.models
+            for path in glob(self.model_path(key, '*'))
+        ]
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait(self):
+        """Block until the pending write finishes; raise its errors.
+        """
+        if self.pending:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def restore(self):
+        """Load the latest checkpoint.
+
+        Returns: the next epoch, or 0 if there is nothing to resume.
+        """
+        if not self.manifest['epochs']:
+            return 0
+
+        epoch = self.manifest['epochs'][-1]
+
+        state = torch.load(self.state_path(epoch), map_location='cpu')
+
+        for key, model in self.models.items():
+            model.load_state_dict(state['models'][key])
+
+        self.optimizer.load_state_dict(state['optimizer'])
+
+        return epoch + 1
@@ -0,0 +1,496 @@
+
+
+import click
+import ujson
+
+from sent_order.constants import KT_DECODERS, SENT_ENCODERS, DISTILL_MODELS
+
+
+# Heavy modules (torch, gensim, scipy, the models) are imported inside each
+# command, so --help and the metrics / orchestration commands start fast.
+
+
+@click.group()
+def cli():
+    """Sentence ordering.
+    """
+
+
+def device_options(func):
+    """Add execution options to a command.
+    """
+    options = [
+        click.option('--device',
+            help='cpu, cuda, or cuda:N. Default: cuda if available.'),
+        click.option('--threads', type=int,
+            help='Intra-op threads. Default: one per pinned core.'),
+        click.option('--interop_threads', type=int,
+            help='Inter-op threads.'),
+        click.option('--cores',
+            help='Pin to these CPUs, eg 0-7,16-23. Split between workers.'),
+        click.option('--numa_node', type=int,
+            help='Pin to the CPUs of a NUMA node.'),
+    ]
+
+    for option in reversed(options):
+        func = option(func)
+
+    return func
+
+
+def configure_device(kwargs):
+    """Pop the execution options, set up this process.
+    """
+    from sent_order import device
+
+    return device.configure(
+        name=kwargs.pop('device'),
+        threads=kwargs.pop('threads'),
+        interop_threads=kwargs.pop('interop_threads'),
+        cores=kwargs.pop('cores'),
+        numa_node=kwargs.pop('numa_node'),
+    )
+
+
+def train_command(group, name, **encoder_paths):
+    """Add the shared train command to a model group.
+
+    Args:
+        name (str): Model module, in sent_order.models.
+        encoder_paths: Frozen-encoder option names -> help.
+    """
+    def train(*args, **kwargs):
+        """Train a model.
+        """
+        import importlib
+        from sent_order import distributed
+
+        model = importlib.import_module(f'sent_order.models.{name}')
+
+        # Workers each take a share of the pinned cores.
+        configure_device(kwargs)
+
+        distributed.launch(
+            model.train, kwargs.pop('workers'), *args, **kwargs)
+
+    options = [
+        click.argument('train_path', type=click.Path()),
+        click.argument('model_path', type=click.Path()),
+        click.option('--train_skim', type=int, default=1000000),
+        click.option('--lr', type=float, default=1e-3),
+        click.option('--epochs', type=int, default=1000),
+        click.option('--epoch_size', type=int, default=1000),
+        click.option('--batch_size', type=int, default=20),
+        click.option('--lstm_dim', type=int, default=500),
+        click.option('--lin_dim', type=int, default=500),
+        *(
+            click.option(f'--{key}', type=click.Path(), help=help)
+            for key, help in encoder_paths.items()
+        ),
+        click.option('--encoder', type=click.Choice(SENT_ENCODERS),
+            default='lstm', help='Sentence encoder architecture.'),
+        click.option('--keep', type=int, default=5),
+        click.option('--resume', is_flag=True),
+        click.option('--overwrite', is_flag=True,
+            help='Replace a previous run in model_path.'),
+        click.option('--workers', type=int, default=1),
+    ]
+
+    for option in reversed(options):
+        train = option(train)
+
+    group.command()(device_options(train))
+
+
+@click.command()
+@click.argument('src', type=click.Path())
+@click.argument('dst', type=click.Path())
+@click.option('--map_source', default='cuda:0')
+@click.option('--map_target', default='cpu')
+def export(src, dst, map_source, map_target):
+    """Convert a trusted pickled module to the state_dict + hparams format.
+    """
+    from sent_order import checkpoints
+
+    checkpoints.export(src, dst, {map_source: map_target})
+
+
+@cli.group()
+def pairs():
+    """Pairwise precedence classifier.
+    """
+
+
+train_command(pairs, 'pairs')
+
+
+@pairs.command('predict')
+@click.argument('test_path', type=click.Path())
+@click.argument('s_encoder_path', type=click.Path())
+@click.argument('classifier_path', type=click.Path())
+@click.argument('gp_path', type=click.Path())
+@click.option('--test_skim', type=int, default=10000)
+@click.option('--nbest', type=click.IntRange(1), default=1)
+@click.option('--nbest_path', type=click.Path())
+@click.option('--long_size', type=int,
+    help='Use long-document search above this many sentences. 1-best only.')
+@click.option('--map_source', default='cuda:1')
+@click.option('--map_target', default='cuda:1')
+@device_options
+def pairs_predict(*args, **kwargs):
+    """Predict order.
+    """
+    from sent_order.models import pairs as model
+
+    configure_device(kwargs)
+
+    model.predict(*args, **kwargs)
+
+
+pairs.add_command(export)
+
+
+@cli.group('pick_next')
+def pick_next():
+    """Next-sentence classifier, with right context.
+    """
+
+
+train_command(pick_next, 'pick_next',
+    s_encoder_path='Frozen sentence encoder.',
+    encodings_path='Precomputed sentence encodings.')
+
+
+@pick_next.command('predict')
+@click.argument('test_path', type=click.Path())
+@click.argument('s_encoder_path', type=click.Path())
+@click.argument('r_encoder_path', type=click.Path())
+@click.argument('classifier_path', type=click.Path())
+@click.argument('gp_path', type=click.Path())
+@click.option('--test_skim', type=int, default=10000)
+@click.option('--nbest', type=click.IntRange(1), default=1)
+@click.option('--nbest_path', type=click.Path())
+@click.option('--map_source', default='cuda:2')
+@click.option('--map_target', default='cuda:2')
+@device_options
+def pick_next_predict(*args, **kwargs):
+    """Predict order.
+    """
+    from sent_order.models import pick_next as model
+
+    configure_device(kwargs)
+
+    model.predict(*args, **kwargs)
+
+
+pick_next.add_command(export)
+
+
+@cli.group('context_regression')
+def context_regression():
+    """Position regression, with paragraph context.
+    """
+
+
+train_command(context_regression, 'context_regression',
+    sent_encoder_path='Frozen sentence encoder.',
+    encodings_path='Precomputed sentence encodings.')
+
+
+@context_regression.command('predict')
+@click.argument('test_path', type=click.Path())
+@click.argument('sent_encoder_path', type=click.Path())
+@click.argument('graf_encoder_path', type=click.Path())
+@click.argument('regressor_path', type=click.Path())
+@click.argument('gp_path', type=click.Path())
+@click.option('--test_skim', type=int, default=10000)
+@click.option('--map_source', default='cuda:0')
+@click.option('--map_target', default='cuda:0')
+@device_options
+def context_regression_predict(*args, **kwargs):
+    """Predict order.
+    """
+    from sent_order.models import context_regression as model
+
+    configure_device(kwargs)
+
+    model.predict(*args, **kwargs)
+
+
+context_regression.add_command(export)
+
+
+@cli.group('kt_regression')
+def kt_regression():
+    """Kendall's tau regression over whole orderings.
+    """
+
+
+train_command(kt_regression, 'kt_regression',
+    sent_encoder_path='Frozen sentence encoder.',
+    encodings_path='Precomputed sentence encodings.')
+
+
+@kt_regression.command('predict')
+@click.argument('test_path', type=click.Path())
+@click.argument('sent_encoder_path', type=click.Path())
+@click.argument('regressor_path', type=click.Path())
+@click.argument('gp_path', type=click.Path())
+@click.option('--test_skim', type=int, default=10000)
+@click.option('--decoder', type=click.Choice(KT_DECODERS), default='genetic')
+@click.option('--map_source', default='cuda:0')
+@click.option('--map_target', default='cuda:0')
+@device_options
+def kt_regression_predict(*args, **kwargs):
+    """Predict order.
+    """
+    from sent_order.models import kt_regression as model
+
+    configure_device(kwargs)
+
+    model.predict(*args, **kwargs)
+
+
+kt_regression.add_command(export)
+
+
+@cli.group()
+def ensemble():
+    """Weighted ensemble of pairs, pick_next, and context_regression.
+    """
+
+
+@ensemble.command('predict')
+@click.argument('test_path', type=click.Path())
+@click.argument('gp_path', type=click.Path())
+@click.option('--test_skim', type=int, default=10000)
+@click.option('--pairs_s_encoder_path', type=click.Path())
+@click.option('--pairs_classifier_path', type=click.Path())
+@click.option('--pick_s_encoder_path', type=click.Path())
+@click.option('--pick_r_encoder_path', type=click.Path())
+@click.option('--pick_classifier_path', type=click.Path())
+@click.option('--ctx_sent_encoder_path', type=click.Path())
+@click.option('--ctx_graf_encoder_path', type=click.Path())
+@click.option('--ctx_regressor_path', type=click.Path())
+@click.option('--pairs_weight', type=float, default=1)
+@click.option('--pick_weight', type=float, default=1)
+@click.option('--ctx_weight', type=float, default=1)
+@click.option('--beam_size', type=int, default=100)
+@click.option('--nbest', type=click.IntRange(1), default=1)
+@click.option('--nbest_path', type=click.Path())
+@click.option('--map_source', default='cuda:0')
+@click.option('--map_target', default='cuda:0')
+@device_options
+def ensemble_predict(*args, **kwargs):
+    """Predict order.
+    """
+    from sent_order.models import ensemble as model
+
+    configure_device(kwargs)
+
+    model.predict(*args, **kwargs)
+
+
+@cli.group()
+def distill():
+    """Train small students on pairs / pick_next teachers.
+    """
+
+
+@distill.command('train')
+@click.argument('model', type=click.Choice(DISTILL_MODELS))
+@click.argument('teacher_path', type=click.Path())
+@click.argument('train_path', type=click.Path())
+@click.argument('model_path', type=click.Path())
+@click.option('--train_skim', type=int, default=1000000)
+@click.option('--lr', type=float, default=1e-3)
+@click.option('--epochs', type=int, default=1000)
+@click.option('--epoch_size', type=int, default=1000)
+@click.option('--batch_size', type=int, default=20)
+@click.option('--lstm_dim', type=int, default=100)
+@click.option('--lin_dim', type=int, default=100)
+@click.option('--encoder', type=click.Choice(SENT_ENCODERS), default='lstm',
+    help='Student sentence encoder architecture.')
+@click.option('--temperature', type=float, default=1)
+@click.option('--alpha', type=float, default=0,
+    help='Weight of the gold-label loss.')
+@click.option('--teacher_epoch', type=int,
+    help='Default: the best epoch.')
+@click.option('--teacher_s_encoder_path', type=click.Path(),
+    help='Frozen sentence encoder the teacher was trained on.')
+@click.option('--keep', type=int, default=5)
+@click.option('--resume', is_flag=True)
+@click.option('--overwrite', is_flag=True,
+    help='Replace a previous run in model_path.')
+@click.option('--workers', type=int, default=1)
+@device_options
+def distill_train(model, teacher_path, train_path, model_path, **kwargs):
+    """Train a student on a teacher's scores.
+    """
+    from sent_order import distill, distributed
+
+    configure_device(kwargs)
+
+    distributed.launch(distill.train, kwargs.pop('workers'), train_path,
+        model_path, model, teacher_path, **kwargs)
+
+
+@distill.command('compare')
+@click.argument('model', type=click.Choice(DISTILL_MODELS))
+@click.argument('teacher_path', type=click.Path())
+@click.argument('student_path', type=click.Path())
+@click.argument('test_path', type=click.Path())
+@click.argument('report_path', type=click.Path())
+@click.option('--test_skim', type=int, default=1000)
+@click.option('--beam_size', type=int, default=100)
+@click.option('--teacher_epoch', type=int)
+@click.option('--student_epoch', type=int)
+@click.option('--teacher_s_encoder_path', type=click.Path())
+@click.option('--seed', type=int, default=0)
+@device_options
+def distill_compare(model, teacher_path, student_path, test_path,
+    report_path, **kwargs):
+    """Throughput and KT, teacher vs student.
+    """
+    from sent_order import distill
+
+    configure_device(kwargs)
+
+    report = distill.compare(test_path, model, teacher_path, student_path,
+        **kwargs)
+
+    with open(report_path, 'w') as fh:
+        ujson.dump(report, fh, indent=2)
+
+    for name, result in report['results'].items():
+        print(f'{name:10} {result["params"]:12} '
+            f'{result["sentences_per_second"]:10.1f} sents/s '
+            f'{result["overall_kt"]:8.4f} kt')
+
+
+@cli.group()
+def checkpoints():
+    """Model files.
+    """
+
+
+checkpoints.add_command(export)
+
+
+@cli.command()
+@click.argument('gp_paths', type=click.Path(), nargs=-1, required=True)
+@click.option('--max_len', type=int, default=10)
+def metrics(gp_paths, max_len):
+    """Score JSON / JSONL / n-best prediction files.
+    """
+    from sent_order.metrics import MetricsAccumulator
+
+    acc = MetricsAccumulator.from_files(gp_paths)
+
+    print(ujson.dumps(acc.report(max_len), indent=2))
+
+
+@cli.group()
+def benchmark():
+    """Benchmarks, on synthetic data.
+    """
+
+
+@benchmark.command()
+@click.argument('root', type=click.Path())
+@click.argument('report_path', type=click.Path())
+@click.option('--repeats', type=int, default=10)
+@click.option('--only')
+@click.option('--batch_size', type=int, default=20)
+@click.option('--decode_size', type=int, default=20)
+@click.option('--lstm_dim', type=int, default=100)
+@click.option('--lin_dim', type=int, default=100)
+@click.option('--beam_size', type=int, default=100)
+@click.option('--abstracts', type=int, default=1000)
+@click.option('--sents_mean', type=float, default=6)
+@click.option('--sents_max', type=int, default=20)
+@click.option('--tokens_mean', type=float, default=25)
+@click.option('--tokens_max', type=int, default=80)
+@click.option('--vocab_size', type=int, default=5000)
+@click.option('--oov', type=float, default=0.05)
+@click.option('--vectors_dtype', default='float16',
+    type=click.Choice(['float16', 'bfloat16', 'float32']))
+@click.option('--seed', type=int, default=0)
+@device_options
+def run(root, report_path, **kwargs):
+    """Time training steps, decoders, and utils.
+    """
+    from sent_order import benchmark
+
+    configure_device(kwargs)
+
+    report = benchmark.run(root, **kwargs)
+
+    with open(report_path, 'w') as fh:
+        ujson.dump(report, fh, indent=2)
+
+
+@benchmark.command()
+@click.argument('old_path', type=click.Path())
+@click.argument('new_path', type=click.Path())
+def compare(old_path, new_path):
+    """Compare median times in two reports.
+    """
+    from sent_order import benchmark
+
+    with open(old_path) as fh:
+        old = ujson.load(fh)
+
+    with open(new_path) as fh:
+        new = ujson.load(fh)
+
+    for name, (t1, t2, ratio) in benchmark.compare(old, new).items():
+        print(f'{name:50} {t1:10.4f} {t2:10.4f} {ratio:6.2f}x')
+
+
+def ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+@benchmark.command()
+@click.argument('report_path', type=click.Path())
+@click.option('--sizes', default='3,5,7,10,15,20,30,40')
+@click.option('--beams', default='1,10,100')
+@click.option('--samples', type=int, default=5)
+@click.option('--exact_max', type=int, default=8)
+@click.option('--lstm_dim', type=int, default=100)
+@click.option('--lin_dim', type=int, default=100)
+@click.option('--seed', type=int, default=0)
+@device_options
+def scaling(report_path, sizes, beams, **kwargs):
+    """Sweep decoders over abstract length and beam width.
+    """
+    from sent_order import benchmark
+
+    configure_device(kwargs)
+
+    config = dict(sizes=ints(sizes), beams=ints(beams), **kwargs)
+
+    rows = []
+    for row in benchmark.scaling(**config):
+
+        print(
+            f'{row["model"]:20} {row["decoder"]:18} '
+            f'n={row["n"]:<3} beam={str(row["beam_size"]):5} '
+            f'{row["seconds"]:9.4f}s '
+            f'calls={row["classifier_calls"]+row["regressor_calls"]:<7g} '
+            f'mem={row["peak_mb"] or 0:7.1f}MB '
+            f'kt={row["kt_vs_exact"]}'
+        )
+
+        rows.append(row)
+
+    with open(report_path, 'w') as fh:
+        ujson.dump(
+            dict(meta=benchmark.meta(), config=config, results=rows),
+            fh, indent=2,
+        )
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,13 @@
+
+
+# Registry names, shared by the CLI choices and the modules behind them.
+# No imports here, so the CLI can read them without loading torch.
+
+# kt_regression.DECODERS.
+KT_DECODERS = ('local', 'genetic', 'walks')
+
+# A model's own BiLSTM, plus encoders.ENCODERS.
+SENT_ENCODERS = ('lstm', 'pooled', 'cnn')
+
+# distill.TASKS.
+DISTILL_MODELS = ('pairs', 'pick_next')
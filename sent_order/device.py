@@ -0,0 +1,157 @@
+
+
+import numpy as np
+
+import os
+import attr
+import torch
+import warnings
+
+
+def parse_cpus(value):
+    """Parse a CPU list, eg '0-3,8,10-11'.
+    """
+    cpus = []
+
+    for part in value.split(','):
+
+        if '-' in part:
+            start, end = map(int, part.split('-'))
+            cpus += range(start, end+1)
+
+        elif part.strip():
+            cpus.append(int(part))
+
+    return cpus
+
+
+def numa_cpus(node):
+    """CPUs on a NUMA node.
+    """
+    path = f'/sys/devices/system/node/node{node}/cpulist'
+
+    with open(path) as fh:
+        return parse_cpus(fh.read().strip())
+
+
+@attr.s
+class Device:
+
+    # cpu, cuda, cuda:N. Default: cuda if available.
+    name = attr.ib(default=None)
+
+    # Intra-op threads. Default: one per pinned core.
+    threads = attr.ib(default=None)
+
+    # Inter-op threads.
+    interop_threads = attr.ib(default=None)
+
+    # CPU ids to pin to, as a list or '0-7,16-23'.
+    cores = attr.ib(default=None)
+
+    # Or, pin to the CPUs of a NUMA node.
+    numa_node = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+
+        if self.name is None:
+            self.name = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        if isinstance(self.cores, str):
+            self.cores = parse_cpus(self.cores)
+
+        self.device = torch.device(self.name)
+
+    def cpus(self):
+        """CPUs to pin to, or None.
+        """
+        if self.cores:
+            return list(self.cores)
+
+        if self.numa_node is not None:
+            return numa_cpus(self.numa_node)
+
+    def apply(self):
+        """Pin this process, size the thread pools, select the GPU.
+        """
+        cpus = self.cpus()
+
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+
+        threads = self.threads or (len(cpus) if cpus else None)
+
+        if threads:
+            torch.set_num_threads(threads)
+
+        if self.interop_threads:
+
+            # Only settable before the first inter-op parallel work.
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+
+            except RuntimeError as e:
+                warnings.warn(f'Inter-op threads not set: {e}')
+
+        if self.device.type == 'cuda' and self.device.index is not None:
+            torch.cuda.set_device(self.device)
+
+    def split(self, rank, workers):
+        """Config for one of N local workers, on a disjoint share of the
+        pinned (or available) CPUs.
+        """
+        cpus = self.cpus() or sorted(os.sched_getaffinity(0))
+
+        share = np.array_split(cpus, workers)[rank].tolist()
+
+        # More workers than CPUs - share them.
+        if not share:
+            share = [cpus[rank % len(cpus)]]
+
+        threads = (
+            max(1, self.threads // workers)
+            if self.threads else len(share)
+        )
+
+        return attr.evolve(
+            self,
+            threads=threads,
+            cores=share,
+            numa_node=None,
+        )
+
+
+DEVICE = Device()
+
+
+def use(device):
+    """Make a config current, and apply it to this process.
+    """
+    global DEVICE
+
+    DEVICE = device
+    DEVICE.apply()
+
+    return DEVICE
+
+
+def configure(**kwargs):
+    return use(Device(**kwargs))
+
+
+def floats(x):
+    """Float tensor on the device, from a tensor, array, or list.
+    """
+    return torch.as_tensor(x, dtype=torch.float, device=DEVICE.device)
+
+
+def longs(x):
+    """Index tensor on the device, from a tensor, array, or list.
+    """
+    return torch.as_tensor(x, dtype=torch.long, device=DEVICE.device)
+
+
+def move(x):
+    """Move a module or tensor to the device, keeping its dtype.
+    """
+    return x.to(DEVICE.device)
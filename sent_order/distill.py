@@ -0,0 +1,340 @@
+import numpy as np
+
+import time
+import random
+import torch
+import attr
+
+from tqdm import tqdm
+
+from torch import nn
+from torch.nn import functional as F
+
+from sent_order.models import pairs, pick_next
+from sent_order.encoders import sentence_encoder
+from sent_order.checkpoints import Checkpoints, load_model, load_run
+from sent_order.metrics import Metrics
+from sent_order import device, distributed, timers
+
+
+@attr.s
+class Task:
+
+    # Model file keys, in predict argument order.
+    keys = attr.ib()
+
+    # (lstm_dim, lin_dim, encoder) -> list of modules
+    student = attr.ib()
+
+    # (batch, teacher, student) -> teacher log-probs, student log-probs, y
+    step = attr.ib()
+
+    # (sents, models, beam_size) -> best path
+    order = attr.ib()
+
+    corpus = attr.ib()
+
+
+def pairs_student(lstm_dim, lin_dim, encoder):
+    return [
+        sentence_encoder(encoder, pairs.Encoder, 300, lstm_dim),
+        pairs.Classifier(4*lstm_dim, lin_dim),
+    ]
+
+
+def pairs_step(batch, teacher, student):
+    with torch.no_grad():
+        soft, _ = pairs.train_batch(batch, *teacher)
+
+    y_pred, y = pairs.train_batch(batch, *student)
+
+    return soft, y_pred, y
+
+
+def pairs_order(sents, models, beam_size):
+    return pairs.beam_search(sents, models[1], beam_size)[0][0]
+
+
+def pick_next_student(lstm_dim, lin_dim, encoder):
+    return [
+        sentence_encoder(encoder, pick_next.Encoder, 300, lstm_dim),
+        pick_next.Encoder(2*lstm_dim, lstm_dim),
+        pick_next.Classifier(8*lstm_dim+2, lin_dim),
+    ]
+
+
+def pick_next_step(batch, teacher, student):
+    # Score the same sampled candidates and right contexts.
+    idx = pick_next.example_indexes([
+        len(ab.sentences) for ab in batch.abstracts
+    ])
+
+    with torch.no_grad():
+        soft, _ = pick_next.train_batch(batch, *teacher, idx=idx)
+
+    y_pred, y = pick_next.train_batch(batch, *student, idx=idx)
+
+    return soft, y_pred, y
+
+
+def pick_next_order(sents, models, beam_size):
+    return pick_next.order_beam_search(sents, *models[1:], beam_size)[0][0]
+
+
+TASKS = dict(
+
+    pairs=Task(
+        keys=('s_encoder', 'classifier'),
+        student=pairs_student,
+        step=pairs_step,
+        order=pairs_order,
+        corpus=pairs.Corpus,
+    ),
+
+    pick_next=Task(
+        keys=('s_encoder', 'r_encoder', 'classifier'),
+        student=pick_next_student,
+        step=pick_next_step,
+        order=pick_next_order,
+        corpus=pick_next.Corpus,
+    ),
+
+)
+
+
+def load_teacher(task, teacher_path, epoch=None, s_encoder_path=None):
+    """Load a teacher run, best epoch by default.
+
+    Args:
+        s_encoder_path (str): Frozen sentence encoder, if the teacher was
+            trained on one and has no s_encoder file.
+    """
+    if not s_encoder_path:
+        return load_run(teacher_path, task.keys, epoch)
+
+    return [load_model(s_encoder_path)] + \
+        load_run(teacher_path, task.keys[1:], epoch)
+
+
+def count_params(models):
+    return sum(p.numel() for m in models for p in m.parameters())
+
+
+def distill_loss(y_pred, soft, y, temperature=1, alpha=0):
+    """KL from the teacher's scores, mixed with the gold NLL.
+
+    Args:
+        y_pred, soft (Variable): Student / teacher log-probs.
+        temperature (float): Flatten both distributions.
+        alpha (float): Weight of the gold-label loss.
+    """
+    t = F.log_softmax(soft / temperature, 1)
+    s = F.log_softmax(y_pred / temperature, 1)
+
+    kl = F.kl_div(s, t, reduction='batchmean', log_target=True)
+
+    # Keep gradient size independent of the temperature.
+    kl = kl * temperature**2
+
+    if not alpha:
+        return kl
+
+    return (1-alpha) * kl + alpha * nn.NLLLoss()(y_pred, y)
+
+
+def train(train_path, model_path, model, teacher_path, train_skim, lr,
+    epochs, epoch_size, batch_size, lstm_dim, lin_dim, encoder='lstm',
+    temperature=1, alpha=0, teacher_epoch=None, teacher_s_encoder_path=None,
+    keep=5, resume=False, overwrite=False):
+    """Train a small student on a trained teacher's scores.
+
+    The student writes the same model files as the teacher, so the model's
+    predict command takes either.
+    """
+    task = TASKS[model]
+
+    # Each worker samples from its own shard.
+    with timers.stage('corpus_load'):
+        train = task.corpus(train_path, train_skim, shard=True)
+
+    distributed.check_shard(len(train.abstracts), batch_size)
+
+    teacher = load_teacher(task, teacher_path, teacher_epoch,
+        teacher_s_encoder_path)
+
+    student = task.student(lstm_dim, lin_dim, encoder)
+
+    teacher_size, student_size = count_params(teacher), count_params(student)
+
+    if student_size >= teacher_size:
+        raise ValueError(
+            f'Student has {student_size} params, teacher {teacher_size}. '
+            'Reduce --lstm_dim / --lin_dim.'
+        )
+
+    params = [p for m in student for p in m.parameters()]
+
+    optimizer = torch.optim.Adam(params, lr=lr)
+
+    student = [device.move(m) for m in student]
+
+    checkpoints = Checkpoints(model_path, dict(zip(task.keys, student)),
+        optimizer, keep, resume, overwrite)
+
+    # Pick up after the latest checkpoint.
+    start = checkpoints.restore() if resume else 0
+
+    distributed.broadcast_params(params)
+
+    for epoch in range(start, epochs):
+
+        if distributed.is_main():
+            print(f'\nEpoch {epoch}')
+
+        epoch_loss, agree, c, t = 0, 0, 0, 0
+
+        steps = distributed.steps(epoch_size)
+
+        for _ in tqdm(steps, disable=not distributed.is_main()):
+
+            optimizer.zero_grad()
+
+            batch = train.random_batch(batch_size)
+
+            soft, y_pred, y = task.step(batch, teacher, student)
+
+            loss = distill_loss(y_pred, soft, y, temperature, alpha)
+
+            with timers.stage('backward'):
+                loss.backward()
+
+            with timers.stage('allreduce'):
+                distributed.average_gradients(params)
+
+            with timers.stage('step'):
+                optimizer.step()
+
+            timers.count('steps')
+            timers.tick()
+
+            epoch_loss += loss.item()
+
+            # EVAL
+
+            pred = np.argmax(y_pred.data.tolist(), 1)
+
+            agree += (pred == np.argmax(soft.data.tolist(), 1)).sum()
+            c += (pred == np.array(y.data.tolist())).sum()
+            t += len(pred)
+
+        epoch_loss, agree, c, t = distributed.reduce_sum(
+            epoch_loss, agree, c, t)
+
+        if distributed.is_main():
+
+            with timers.stage('checkpoint'):
+                checkpoints.save(epoch, epoch_loss / epoch_size)
+
+            print(epoch_loss / epoch_size)
+            print(agree / t, c / t)
+
+    checkpoints.close()
+
+    timers.flush()
+
+
+def evaluate(task, corpus, models, beam_size=100, batch_size=100):
+    """Order every abstract, timing the encoder and the search.
+
+    Returns: dict of timings, throughput, and order metrics
+    """
+    encode_time, search_time, gps = 0, 0, []
+
+    for batch in corpus.batches(batch_size):
+
+        start = time.perf_counter()
+
+        with torch.no_grad():
+            x, reorder = batch.packed_sentence_tensor()
+            sents = models[0](x, reorder)
+
+        encode_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+
+        with torch.no_grad():
+            for ab, ab_sents in zip(batch.abstracts,
+                batch.unpack_sentences(sents)):
+
+                path = task.order(ab_sents, models, beam_size)
+
+                gold = [s.position for s in ab.sentences]
+                gps.append((gold, np.argsort(path).tolist()))
+
+        search_time += time.perf_counter() - start
+
+    seconds = encode_time + search_time
+    sentences = sum(len(gold) for gold, _ in gps)
+
+    metrics = Metrics(gps)
+
+    return dict(
+        params=count_params(models),
+        encode_seconds=encode_time,
+        search_seconds=search_time,
+        seconds=seconds,
+        abstracts_per_second=len(gps) / seconds,
+        sentences_per_second=sentences / seconds,
+        overall_kt=float(metrics.overall_kt()),
+        overall_perfect_order_pct=float(metrics.overall_perfect_order_pct()),
+    )
+
+
+def compare(test_path, model, teacher_path, student_path, test_skim=1000,
+    beam_size=100, teacher_epoch=None, student_epoch=None,
+    teacher_s_encoder_path=None, seed=0):
+    """Run teacher and student on the same shuffled abstracts.
+
+    Returns: report dict
+    """
+    from sent_order.benchmark import meta
+
+    task = TASKS[model]
+
+    corpus = task.corpus(test_path, test_skim)
+
+    # Shuffle once, so both models see the same inputs.
+    random.seed(seed)
+
+    for batch in corpus.batches(100):
+        batch.shuffle()
+
+    models = dict(
+        teacher=load_teacher(task, teacher_path, teacher_epoch,
+            teacher_s_encoder_path),
+        student=load_run(student_path, task.keys, student_epoch),
+    )
+
+    results = {
+        name: evaluate(task, corpus, ms, beam_size)
+        for name, ms in models.items()
+    }
+
+    teacher, student = results['teacher'], results['student']
+
+    return dict(
+        meta=meta(),
+        config=dict(
+            model=model,
+            teacher_path=teacher_path,
+            student_path=student_path,
+            test_skim=test_skim,
+            beam_size=beam_size,
+            seed=seed,
+        ),
+        results=results,
+        speedup=teacher['seconds'] / student['seconds'],
+        encode_speedup=teacher['encode_seconds'] / student['encode_seconds'],
+        param_ratio=student['params'] / teacher['params'],
+        kt_delta=student['overall_kt'] - teacher['overall_kt'],
+    )
@@ -0,0 +1,155 @@
+
+
+import os
+import random
+import socket
+
+import torch
+
+from itertools import islice
+from torch import distributed as dist
+from torch import multiprocessing as mp
+
+from sent_order import device
+
+
+def free_port():
+    """Find an open local port for the process group rendezvous.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def launch(func, workers, *args, **kwargs):
+    """Run func in N local processes, joined in a gloo process group.
+
+    With 1 worker, just call func in this process.
+    """
+    if workers <= 1:
+        return func(*args, **kwargs)
+
+    port = free_port()
+    seed = random.randrange(2**32)
+
+    mp.spawn(
+        worker,
+        args=(workers, port, seed, device.DEVICE, func, args, kwargs),
+        nprocs=workers,
+    )
+
+
+def worker(rank, workers, port, seed, config, func, args, kwargs):
+    """Join the process group, then run func.
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    os.environ['RANK'] = str(rank)
+
+    # Pin to a disjoint share of the cores, before any torch work.
+    device.use(config.split(rank, workers))
+
+    dist.init_process_group('gloo', rank=rank, world_size=workers)
+
+    # Sample different batches on each rank.
+    random.seed(seed + rank)
+    torch.manual_seed(seed + rank)
+
+    try:
+        func(*args, **kwargs)
+
+    finally:
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return rank() == 0
+
+
+def barrier():
+    """Wait for all ranks.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def steps(count):
+    """Split steps between ranks, the same number on each.
+
+    Every rank must run the same number of collectives.
+    """
+    return range(-(-count // world_size()))
+
+
+def shard(items):
+    """Take this rank's share of an iterable, lazily.
+    """
+    return islice(items, rank(), None, world_size())
+
+
+def check_shard(size, batch_size):
+    """Fail before training if this rank can't sample a full batch.
+    """
+    if size < batch_size:
+        raise ValueError(
+            f'Rank {rank()} has {size} training examples, fewer than '
+            f'--batch_size {batch_size}. Use fewer --workers or more data.'
+        )
+
+
+def broadcast_params(params):
+    """Copy rank 0's parameters to all ranks.
+    """
+    if not is_distributed():
+        return
+
+    for p in params:
+        dist.broadcast(p.data, 0)
+
+
+def average_gradients(params):
+    """All-reduce gradients in a single flat buffer, divide by world size.
+    """
+    if not is_distributed():
+        return
+
+    # Params unused in this rank's batch still join the reduce.
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    grads = [p.grad.data for p in params]
+
+    flat = torch.cat([g.contiguous().view(-1) for g in grads])
+
+    dist.all_reduce(flat)
+    flat /= world_size()
+
+    start = 0
+    for g in grads:
+        g.copy_(flat[start:start+g.numel()].view_as(g))
+        start += g.numel()
+
+
+def reduce_sum(*values):
+    """Sum scalars across ranks.
+    """
+    if not is_distributed():
+        return values
+
+    x = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(x)
+
+    return tuple(x.tolist())
@@ -0,0 +1,144 @@
+
+
+import torch
+
+from torch import nn
+from torch.nn import functional as F
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+
+from sent_order import device, timers
+from sent_order.utils import pad_and_stack
+from sent_order.constants import SENT_ENCODERS
+
+
+# Max CNN feature maps. Smaller outputs use 2 * lstm_dim.
+CNN_CHANNELS = 128
+
+
+class FastEncoder(nn.Module):
+
+    """Sentence encoder over padded word embeddings, without recurrence.
+
+    Outputs 2 * lstm_dim features, the same as the BiLSTM encoders, and
+    takes either of their inputs.
+    """
+
+    def forward(self, x, arg=30):
+        """Encode sentences.
+
+        Args:
+            x (PackedSequence or list of Variable)
+            arg (int): Reorder indexes for a packed batch, like Encoder, or
+                a pad size for a list, like SentenceEncoder.
+        """
+        if isinstance(x, PackedSequence):
+            return self.encode_packed(x, arg)
+
+        with timers.stage('pad_and_pack'):
+            x, sizes = pad_and_stack(x, arg)
+
+        # Trim to the longest sentence, upcast half-precision embeddings.
+        x = device.floats(x[:,:max(sizes)])
+        sizes = device.longs(sizes)
+
+        # Keep padding at zero after the projection, like encode_packed.
+        x = self.project(x) * self.mask(x, sizes)
+
+        return self.encode(x, sizes)
+
+    def encode_packed(self, x, reorder):
+        """Encode a packed batch, restore the original order.
+        """
+        # Project real tokens only, before padding.
+        x = x._replace(data=self.project(x.data))
+
+        x, sizes = pad_packed_sequence(x, batch_first=True)
+
+        return self.encode(x, device.longs(sizes))[reorder]
+
+    def project(self, x):
+        """Per-token transform, applied before padding.
+        """
+        return x
+
+    def mask(self, x, sizes):
+        """(batch, len, 1) mask of real tokens.
+        """
+        steps = torch.arange(x.shape[1], device=x.device)
+        return (steps[None,:] < sizes[:,None]).unsqueeze(2)
+
+
+class PooledEncoder(FastEncoder):
+
+    def __init__(self, input_dim, lstm_dim):
+        """Mean + max pooled embeddings, projected.
+        """
+        super().__init__()
+
+        self.hparams = dict(input_dim=input_dim, lstm_dim=lstm_dim)
+
+        self.lin = nn.Linear(2*input_dim, 2*lstm_dim)
+
+    def encode(self, x, sizes):
+        mask = self.mask(x, sizes)
+
+        mean = (x * mask).sum(1) / sizes[:,None].clamp(min=1).float()
+        top = x.masked_fill(~mask, float('-inf')).max(1)[0]
+
+        return torch.tanh(self.lin(torch.cat([mean, top], 1)))
+
+
+class CNNEncoder(FastEncoder):
+
+    def __init__(self, input_dim, lstm_dim, channels=None):
+        """Project embeddings to a few channels, width 3 and 5 convolutions,
+        max-pool over time, project up to the output size.
+        """
+        super().__init__()
+
+        if channels is None:
+            channels = min(CNN_CHANNELS, 2*lstm_dim)
+
+        self.hparams = dict(
+            input_dim=input_dim,
+            lstm_dim=lstm_dim,
+            channels=channels,
+        )
+
+        self.proj = nn.Linear(input_dim, channels)
+        self.conv3 = nn.Conv1d(channels, channels, 3, padding=1)
+        self.conv5 = nn.Conv1d(channels, channels, 5, padding=2)
+        self.out = nn.Linear(2*channels, 2*lstm_dim)
+
+    def project(self, x):
+        return self.proj(x)
+
+    def encode(self, x, sizes):
+        mask = self.mask(x, sizes)
+
+        # (batch, dim, len)
+        x = x.transpose(1, 2).contiguous()
+
+        y = torch.cat([self.conv3(x), self.conv5(x)], 1).transpose(1, 2)
+
+        # ReLU outputs are >= 0, so masked slots can't win the max.
+        y = (F.relu(y) * mask).max(1)[0]
+
+        return torch.tanh(self.out(y))
+
+
+ENCODERS = dict(pooled=PooledEncoder, cnn=CNNEncoder)
+
+
+def sentence_encoder(name, lstm_cls, input_dim, lstm_dim):
+    """Build a sentence encoder by name.
+
+    Args:
+        name (str): One of SENT_ENCODERS.
+        lstm_cls (type): The model's own BiLSTM encoder, for 'lstm'.
+    """
+    if name not in SENT_ENCODERS:
+        raise ValueError(f'Unknown sentence encoder: {name}')
+
+    cls = lstm_cls if name == 'lstm' else ENCODERS[name]
+    return cls(input_dim, lstm_dim)
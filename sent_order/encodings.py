@@ -0,0 +1,142 @@
+
+
+import numpy as np
+
+import os
+import torch
+import attr
+import ujson
+
+from tqdm import tqdm
+from boltons.iterutils import chunked_iter
+
+from sent_order import device, distributed
+
+
+def meta_path(path):
+    return f'{path}.json'
+
+
+def read_meta(path):
+    """Metadata written next to an encodings file, or None.
+    """
+    if not os.path.exists(path) or not os.path.exists(meta_path(path)):
+        return None
+
+    with open(meta_path(path)) as fh:
+        return ujson.load(fh)
+
+
+@attr.s
+class Encodings:
+
+    # Abstracts / grafs, in corpus order.
+    units = attr.ib()
+
+    # (sentences, dim) encodings, memory-mapped.
+    array = attr.ib()
+
+    def __attrs_post_init__(self):
+        """Map each unit to its first row.
+        """
+        sizes = [len(u.sentences) for u in self.units]
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+
+        self.offsets = {id(u): start for u, start in zip(self.units, starts)}
+
+    @classmethod
+    def write(cls, path, units, encode, meta, batch_size=100):
+        """Encode every sentence once, write a .npy file and its metadata.
+
+        Args:
+            units (list): Abstracts / grafs.
+            encode (func): units -> encoded sentences, in unit order.
+            meta (dict): From Encodings.meta.
+        """
+        encodings = cls(units, None)
+
+        size = sum(len(u.sentences) for u in units)
+
+        array = None
+
+        tmp_path = f'{path}.tmp'
+
+        for chunk in tqdm(chunked_iter(units, batch_size)):
+
+            with torch.no_grad():
+                x = encode(chunk).data.cpu().numpy()
+
+            if x.shape[1] != meta['dim']:
+                raise ValueError(
+                    f'Encoder outputs {x.shape[1]} dims, '
+                    f'expected {meta["dim"]}.'
+                )
+
+            if array is None:
+                array = np.lib.format.open_memmap(
+                    tmp_path, 'w+', np.float32, (size, x.shape[1]))
+
+            array[encodings.rows(chunk)] = x
+
+        array.flush()
+        del array
+
+        os.replace(tmp_path, path)
+
+        with open(f'{meta_path(path)}.tmp', 'w') as fh:
+            ujson.dump(meta, fh)
+
+        os.replace(f'{meta_path(path)}.tmp', meta_path(path))
+
+    @staticmethod
+    def meta(units, encoder_path, dim):
+        """Identify the corpus shard and encoder behind an encodings file.
+        """
+        return dict(
+            sentences=sum(len(u.sentences) for u in units),
+            shard=[distributed.rank(), distributed.world_size()],
+            dim=dim,
+            encoder_path=os.path.abspath(encoder_path),
+            # A retrained encoder at the same path.
+            encoder_mtime=os.path.getmtime(encoder_path),
+        )
+
+    @classmethod
+    def load(cls, path, units, encode, encoder_path, dim, batch_size=100):
+        """Memory-map encodings, (re)writing them if missing, or if they
+        were made from another corpus or encoder.
+
+        Args:
+            encoder_path (str): The frozen sentence encoder file.
+            dim (int): Encoding size.
+        """
+        # Each rank encodes its own shard.
+        if distributed.world_size() > 1:
+            root, ext = os.path.splitext(path)
+            path = f'{root}.{distributed.rank()}{ext}'
+
+        meta = cls.meta(units, encoder_path, dim)
+
+        if read_meta(path) != meta:
+
+            if os.path.exists(path):
+                print(f'Stale encodings, rewriting {path}')
+
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            cls.write(path, units, encode, meta, batch_size)
+
+        return cls(units, np.load(path, mmap_mode='r'))
+
+    def rows(self, units):
+        """Rows for the (possibly shuffled) sentences of each unit.
+        """
+        return np.concatenate([
+            self.offsets[id(u)] + np.array([s.position for s in u.sentences])
+            for u in units
+        ])
+
+    def batch(self, units):
+        """Gather encodings for a batch.
+        """
+        x = torch.from_numpy(self.array[self.rows(units)])
+        return device.floats(x)
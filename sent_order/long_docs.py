@@ -0,0 +1,305 @@
+
+
+import numpy as np
+
+import math
+import attr
+
+from .search import exhaustive_search, EXHAUSTIVE_SIZE
+
+
+@attr.s
+class PairScores:
+
+    score_pairs = attr.ib()
+    size = attr.ib()
+    max_pairs = attr.ib(default=10000)
+    calls = attr.ib(default=0)
+
+    def __attrs_post_init__(self):
+        """Lazily-filled score matrix; row / column `size` is the boundary.
+        """
+        self.matrix = np.full((self.size+1, self.size+1), np.nan)
+        self.matrix[self.size] = 0
+        self.matrix[:,self.size] = 0
+
+    def fill(self, i, j):
+        """Score any missing pairs, in chunked scorer calls.
+        """
+        i, j = np.asarray(i).ravel(), np.asarray(j).ravel()
+
+        missing = np.isnan(self.matrix[i, j])
+
+        pairs = np.unique(np.stack([i[missing], j[missing]], 1), axis=0)
+
+        for start in range(0, len(pairs), self.max_pairs):
+            chunk = pairs[start:start+self.max_pairs]
+            scores = self.score_pairs(chunk[:,0], chunk[:,1])
+            self.matrix[chunk[:,0], chunk[:,1]] = scores
+            self.calls += 1
+
+    def __getitem__(self, idx):
+        self.fill(*idx)
+        return self.matrix[idx]
+
+
+def kmeans(x, k, iters=10):
+    """Cluster rows by cosine similarity.
+
+    Returns: cluster label for each row.
+    """
+    x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-8)
+
+    centroids = x[np.random.choice(len(x), k, replace=False)]
+
+    for _ in range(iters):
+
+        labels = (x @ centroids.T).argmax(1)
+
+        for c in range(k):
+            if (labels == c).any():
+                centroids[c] = x[labels == c].mean(0)
+
+    return labels
+
+
+def chunk_units(encoded, chunk_size):
+    """Cluster units into chunks of at most chunk_size.
+    """
+    n = len(encoded)
+
+    k = math.ceil(n / chunk_size)
+
+    labels = kmeans(encoded, k)
+
+    chunks = []
+    for c in range(k):
+
+        members = np.flatnonzero(labels == c)
+
+        # Split oversized clusters.
+        for start in range(0, len(members), chunk_size):
+            chunks.append(members[start:start+chunk_size])
+
+    return chunks
+
+
+def order_matrix(scores, beam_size=100):
+    """Order items by a dense pair score matrix, beam search over paths.
+    """
+    n = len(scores)
+
+    if n <= EXHAUSTIVE_SIZE:
+
+        def score_perms(perms):
+            return scores[perms[:,:-1], perms[:,1:]].sum(1)
+
+        return list(exhaustive_search(n, score_perms, 16*n)[0][0])
+
+    paths = np.arange(n).reshape(n, 1)
+    totals = np.zeros(n)
+
+    for _ in range(n-1):
+
+        # Extend each path by every item.
+        k = len(paths)
+        cands = np.tile(np.arange(n), k)
+        parents = np.repeat(np.arange(k), n)
+
+        # Skip items already on the path.
+        used = (paths[parents] == cands[:,None]).any(1)
+        cands, parents = cands[~used], parents[~used]
+
+        new_totals = totals[parents] + scores[paths[parents,-1], cands]
+
+        # Keep N highest scoring paths.
+        top = np.argsort(-new_totals, kind='stable')[:beam_size]
+
+        paths = np.concatenate([paths[parents[top]], cands[top,None]], 1)
+        totals = new_totals[top]
+
+    return paths[0].tolist()
+
+
+def insertion_moves(e, scores, window):
+    """Gains for moving one unit to another gap, within a window.
+
+    Returns: (gain, unit position, target gap) arrays
+    """
+    n = len(e) - 2
+
+    p, d = np.meshgrid(np.arange(1, n+1), np.arange(-window, window+1))
+    p, d = p.ravel(), d.ravel()
+
+    # Gap g sits between e[g] and e[g+1].
+    g = p + d
+    valid = (g >= 0) & (g <= n) & (g != p) & (g != p-1)
+    p, g = p[valid], g[valid]
+
+    x = e[p]
+
+    gain = (
+        scores[e[p-1], e[p+1]] - scores[e[p-1], x] - scores[x, e[p+1]] +
+        scores[e[g], x] + scores[x, e[g+1]] - scores[e[g], e[g+1]]
+    )
+
+    return gain, p, g
+
+
+def reversal_moves(e, scores, window):
+    """Gains for reversing a segment of at most window+1 units.
+
+    Returns: (gain, first position, last position) arrays
+    """
+    n = len(e) - 2
+
+    # Change in each adjacent pair's score when it is flipped.
+    flip = scores[e[2:-1], e[1:-2]] - scores[e[1:-2], e[2:-1]]
+    flip = np.concatenate([[0], np.cumsum(flip)])
+
+    a, length = np.meshgrid(np.arange(1, n+1), np.arange(1, window+1))
+    a, b = a.ravel(), (a + length).ravel()
+
+    valid = b <= n
+    a, b = a[valid], b[valid]
+
+    gain = (
+        scores[e[a-1], e[b]] + scores[e[a], e[b+1]] -
+        scores[e[a-1], e[a]] - scores[e[b], e[b+1]] +
+        flip[b-1] - flip[a-1]
+    )
+
+    return gain, a, b
+
+
+def local_search(order, scores, window=5, max_rounds=1000):
+    """Refine an order with batched insertion and 2-opt moves.
+
+    Each round scores every pair within the window of the current order,
+    then applies the best non-overlapping improving moves.
+    """
+    n = len(order)
+
+    for _ in range(max_rounds):
+
+        # Pad with the boundary sentinel.
+        e = np.concatenate([[n], order, [n]])
+
+        # Fill all pairs that any move can touch, in one pass.
+        i, d = np.meshgrid(np.arange(n+2), np.arange(1, window+2))
+        j = i + d
+        valid = j < n+2
+        i, j = e[i[valid]], e[j[valid]]
+        scores.fill(np.concatenate([i, j]), np.concatenate([j, i]))
+
+        matrix = scores.matrix
+
+        ins_gain, ins_p, ins_g = insertion_moves(e, matrix, window)
+        rev_gain, rev_a, rev_b = reversal_moves(e, matrix, window)
+
+        gain = np.concatenate([ins_gain, rev_gain])
+
+        # Touched spans, including neighbors.
+        lo = np.concatenate([np.minimum(ins_p, ins_g), rev_a]) - 1
+        hi = np.concatenate([np.maximum(ins_p, ins_g+1), rev_b]) + 1
+
+        kind = np.concatenate([np.zeros(len(ins_gain)), np.ones(len(rev_gain))])
+        arg1 = np.concatenate([ins_p, rev_a])
+        arg2 = np.concatenate([ins_g, rev_b])
+
+        improving = np.flatnonzero(gain > 1e-9)
+
+        if not len(improving):
+            break
+
+        taken = np.zeros(n+2, dtype=bool)
+
+        for m in improving[np.argsort(-gain[improving])]:
+
+            if taken[lo[m]:hi[m]+1].any():
+                continue
+
+            taken[lo[m]:hi[m]+1] = True
+
+            p, q = arg1[m], arg2[m]
+
+            # Reverse a segment.
+            if kind[m]:
+                e[p:q+1] = e[p:q+1][::-1].copy()
+
+            # Move a unit right, to gap q.
+            elif q > p:
+                e[p:q+1] = np.concatenate([e[p+1:q+1], [e[p]]])
+
+            # Move a unit left, to gap q.
+            else:
+                e[q+1:p+1] = np.concatenate([[e[p]], e[q+1:p]])
+
+        order = e[1:-1]
+
+    return list(order)
+
+
+def order_chunks(chunks, scores, beam_size=100):
+    """Order chunks by the link from one's last unit to the next's first.
+    """
+    lasts = np.array([c[-1] for c in chunks])
+    firsts = np.array([c[0] for c in chunks])
+
+    i, j = np.meshgrid(lasts, firsts, indexing='ij')
+    links = scores[i, j]
+    np.fill_diagonal(links, 0)
+
+    return np.concatenate([chunks[c] for c in order_matrix(links, beam_size)])
+
+
+def split_weakest(order, scores, count):
+    """Cut an order into runs at its weakest links.
+    """
+    links = scores[order[:-1], order[1:]]
+
+    cuts = np.sort(np.argsort(links)[:count]) + 1
+
+    return np.split(order, cuts)
+
+
+def order_long(encoded, score_pairs, chunk_size=8, window=5, beam_size=100,
+    levels=3, max_rounds=1000):
+    """Order a long document: chunk, order within and between chunks, refine.
+
+    After each refinement the order is cut at its weakest links, and the
+    resulting runs are re-ordered as chunks.
+
+    Args:
+        encoded (np.array): (n, d) unit encodings, used for clustering.
+        score_pairs (func): (i, j) index arrays -> log-prob i precedes j.
+
+    Returns: ordered unit indexes.
+    """
+    n = len(encoded)
+
+    scores = PairScores(score_pairs, n)
+
+    chunks = chunk_units(encoded, chunk_size)
+
+    # Order units within each chunk.
+    for c, chunk in enumerate(chunks):
+        i, j = np.meshgrid(chunk, chunk, indexing='ij')
+        sub = scores[i, j]
+        chunks[c] = chunk[order_matrix(sub, beam_size)]
+
+    best, best_score = None, -np.inf
+
+    for _ in range(levels):
+
+        order = order_chunks(chunks, scores, beam_size)
+        order = np.array(local_search(order, scores, window, max_rounds))
+
+        score = scores[order[:-1], order[1:]].sum()
+
+        if score > best_score:
+            best, best_score = order, score
+
+        chunks = split_weakest(order, scores, len(chunks)-1)
+
+    return best.tolist()
@@ -6,72 +6,379 @@ import attr
 import warnings
 import ujson
 
+from concurrent.futures import ProcessPoolExecutor
+
 from cached_property import cached_property
 from collections import defaultdict, Counter, OrderedDict
-from scipy import stats
+from boltons.iterutils import chunked_iter
 
-from .utils import sort_by_key
+from .nbest import read_nbest
 
 
 warnings.simplefilter("ignore")
 
 
+# Above this length, count inversions with a Fenwick tree.
+BROADCAST_MAX_LEN = 64
+
+# Memory ceiling for broadcast comparisons.
+MAX_BYTES = 2**26
+
+
+def sort_by_key(d, desc=False):
+    """Sort dictionary by key.
+    """
+    items = sorted(d.items(), key=lambda x: x[0], reverse=desc)
+
+    return OrderedDict(items)
+
+
+def count_inversions_broadcast(x):
+    """Count inversions in each row by comparing all pairs at once.
+    """
+    k, n = x.shape
+
+    upper = np.triu(np.ones((n, n), dtype=bool), 1)
+
+    chunk_size = max(1, MAX_BYTES // (n*n))
+
+    return np.concatenate([
+        ((c[:,:,None] > c[:,None,:]) & upper).sum((1, 2))
+        for c in np.split(x, range(chunk_size, k, chunk_size))
+    ])
+
+
+def count_inversions_fenwick(x):
+    """Count inversions in each row in O(n log n), with one Fenwick tree per
+    row, updated in lockstep across rows.
+
+    Args:
+        x (np.array): (k, n) rows, each a permutation of range(n).
+    """
+    k, n = x.shape
+
+    rows = np.arange(k)
+    tree = np.zeros((k, n+1), dtype=np.int64)
+    inversions = np.zeros(k, dtype=np.int64)
+
+    for j in range(n):
+
+        v = x[:,j] + 1
+
+        # Count seen values <= v.
+        seen, idx = np.zeros(k, dtype=np.int64), v.copy()
+        while (idx > 0).any():
+            active = idx > 0
+            seen[active] += tree[rows[active], idx[active]]
+            idx[active] -= idx[active] & -idx[active]
+
+        # Seen values > v are inversions.
+        inversions += j - seen
+
+        # Mark v as seen.
+        idx = v.copy()
+        while (idx <= n).any():
+            active = idx <= n
+            tree[rows[active], idx[active]] += 1
+            idx[active] += idx[active] & -idx[active]
+
+    return inversions
+
+
+def kendall_taus(gold, pred):
+    """Kendall's tau for each row of two (k, n) arrays of positions.
+
+    Rows that aren't permutations of range(n) fall back to scipy, which
+    corrects for ties.
+    """
+    k, n = gold.shape
+
+    if n < 2:
+        return np.full(k, np.nan)
+
+    perm = np.arange(n)
+
+    valid = (
+        (np.sort(gold, 1) == perm).all(1) &
+        (np.sort(pred, 1) == perm).all(1)
+    )
+
+    taus = np.empty(k)
+
+    # Pred positions, in gold order.
+    x = np.take_along_axis(pred[valid], np.argsort(gold[valid], 1), 1)
+
+    if n <= BROADCAST_MAX_LEN:
+        inversions = count_inversions_broadcast(x)
+    else:
+        inversions = count_inversions_fenwick(x)
+
+    taus[valid] = 1 - 4 * inversions / (n * (n-1))
+
+    if not valid.all():
+
+        from scipy import stats
+
+        for i in np.flatnonzero(~valid):
+            taus[i], _ = stats.kendalltau(gold[i], pred[i])
+
+    return taus
+
+
+def longest_increasing(x):
+    """Length of the longest increasing subsequence in each row.
+
+    Args:
+        x (np.array): (k, n) rows of distinct values.
+    """
+    k, n = x.shape
+
+    # Smallest tail of an increasing run of each length, per row.
+    tails = np.full((k, n), np.inf)
+    rows = np.arange(k)
+
+    for j in range(n):
+        v = x[:,j]
+        tails[rows, (tails < v[:,None]).sum(1)] = v
+
+    return np.isfinite(tails).sum(1)
+
+
+def bootstrap_ratios(num, den, replicates, seed=None):
+    """Resample abstracts with replacement, take the ratio of summed values
+    for each replicate.
+
+    Args:
+        num (np.array): Per-abstract numerators.
+        den (np.array): Per-abstract denominators.
+        replicates (int): Number of resamples.
+        seed: Seed for numpy's default_rng.
+    """
+    rng = np.random.default_rng(seed)
+
+    n = len(num)
+
+    # Nothing to resample.
+    if not n:
+        return np.full(replicates, np.nan)
+
+    # Index arrays are the bulk of the memory.
+    chunk_size = max(1, MAX_BYTES // (8*n))
+
+    # Skip the second gather for plain averages.
+    constant = (den == den[0]).all()
+
+    ratios = []
+    for start in range(0, replicates, chunk_size):
+
+        idx = rng.integers(0, n, size=(min(chunk_size, replicates-start), n))
+
+        totals = num[idx].sum(1)
+
+        if constant:
+            ratios.append(totals / (den[0] * n))
+        else:
+            ratios.append(totals / den[idx].sum(1))
+
+    return np.concatenate(ratios)
+
+
 class Metrics:
 
     @classmethod
     def from_file(cls, path):
+        """Read (gold, pred) JSON lines, or a legacy JSON array.
+        """
         with open(path) as fh:
-            return cls(ujson.load(fh))
+
+            if is_json_array(path):
+                return cls(ujson.load(fh))
+
+            return cls([ujson.loads(line) for line in fh if line.strip()])
 
     def __init__(self, gold_pred):
         self.gold_pred = gold_pred
 
     @cached_property
-    def len_counts(self):
-        """Sentence count -> count.
+    def lengths(self):
+        """Sentence count for each abstract.
         """
-        lengths = map(len, [g for g, _ in self.gold_pred])
-        return Counter(list(lengths))
+        return np.array([len(g) for g, _ in self.gold_pred], dtype=np.int64)
 
-    def perfect_order_pct_by_len(self, max_len=10):
-        """Percent perfect order by sentence count.
+    @cached_property
+    def offsets(self):
+        """Start of each abstract in the flat arrays, plus the end.
         """
-        perfect = Counter()
+        return np.concatenate([[0], np.cumsum(self.lengths)])
 
-        for gold, pred in self.gold_pred:
-            if gold == pred:
-                perfect[len(gold)] += 1
+    @cached_property
+    def flat(self):
+        """Flat gold, pred position arrays, abstract index for each sentence.
+        """
+        total = int(self.offsets[-1])
+
+        gold = np.fromiter(
+            (i for g, _ in self.gold_pred for i in g),
+            dtype=np.int64, count=total,
+        )
+
+        pred = np.fromiter(
+            (i for _, p in self.gold_pred for i in p),
+            dtype=np.int64, count=total,
+        )
+
+        ids = np.repeat(np.arange(len(self.lengths)), self.lengths)
+
+        return gold, pred, ids
+
+    @cached_property
+    def correct(self):
+        """Sentences in the right slot, for each abstract.
+        """
+        gold, pred, ids = self.flat
+
+        return np.bincount(
+            ids,
+            weights=gold == pred,
+            minlength=len(self.lengths),
+        ).astype(np.int64)
+
+    @cached_property
+    def perfect(self):
+        """Whether each abstract is perfectly ordered.
+        """
+        return self.correct == self.lengths
+
+    @cached_property
+    def gold_pred_by_len(self):
+        """Sentence count -> abstract indexes, 2-D gold and pred arrays.
+        """
+        gold, pred, _ = self.flat
+
+        by_len = {}
+        for slen in np.unique(self.lengths):
+            idx = np.flatnonzero(self.lengths == slen)
+            flat_idx = self.offsets[idx][:,None] + np.arange(slen)
+            by_len[int(slen)] = idx, gold[flat_idx], pred[flat_idx]
+
+        return by_len
+
+    def by_abstract(self, func):
+        """Apply a function to each (gold, pred) length group, scatter the
+        results back to one value per abstract.
+        """
+        values = np.empty(len(self.lengths))
+
+        for idx, gold, pred in self.gold_pred_by_len.values():
+            values[idx] = func(gold, pred)
+
+        return values
+
+    @cached_property
+    def kts(self):
+        """Kendall's tau for each abstract.
+        """
+        return self.by_abstract(kendall_taus)
+
+    @cached_property
+    def lcs(self):
+        """Longest correctly-ordered subsequence, for each abstract.
+        """
+        def func(gold, pred):
+            # Pred positions, in gold order.
+            x = np.take_along_axis(pred, np.argsort(gold, 1), 1)
+            return longest_increasing(x)
+
+        return self.by_abstract(func)
+
+    @cached_property
+    def first_correct(self):
+        """Whether the first sentence is predicted first, for each abstract.
+        """
+        gold, pred, ids = self.flat
+
+        first = gold == 0
+
+        correct = np.zeros(len(self.lengths), dtype=bool)
+        correct[ids[first]] = pred[first] == 0
+
+        return correct
+
+    @cached_property
+    def last_correct(self):
+        """Whether the last sentence is predicted last, for each abstract.
+        """
+        gold, pred, ids = self.flat
+
+        last = gold == self.lengths[ids]-1
+
+        correct = np.zeros(len(self.lengths), dtype=bool)
+        correct[ids[last]] = pred[last] == self.lengths[ids[last]]-1
+
+        return correct
+
+    def sum_by_len(self, values, max_len=10):
+        """Sum a per-abstract value for each sentence count.
+        """
+        sums = np.bincount(self.lengths, weights=values)
 
         return sort_by_key({
-            slen: perfect.get(slen, 0) / self.len_counts[slen]
+            slen: sums[slen]
             for slen in self.len_counts
             if slen <= max_len
         })
 
+    def mean_by_len(self, values, max_len=10):
+        """Average a per-abstract value for each sentence count.
+        """
+        return sort_by_key({
+            slen: total / self.len_counts[slen]
+            for slen, total in self.sum_by_len(values, max_len).items()
+        })
+
+    @cached_property
+    def len_counts(self):
+        """Sentence count -> count.
+        """
+        counts = np.bincount(self.lengths)
+
+        return Counter({
+            int(slen): int(counts[slen])
+            for slen in np.flatnonzero(counts)
+        })
+
+    def perfect_order_pct_by_len(self, max_len=10):
+        """Percent perfect order by sentence count.
+        """
+        return self.mean_by_len(self.perfect, max_len)
+
     def overall_perfect_order_pct(self):
         """Percent perfect order overall.
         """
-        perfect = sum([1 for g, p in self.gold_pred if g==p])
-        return perfect / len(self.gold_pred)
+        return self.perfect.mean()
 
     @cached_property
     def kts_by_len(self):
         """Kendall's tau by sentence count.
         """
-        kts = defaultdict(list)
-
-        for gold, pred in self.gold_pred:
-            kt, _ = stats.kendalltau(gold, pred)
-            kts[len(gold)].append(kt)
-
-        return kts
+        return {
+            slen: self.kts[idx]
+            for slen, (idx, _, _) in self.gold_pred_by_len.items()
+        }
 
     def avg_kt_by_len(self, max_len=10):
-        """Average KT for each sentence count.
+        """Average KT for each sentence count, skipping undefined taus.
         """
+        defined = ~np.isnan(self.kts)
+
+        kts = np.where(defined, self.kts, 0)
+
+        sums = np.bincount(self.lengths, weights=kts)
+        counts = np.bincount(self.lengths, weights=defined)
+
         return sort_by_key({
-            slen: sum(kts) / len(kts)
-            for slen, kts in self.kts_by_len.items()
+            slen: sums[slen] / counts[slen] if counts[slen] else np.nan
+            for slen in self.len_counts
             if slen <= max_len
         })
 
@@ -82,31 +389,375 @@ class Metrics:
         return [kt for kts in self.kts_by_len.values() for kt in kts]
 
     def overall_kt(self):
-        """Overall average KT.
+        """Overall average KT, skipping single sentences.
         """
-        return sum(self.all_kts) / len(self.all_kts)
+        return np.nanmean(self.kts)
 
     def positional_accuracy_pct_by_len(self, max_len=10):
         """Percentage of sentences in the right slot.
         """
-        correct = Counter()
+        return sort_by_key({
+            slen: correct / (self.len_counts[slen] * slen)
+            for slen, correct in self.sum_by_len(self.correct, max_len).items()
+        })
+
+    def overall_positional_accuracy_pct(self):
+        """Positional accuracy for all sentences.
+        """
+        return self.correct.sum() / self.lengths.sum()
+
+    def lcs_pct_by_len(self, max_len=10):
+        """Longest correctly-ordered subsequence, as a share of the length.
+        """
+        return self.mean_by_len(self.lcs / self.lengths, max_len)
+
+    def overall_lcs_pct(self):
+        """Longest correctly-ordered subsequence share, overall.
+        """
+        return (self.lcs / self.lengths).mean()
+
+    def first_correct_pct_by_len(self, max_len=10):
+        """Percent of abstracts with the first sentence predicted first.
+        """
+        return self.mean_by_len(self.first_correct, max_len)
+
+    def last_correct_pct_by_len(self, max_len=10):
+        """Percent of abstracts with the last sentence predicted last.
+        """
+        return self.mean_by_len(self.last_correct, max_len)
+
+    def bootstrap_values(self, metric):
+        """Per-abstract numerators and denominators for an overall metric.
+        """
+        ones = np.ones(len(self.lengths))
+
+        if metric == 'kt':
+            # Tau is undefined for single sentences.
+            defined = ~np.isnan(self.kts)
+            return self.kts[defined], ones[defined]
+
+        return dict(
+            perfect=(self.perfect.astype(float), ones),
+            positional=(self.correct.astype(float), self.lengths),
+            lcs=(self.lcs / self.lengths, ones),
+            first=(self.first_correct.astype(float), ones),
+            last=(self.last_correct.astype(float), ones),
+        )[metric]
+
+    def bootstrap_ci(self, metric='kt', replicates=10000, alpha=0.05,
+        workers=None, seed=None):
+        """Percentile bootstrap confidence interval for an overall metric.
+
+        Args:
+            metric (str): kt, perfect, positional, lcs, first or last.
+            replicates (int): Number of resamples.
+            alpha (float): 1 - confidence level.
+            workers (int): If set, split replicates across processes.
+            seed (int)
+
+        Returns: low, high, or NaNs if no abstracts define the metric
+        """
+        num, den = self.bootstrap_values(metric)
+
+        if not len(num):
+            return np.nan, np.nan
+
+        if workers and workers > 1:
+
+            seeds = np.random.SeedSequence(seed).spawn(workers)
+            counts = np.diff(np.linspace(0, replicates, workers+1, dtype=int))
+
+            with ProcessPoolExecutor(workers) as pool:
+                ratios = np.concatenate(list(pool.map(
+                    bootstrap_ratios,
+                    [num]*workers,
+                    [den]*workers,
+                    counts,
+                    seeds,
+                )))
+
+        else:
+            ratios = bootstrap_ratios(num, den, replicates, seed)
+
+        low, high = np.percentile(ratios, [100*alpha/2, 100*(1-alpha/2)])
+
+        return low, high
+
+    def report(self, max_len=10):
+        """All metrics, by sentence count and overall.
+        """
+        return dict(
+            len_counts=sort_by_key(self.len_counts),
+            perfect_order_pct_by_len=self.perfect_order_pct_by_len(max_len),
+            overall_perfect_order_pct=self.overall_perfect_order_pct(),
+            avg_kt_by_len=self.avg_kt_by_len(max_len),
+            overall_kt=self.overall_kt(),
+            positional_accuracy_pct_by_len=
+                self.positional_accuracy_pct_by_len(max_len),
+            overall_positional_accuracy_pct=
+                self.overall_positional_accuracy_pct(),
+            lcs_pct_by_len=self.lcs_pct_by_len(max_len),
+            overall_lcs_pct=self.overall_lcs_pct(),
+            first_correct_pct=self.first_correct.mean(),
+            first_correct_pct_by_len=self.first_correct_pct_by_len(max_len),
+            last_correct_pct=self.last_correct.mean(),
+            last_correct_pct_by_len=self.last_correct_pct_by_len(max_len),
+        )
+
+
+def is_json_array(path):
+    """Is a prediction file one JSON array of pairs, rather than JSON lines?
+
+    Array files start `[[[` (or are `[]`); lines start `[[` + a position.
+    """
+    with open(path) as fh:
+        head = ''.join(fh.read(64).split())
+
+    return head.startswith('[[[') or head == '[]'
+
+
+class MetricsAccumulator:
+
+    # Per-length sums.
+    fields = (
+        'count',
+        'perfect',
+        'correct',
+        'kt',
+        'kt_count',
+        'lcs_pct',
+        'first_correct',
+        'last_correct',
+    )
+
+    @classmethod
+    def from_files(cls, paths, chunk_size=10000):
+        """Stream a set of prediction files.
+        """
+        acc = cls()
+
+        for path in paths:
+            acc.update_file(path, chunk_size)
+
+        return acc
+
+    @classmethod
+    def load(cls, path):
+        """Load saved partial sums.
+        """
+        acc = cls()
+
+        with np.load(path) as arrays:
+            acc.sums = {f: arrays[f] for f in arrays.files}
+
+        # Saved before kt_count: assume taus were defined for 2+ sentences.
+        if 'kt_count' not in acc.sums:
+            kt = acc.sums['kt']
+            acc.sums['kt_count'] = np.where(np.isnan(kt), 0, acc.sums['count'])
+            acc.sums['kt'] = np.nan_to_num(kt)
+
+        return acc
+
+    def __init__(self):
+        self.sums = {f: np.zeros(0) for f in self.fields}
+
+    def save(self, path):
+        """Save partial sums, to merge later.
+        """
+        np.savez(path, **self.sums)
+
+    def add_sums(self, sums):
+        """Add per-length sums, growing to the longest length.
+        """
+        size = max(len(self.sums['count']), len(sums['count']))
+
+        for f in self.fields:
+            total = np.zeros(size)
+            total[:len(self.sums[f])] += self.sums[f]
+            total[:len(sums[f])] += sums[f]
+            self.sums[f] = total
+
+    def update(self, gold_pred):
+        """Add a chunk of (gold, pred) pairs.
+        """
+        if not gold_pred:
+            return
+
+        m = Metrics(gold_pred)
+
+        # Tau is undefined for single sentences.
+        kt_defined = ~np.isnan(m.kts)
 
-        for gold, pred in self.gold_pred:
-            correct[len(gold)] += np.equal(gold, pred).sum()
+        values = dict(
+            count=np.ones(len(m.lengths)),
+            perfect=m.perfect,
+            correct=m.correct,
+            kt=np.where(kt_defined, m.kts, 0),
+            kt_count=kt_defined,
+            lcs_pct=m.lcs / m.lengths,
+            first_correct=m.first_correct,
+            last_correct=m.last_correct,
+        )
 
+        self.add_sums({
+            f: np.bincount(m.lengths, weights=values[f])
+            for f in self.fields
+        })
+
+    def update_jsonl(self, path, chunk_size=10000):
+        """Stream (gold, pred) JSON lines.
+        """
+        with open(path) as fh:
+            for lines in chunked_iter(fh, chunk_size):
+                self.update([ujson.loads(line) for line in lines])
+
+    def update_json(self, path, chunk_size=10000):
+        """Read a legacy (gold, pred) JSON array.
+
+        Loads the whole file - not constant-memory. Predict now writes
+        JSON lines.
+        """
+        with open(path) as fh:
+            gold_pred = ujson.load(fh)
+
+        for chunk in chunked_iter(gold_pred, chunk_size):
+            self.update(chunk)
+
+    def update_nbest(self, path, chunk_size=10000):
+        """Stream the top prediction from an n-best file.
+        """
+        gps = (
+            (gold.tolist(), preds[0].tolist())
+            for gold, preds, _ in read_nbest(path, chunk_size)
+        )
+
+        for chunk in chunked_iter(gps, chunk_size):
+            self.update(chunk)
+
+    def update_file(self, path, chunk_size=10000):
+        """Read a JSONL, n-best .npz, or legacy JSON prediction file.
+        """
+        if path.endswith('.npz'):
+            self.update_nbest(path, chunk_size)
+
+        elif is_json_array(path):
+            self.update_json(path, chunk_size)
+
+        else:
+            self.update_jsonl(path, chunk_size)
+
+    def merge(self, other):
+        """Combine with another accumulator, eg from another shard.
+        """
+        acc = MetricsAccumulator()
+        acc.add_sums(self.sums)
+        acc.add_sums(other.sums)
+
+        return acc
+
+    __add__ = merge
+
+    @property
+    def len_counts(self):
+        """Sentence count -> count.
+        """
+        return Counter({
+            int(slen): int(count)
+            for slen, count in enumerate(self.sums['count'])
+            if count
+        })
+
+    def mean_by_len(self, field, max_len=10):
+        """Average a summed field for each sentence count.
+        """
         return sort_by_key({
-            slen: correct.get(slen, 0) / (self.len_counts[slen] * slen)
+            slen: self.sums[field][slen] / count
+            for slen, count in self.len_counts.items()
+            if slen <= max_len
+        })
+
+    def overall_mean(self, field):
+        """Average a summed field over all abstracts.
+        """
+        return self.sums[field].sum() / self.sums['count'].sum()
+
+    def perfect_order_pct_by_len(self, max_len=10):
+        """Percent perfect order by sentence count.
+        """
+        return self.mean_by_len('perfect', max_len)
+
+    def overall_perfect_order_pct(self):
+        """Percent perfect order overall.
+        """
+        return self.overall_mean('perfect')
+
+    def avg_kt_by_len(self, max_len=10):
+        """Average KT for each sentence count, skipping undefined taus.
+        """
+        kt, kt_count = self.sums['kt'], self.sums['kt_count']
+
+        return sort_by_key({
+            slen: kt[slen] / kt_count[slen] if kt_count[slen] else np.nan
             for slen in self.len_counts
             if slen <= max_len
         })
 
+    def overall_kt(self):
+        """Overall average KT, skipping single sentences.
+        """
+        return self.sums['kt'].sum() / self.sums['kt_count'].sum()
+
+    def positional_accuracy_pct_by_len(self, max_len=10):
+        """Percentage of sentences in the right slot.
+        """
+        return sort_by_key({
+            slen: pct / slen
+            for slen, pct in self.mean_by_len('correct', max_len).items()
+        })
+
     def overall_positional_accuracy_pct(self):
         """Positional accuracy for all sentences.
         """
-        c, t = 0, 0
+        sizes = np.arange(len(self.sums['count']))
+        return self.sums['correct'].sum() / (self.sums['count'] * sizes).sum()
 
-        for gold, pred in self.gold_pred:
-            c += np.equal(gold, pred).sum()
-            t += len(gold)
+    def lcs_pct_by_len(self, max_len=10):
+        """Longest correctly-ordered subsequence, as a share of the length.
+        """
+        return self.mean_by_len('lcs_pct', max_len)
 
-        return c / t
+    def overall_lcs_pct(self):
+        """Longest correctly-ordered subsequence share, overall.
+        """
+        return self.overall_mean('lcs_pct')
+
+    def first_correct_pct_by_len(self, max_len=10):
+        """Percent of abstracts with the first sentence predicted first.
+        """
+        return self.mean_by_len('first_correct', max_len)
+
+    def last_correct_pct_by_len(self, max_len=10):
+        """Percent of abstracts with the last sentence predicted last.
+        """
+        return self.mean_by_len('last_correct', max_len)
+
+    def report(self, max_len=10):
+        """All metrics, by sentence count and overall.
+        """
+        return dict(
+            len_counts=sort_by_key(self.len_counts),
+            perfect_order_pct_by_len=self.perfect_order_pct_by_len(max_len),
+            overall_perfect_order_pct=self.overall_perfect_order_pct(),
+            avg_kt_by_len=self.avg_kt_by_len(max_len),
+            overall_kt=self.overall_kt(),
+            positional_accuracy_pct_by_len=
+                self.positional_accuracy_pct_by_len(max_len),
+            overall_positional_accuracy_pct=
+                self.overall_positional_accuracy_pct(),
+            lcs_pct_by_len=self.lcs_pct_by_len(max_len),
+            overall_lcs_pct=self.overall_lcs_pct(),
+            first_correct_pct=self.overall_mean('first_correct'),
+            first_correct_pct_by_len=self.first_correct_pct_by_len(max_len),
+            last_correct_pct=self.overall_mean('last_correct'),
+            last_correct_pct_by_len=self.last_correct_pct_by_len(max_len),
+        )
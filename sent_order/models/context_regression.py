@@ -20,21 +20,31 @@ from torch.nn.utils.rnn import pack_padded_sequence
 from torch.autograd import Variable
 from torch.nn import functional as F
 
-from sent_order.cuda import ftype, itype
+from sent_order import device, distributed, timers
+from sent_order.checkpoints import Checkpoints, hparams, load_model
+from sent_order.encoders import sentence_encoder
+from sent_order.encodings import Encodings
+from sent_order.nbest import write_gold_pred
 from sent_order.vectors import LazyVectors
-from sent_order.utils import checkpoint, pad_and_pack
+from sent_order.utils import pad_and_pack, pack, shuffled_spans
 
 
 vectors = LazyVectors.read()
 
 
-def read_abstracts(path):
-    """Parse abstract JSON lines.
+def read_lines(path):
+    """Unparsed abstract JSON lines.
     """
     for path in glob(os.path.join(path, '*.json')):
         with open(path) as fh:
-            for line in fh:
-                yield Abstract.from_line(line)
+            yield from fh
+
+
+def read_abstracts(path):
+    """Parse abstract JSON lines.
+    """
+    for line in read_lines(path):
+        yield Abstract.from_line(line)
 
 
 @attr.s
@@ -43,19 +53,10 @@ class Sentence:
     position = attr.ib()
     tokens = attr.ib()
 
-    def tensor(self, dim=300):
-        """Stack word vectors.
+    def tensor(self):
+        """Stack word vectors, in the storage dtype.
         """
-        x = [
-            vectors[t] if t in vectors else np.zeros(dim)
-            for t in self.tokens
-        ]
-
-        x = np.array(x)
-        x = torch.from_numpy(x)
-        x = x.float()
-
-        return x
+        return vectors.embed(self.tokens)
 
 
 @attr.s
@@ -83,11 +84,12 @@ class Batch:
     def sentence_variables(self):
         """Pack sentence tensors.
         """
-        return [
-            Variable(s.tensor()).type(ftype)
-            for a in self.abstracts
-            for s in a.sentences
-        ]
+        with timers.stage('embed'):
+            return [
+                device.move(s.tensor())
+                for a in self.abstracts
+                for s in a.sentences
+            ]
 
     def unpack_sentences(self, encoded):
         """Unpack encoded sentences.
@@ -107,15 +109,25 @@ class Batch:
 
 class Corpus:
 
-    def __init__(self, path, skim=None):
+    def __init__(self, path, skim=None, shard=False):
         """Load abstracts into memory.
+
+        Args:
+            shard (bool): Keep this rank's share of the skim, and only
+                parse those lines.
         """
-        reader = read_abstracts(path)
+        lines = read_lines(path)
 
         if skim:
-            reader = islice(reader, skim)
+            lines = islice(lines, skim)
+
+        if shard:
+            lines = distributed.shard(lines)
 
-        self.abstracts = list(tqdm(reader, total=skim))
+        self.abstracts = [
+            Abstract.from_line(line)
+            for line in tqdm(lines, total=None if shard else skim)
+        ]
 
     def random_batch(self, size):
         """Query random batch.
@@ -151,6 +163,12 @@ class Encoder(nn.Module):
         """
         # Pad, pack, encode.
         x, reorder = pad_and_pack(x, pad_size)
+
+        return self.encode_packed(x, reorder)
+
+    def encode_packed(self, x, reorder):
+        """Encode an already-packed batch, restore the original order.
+        """
         _, (hn, _) = self.lstm(x)
 
         # Cat forward + backward hidden layers.
@@ -180,95 +198,172 @@ class Regressor(nn.Module):
         return y.squeeze()
 
 
-def train_batch(batch, sent_encoder, graf_encoder, regressor):
-    """Train the batch.
+def encode_batch(batch, sent_encoder):
+    """Encode the batch's sentences.
     """
     sents = batch.sentence_variables()
 
+    with timers.stage('encode'):
+        return sent_encoder(sents, 30)
+
+
+def train_batch(batch, sent_encoder, graf_encoder, regressor, sents=None):
+    """Train the batch.
+
+    Pass precomputed sentence encodings to skip the sentence encoder.
+    """
     # Encode sentences.
-    sents = sent_encoder(sents, 30)
+    if sents is None:
+        sents = encode_batch(batch, sent_encoder)
 
-    # Generate x / y pairs.
-    examples = []
-    for ab in batch.unpack_sentences(sents):
-        for i in range(len(ab)):
+    timers.count('sentences', len(sents))
 
-            # Shuffle global context.
-            perm = torch.randperm(len(ab)).type(itype)
-            graf = ab[perm]
+    sizes = np.array([len(ab.sentences) for ab in batch.abstracts])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
 
-            # 0 <--> 1
-            y = i / (len(ab)-1)
+    # For each sentence: its abstract's start, size, and position.
+    ab = np.repeat(np.arange(len(sizes)), sizes)
+    i = np.arange(sizes.sum()) - starts[ab]
 
-            # Graf, sentence, size, position.
-            examples.append((graf, ab[i], y))
+    # Shuffle global context, once per sentence.
+    with timers.stage('examples'):
+        grafs, graf_sizes = shuffled_spans(starts[ab], sizes[ab], 30, 0)
 
-    grafs, sents, ys = zip(*examples)
+    grafs = sents[device.longs(grafs.ravel())]
+    grafs = grafs.view(len(i), -1, sents.data.shape[1])
 
     # Encode grafs.
-    grafs = graf_encoder(grafs, 30)
+    with timers.stage('graf_encode'):
+        grafs = graf_encoder.encode_packed(*pack(grafs, graf_sizes.tolist()))
 
     # Cat graf + sent.
-    x = zip(grafs, sents)
-    x = list(map(torch.cat, x))
-    x = torch.stack(x)
+    x = torch.cat([grafs, sents], 1)
+
+    # 0 <--> 1
+    y = i / np.maximum(sizes[ab]-1, 1)
+    y = device.floats(y)
 
-    y = Variable(torch.FloatTensor(ys)).type(ftype)
+    timers.count('examples', len(y))
 
-    return y, regressor(x)
+    with timers.stage('regressor'):
+        return y, regressor(x)
 
 
 def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
-    batch_size, lstm_dim, lin_dim):
+    batch_size, lstm_dim, lin_dim, sent_encoder_path=None,
+    encodings_path=None, encoder='lstm', keep=5, resume=False,
+    overwrite=False):
     """Train model.
+
+    With sent_encoder_path, freeze a trained sentence encoder, encode the
+    corpus once, and train only the graf encoder and regressor.
     """
-    train = Corpus(train_path, train_skim)
+    # Each worker samples from its own shard.
+    with timers.stage('corpus_load'):
+        train = Corpus(train_path, train_skim, shard=True)
+
+    distributed.check_shard(len(train.abstracts), batch_size)
+
+    encodings = None
+
+    if sent_encoder_path:
+
+        sent_encoder = load_model(sent_encoder_path)
+
+        lstm_dim = hparams(sent_encoder)['lstm_dim']
+
+        encodings = Encodings.load(
+            encodings_path or os.path.join(model_path, 'encodings.npy'),
+            train.abstracts,
+            lambda abstracts: encode_batch(Batch(abstracts), sent_encoder),
+            sent_encoder_path, 2*lstm_dim,
+        )
+
+    else:
+        sent_encoder = sentence_encoder(encoder, Encoder, 300, lstm_dim)
 
-    sent_encoder = Encoder(300, lstm_dim)
     graf_encoder = Encoder(2*lstm_dim, lstm_dim)
     regressor = Regressor(4*lstm_dim, lin_dim)
 
     params = (
-        list(sent_encoder.parameters()) +
         list(graf_encoder.parameters()) +
         list(regressor.parameters())
     )
 
+    if not encodings:
+        params += list(sent_encoder.parameters())
+
     optimizer = torch.optim.Adam(params, lr=lr)
 
     loss_func = nn.MSELoss()
 
-    if torch.cuda.is_available():
-        sent_encoder = sent_encoder.cuda()
-        graf_encoder = graf_encoder.cuda()
-        regressor = regressor.cuda()
+    sent_encoder = device.move(sent_encoder)
+    graf_encoder = device.move(graf_encoder)
+    regressor = device.move(regressor)
+
+    models = dict(
+        graf_encoder=graf_encoder,
+        regressor=regressor,
+    )
+
+    if not encodings:
+        models['sent_encoder'] = sent_encoder
+
+    checkpoints = Checkpoints(model_path, models, optimizer, keep, resume,
+        overwrite)
+
+    # Pick up after the latest checkpoint.
+    start = checkpoints.restore() if resume else 0
 
-    for epoch in range(epochs):
+    distributed.broadcast_params(params)
 
-        print(f'\nEpoch {epoch}')
+    for epoch in range(start, epochs):
+
+        if distributed.is_main():
+            print(f'\nEpoch {epoch}')
 
         epoch_loss = 0
-        for _ in tqdm(range(epoch_size)):
+        steps = distributed.steps(epoch_size)
+
+        for _ in tqdm(steps, disable=not distributed.is_main()):
 
             optimizer.zero_grad()
 
             batch = train.random_batch(batch_size)
 
+            sents = encodings.batch(batch.abstracts) if encodings else None
+
             y, y_pred = train_batch(batch, sent_encoder, \
-                    graf_encoder, regressor)
+                    graf_encoder, regressor, sents)
 
             loss = loss_func(y_pred, y)
-            loss.backward()
 
-            optimizer.step()
+            with timers.stage('backward'):
+                loss.backward()
+
+            with timers.stage('allreduce'):
+                distributed.average_gradients(params)
+
+            with timers.stage('step'):
+                optimizer.step()
+
+            timers.count('steps')
+            timers.tick()
+
+            epoch_loss += loss.item()
+
+        epoch_loss, = distributed.reduce_sum(epoch_loss)
 
-            epoch_loss += loss.data[0]
+        if distributed.is_main():
 
-        checkpoint(model_path, 'sent_encoder', sent_encoder, epoch)
-        checkpoint(model_path, 'graf_encoder', graf_encoder, epoch)
-        checkpoint(model_path, 'regressor', regressor, epoch)
+            with timers.stage('checkpoint'):
+                checkpoints.save(epoch, epoch_loss / epoch_size)
 
-        print(epoch_loss / epoch_size)
+            print(epoch_loss / epoch_size)
+
+    checkpoints.close()
+
+    timers.flush()
 
 
 def regress_sents(ab, graf_encoder, regressor):
@@ -280,7 +375,7 @@ def regress_sents(ab, graf_encoder, regressor):
     for i in range(len(ab)):
 
         # Graf = sentence + context.
-        perm = torch.randperm(len(ab)).type(itype)
+        perm = device.longs(torch.randperm(len(ab)))
         graf = ab[perm]
 
         # Graf, sentence, size, position.
@@ -296,29 +391,24 @@ def regress_sents(ab, graf_encoder, regressor):
     x = list(map(torch.cat, x))
     x = torch.stack(x)
 
-    return regressor(x).data.tolist()
+    y = regressor(x)
+    timers.count('regressor_calls')
+
+    return y.data.tolist()
 
 
 def predict(test_path, sent_encoder_path, graf_encoder_path, regressor_path,
     gp_path, test_skim, map_source, map_target):
     """Predict order.
     """
-    test = Corpus(test_path, test_skim)
+    with timers.stage('corpus_load'):
+        test = Corpus(test_path, test_skim)
 
-    sent_encoder = torch.load(
-        sent_encoder_path,
-        map_location={map_source: map_target},
-    )
+    sent_encoder = load_model(sent_encoder_path, {map_source: map_target})
 
-    graf_encoder = torch.load(
-        graf_encoder_path,
-        map_location={map_source: map_target},
-    )
+    graf_encoder = load_model(graf_encoder_path, {map_source: map_target})
 
-    regressor = torch.load(
-        regressor_path,
-        map_location={map_source: map_target},
-    )
+    regressor = load_model(regressor_path, {map_source: map_target})
 
     gps = []
     for batch in tqdm(test.batches(100)):
@@ -326,9 +416,9 @@ def predict(test_path, sent_encoder_path, graf_encoder_path, regressor_path,
         batch.shuffle()
 
         # Encode sentence batch.
-        # TODO: DRY
-        sent_batch = batch.sentence_variables()
-        sent_batch = sent_encoder(sent_batch, 30)
+        sent_batch = encode_batch(batch, sent_encoder)
+
+        timers.count('sentences', len(sent_batch))
 
         # Re-group by abstract.
         unpacked = batch.unpack_sentences(sent_batch)
@@ -337,10 +427,10 @@ def predict(test_path, sent_encoder_path, graf_encoder_path, regressor_path,
 
             gold = [s.position for s in ab.sentences]
 
-            pred = regress_sents(sents, graf_encoder, regressor)
+            with timers.stage('search'):
+                pred = regress_sents(sents, graf_encoder, regressor)
             pred = np.argsort(pred).argsort().tolist()
 
             gps.append((gold, pred))
 
-    with open(gp_path, 'w') as fh:
-        ujson.dump(gps, fh)
+    write_gold_pred(gp_path, gps)
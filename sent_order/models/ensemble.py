@@ -0,0 +1,273 @@
+
+
+import numpy as np
+
+import torch
+import attr
+
+from tqdm import tqdm
+
+from sent_order.models import pairs, pick_next, context_regression
+from sent_order.utils import pad_and_stack, pack
+from sent_order.nbest import write_gold_pred, write_nbest
+from sent_order import device, timers
+from sent_order.checkpoints import load_model
+from sent_order.search import exhaustive_search, EXHAUSTIVE_SIZE
+
+
+def load_models(paths, map_source, map_target):
+    """Load a set of model files, or None if any path is missing.
+    """
+    if not all(paths):
+        return None
+
+    return [
+        load_model(path, {map_source: map_target})
+        for path in paths
+    ]
+
+
+@attr.s
+class Ensemble:
+
+    # (s_encoder, classifier)
+    pairs = attr.ib(default=None)
+
+    # (s_encoder, r_encoder, classifier)
+    pick_next = attr.ib(default=None)
+
+    # (sent_encoder, graf_encoder, regressor)
+    context = attr.ib(default=None)
+
+    weights = attr.ib(default=attr.Factory(dict))
+
+    def encode_batch(self, batch, size=50, context_size=30):
+        """Embed and pad the batch once, run each sentence encoder on it.
+
+        Returns: list of {model: encoded sentences} for each abstract.
+        """
+        sents = [
+            device.move(s.tensor())
+            for a in batch.abstracts
+            for s in a.sentences
+        ]
+
+        padded, sizes = pad_and_stack(sents, size)
+
+        encoded = {}
+
+        if self.pairs or self.pick_next:
+
+            x, reorder = pack(padded, sizes)
+
+            if self.pairs:
+                encoded['pairs'] = self.pairs[0](x, reorder)
+
+            if self.pick_next:
+                encoded['pick_next'] = self.pick_next[0](x, reorder)
+
+        # The context model was trained on shorter pads.
+        if self.context:
+
+            x, reorder = pack(
+                padded[:,:context_size],
+                [min(s, context_size) for s in sizes],
+            )
+
+            encoded['context'] = self.context[0].encode_packed(x, reorder)
+
+        unpacked = {
+            key: list(batch.unpack_sentences(sents))
+            for key, sents in encoded.items()
+        }
+
+        return [
+            {key: grafs[i] for key, grafs in unpacked.items()}
+            for i in range(len(batch.abstracts))
+        ]
+
+    def weight(self, key):
+        return self.weights.get(key, 1)
+
+    def precompute(self, encoded):
+        """Score pair matrix and regressed positions for an abstract.
+        """
+        pair_matrix, positions = None, None
+
+        if self.pairs:
+            pair_matrix = pairs.pair_scores(encoded['pairs'], self.pairs[1])
+
+        if self.context:
+            positions = np.array(context_regression.regress_sents(
+                encoded['context'], *self.context[1:]
+            )).reshape(-1)
+
+        return pair_matrix, positions
+
+    def exhaustive_order(self, encoded, nbest=1):
+        """Score all orderings, summing weighted model scores.
+        """
+        n = len(next(iter(encoded.values())))
+
+        pair_matrix, positions = self.precompute(encoded)
+
+        scorers = []
+
+        if self.pairs:
+            scorers.append((
+                self.weight('pairs'),
+                lambda perms: pair_matrix[perms[:,:-1], perms[:,1:]].sum(1),
+                16*n,
+            ))
+
+        if self.pick_next:
+            score_perms, perm_bytes = pick_next.perm_scorer(
+                encoded['pick_next'], *self.pick_next[1:]
+            )
+            scorers.append((self.weight('pick_next'), score_perms, perm_bytes))
+
+        if self.context:
+            ratios = np.arange(n) / max(n-1, 1)
+            scorers.append((
+                self.weight('context'),
+                lambda perms: -((positions[perms] - ratios)**2).sum(1),
+                16*n,
+            ))
+
+        def score_perms(perms):
+            return sum(w * score(perms) for w, score, _ in scorers)
+
+        perm_bytes = sum(b for _, _, b in scorers)
+
+        return exhaustive_search(n, score_perms, perm_bytes, nbest=nbest)
+
+    def beam_search(self, encoded, beam_size=100,
+        exhaustive_size=EXHAUSTIVE_SIZE, nbest=1):
+        """Beam search over the summed, weighted step scores.
+
+        Returns: [(path, score)], the top nbest, best first
+        """
+        n = len(next(iter(encoded.values())))
+
+        if n <= exhaustive_size:
+            return self.exhaustive_order(encoded, nbest)
+
+        pair_matrix, positions = self.precompute(encoded)
+
+        beam = [((), 0)]
+
+        for i in range(n):
+
+            # Get new path candidates.
+            new_beam = [
+                ((*path, r), score)
+                for path, score in beam
+                for r in range(n)
+                if r not in path
+            ]
+
+            timers.count('beam_expansions', len(new_beam))
+
+            paths = np.array([path for path, _ in new_beam])
+
+            scores = np.zeros(len(new_beam))
+
+            if self.pairs and i > 0:
+                scores += self.weight('pairs') * \
+                    pair_matrix[paths[:,-2], paths[:,-1]]
+
+            if self.pick_next:
+                scores += self.weight('pick_next') * pick_next.score_paths(
+                    encoded['pick_next'],
+                    [path for path, _ in new_beam],
+                    *self.pick_next[1:],
+                )
+
+            if self.context:
+                scores -= self.weight('context') * \
+                    (positions[paths[:,-1]] - i / (n-1))**2
+
+            # Update scores.
+            new_beam = [
+                (path, score + new_score)
+                for (path, score), new_score in zip(new_beam, scores)
+            ]
+
+            # Sort by score.
+            new_beam = sorted(new_beam, key=lambda x: x[1], reverse=True)
+
+            # Keep N highest scoring paths.
+            beam = new_beam[:beam_size]
+
+        return [(path, float(score)) for path, score in beam[:nbest]]
+
+
+def predict(test_path, gp_path, test_skim, pairs_s_encoder_path,
+    pairs_classifier_path, pick_s_encoder_path, pick_r_encoder_path,
+    pick_classifier_path, ctx_sent_encoder_path, ctx_graf_encoder_path,
+    ctx_regressor_path, pairs_weight, pick_weight, ctx_weight, beam_size,
+    nbest, nbest_path, map_source, map_target):
+    """Predict order with any combination of the three models.
+    """
+    # Load the corpus and word vectors once.
+    with timers.stage('corpus_load'):
+        test = pairs.Corpus(test_path, test_skim)
+
+    ensemble = Ensemble(
+
+        pairs=load_models([
+            pairs_s_encoder_path,
+            pairs_classifier_path,
+        ], map_source, map_target),
+
+        pick_next=load_models([
+            pick_s_encoder_path,
+            pick_r_encoder_path,
+            pick_classifier_path,
+        ], map_source, map_target),
+
+        context=load_models([
+            ctx_sent_encoder_path,
+            ctx_graf_encoder_path,
+            ctx_regressor_path,
+        ], map_source, map_target),
+
+        weights=dict(
+            pairs=pairs_weight,
+            pick_next=pick_weight,
+            context=ctx_weight,
+        ),
+
+    )
+
+    if not (ensemble.pairs or ensemble.pick_next or ensemble.context):
+        raise ValueError('No complete set of model paths.')
+
+    gps, nbests = [], []
+    for batch in tqdm(test.batches(100)):
+
+        batch.shuffle()
+
+        with timers.stage('encode'):
+            encoded = ensemble.encode_batch(batch)
+
+        for ab, sents in zip(batch.abstracts, encoded):
+
+            gold = [s.position for s in ab.sentences]
+
+            with timers.stage('search'):
+                paths = ensemble.beam_search(sents, beam_size, nbest=nbest)
+
+            nbests.append([
+                (np.argsort(path).tolist(), score)
+                for path, score in paths
+            ])
+
+            pred = np.argsort(paths[0][0]).tolist()
+
+            gps.append((gold, pred))
+
+    write_gold_pred(gp_path, gps)
+
+    if nbest_path:
+        write_nbest(nbest_path, [g for g, _ in gps], nbests)
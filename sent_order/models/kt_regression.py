@@ -21,32 +21,37 @@ from torch.autograd import Variable
 from torch.nn import functional as F
 
 from sent_order.vectors import LazyVectors
-from sent_order.cuda import ftype, itype
-from sent_order.utils import checkpoint, pad_and_pack
-from sent_order.perms import sample_perms_at_dist
+from sent_order import device, distributed, timers
+from sent_order.checkpoints import Checkpoints, hparams, load_model
+from sent_order.encoders import sentence_encoder
+from sent_order.encodings import Encodings
+from sent_order.nbest import write_gold_pred
+from sent_order.utils import pad_and_pack
+from sent_order.perms import sample_perms_at_dist_array
+from sent_order.search import exhaustive_search, EXHAUSTIVE_SIZE
 
 
 vectors = LazyVectors.read()
 
 
+def read_lines(path):
+    """Unparsed arXiv abstract JSON lines.
+    """
+    for path in glob(os.path.join(path, '*.json')):
+        with open(path) as fh:
+            yield from fh
+
+
 @attr.s
 class Sentence:
 
+    position = attr.ib()
     tokens = attr.ib()
 
     def variable(self):
-        """Stack word vectors.
+        """Stack word vectors, in the storage dtype.
         """
-        x = [
-            vectors[t] if t in vectors else np.zeros(vectors.dim)
-            for t in self.tokens
-        ]
-
-        x = np.array(x)
-        x = torch.from_numpy(x)
-        x = x.float()
-
-        return Variable(x).type(ftype)
+        return device.move(vectors.embed(self.tokens))
 
 
 @attr.s
@@ -58,9 +63,8 @@ class Paragraph:
     def read_arxiv(cls, path):
         """Wrap parsed arXiv abstracts as paragraphs.
         """
-        for path in glob(os.path.join(path, '*.json')):
-            for line in open(path):
-                yield cls.from_arxiv_json(line)
+        for line in read_lines(path):
+            yield cls.from_arxiv_json(line)
 
     @classmethod
     def from_arxiv_json(cls, line):
@@ -69,8 +73,8 @@ class Paragraph:
         json = ujson.loads(line.strip())
 
         return cls([
-            Sentence(s['token'])
-            for s in json['sentences']
+            Sentence(i, s['token'])
+            for i, s in enumerate(json['sentences'])
         ])
 
     def sentence_variables(self):
@@ -109,15 +113,25 @@ class Batch:
 
 class Corpus:
 
-    def __init__(self, path, skim=None):
+    def __init__(self, path, skim=None, shard=False):
         """Load grafs into memory.
+
+        Args:
+            shard (bool): Keep this rank's share of the skim, and only
+                parse those lines.
         """
-        reader = Paragraph.read_arxiv(path)
+        lines = read_lines(path)
 
         if skim:
-            reader = islice(reader, skim)
+            lines = islice(lines, skim)
 
-        self.grafs = list(tqdm(reader, total=skim))
+        if shard:
+            lines = distributed.shard(lines)
+
+        self.grafs = [
+            Paragraph.from_arxiv_json(line)
+            for line in tqdm(lines, total=None if shard else skim)
+        ]
 
     def random_batch(self, size):
         """Query random batch.
@@ -203,74 +217,374 @@ class Regressor(nn.Module):
         return y.squeeze()
 
 
-def train_batch(batch, sent_encoder, regressor):
+def encode_batch(batch, sent_encoder):
+    """Encode the batch's sentences.
+    """
+    with timers.stage('embed'):
+        sents = list(batch.sentence_variables())
+
+    with timers.stage('encode'):
+        return sent_encoder(sents)
+
+
+def train_batch(batch, sent_encoder, regressor, sents=None):
     """Train the batch.
+
+    Pass precomputed sentence encodings to skip the sentence encoder.
     """
     # Encode sentences.
-    sents = batch.sentence_variables()
-    sents = sent_encoder(sents)
+    if sents is None:
+        sents = encode_batch(batch, sent_encoder)
 
-    # Generate x / y pairs.
-    x, y = [], []
-    for ab in batch.unpack_sentences(sents):
+    timers.count('sentences', len(sents))
 
-        perms, kt = sample_perms_at_dist(len(ab), random.random())
+    with timers.stage('examples'):
 
-        for perm in perms:
+        # Perms for each graf, as indexes into the sentence batch.
+        idx, sizes, y = [], [], []
+
+        start = 0
+        for graf in batch.grafs:
 
-            perm = torch.LongTensor(perm).type(itype)
+            size = len(graf.sentences)
 
-            x.append(ab[perm])
-            y.append(kt)
+            perms, kts = sample_perms_at_dist_array(size, random.random())
 
-    y = Variable(torch.FloatTensor(y)).type(ftype)
+            idx.append((perms + start).ravel())
+            sizes += [size] * len(perms)
+            y.append(kts)
 
-    return regressor(x), y
+            start += size
+
+    # Gather all permuted grafs at once.
+    idx = device.longs(np.concatenate(idx))
+    x = torch.split(sents[idx], sizes)
+
+    y = device.floats(np.concatenate(y))
+
+    timers.count('examples', len(y))
+
+    with timers.stage('regressor'):
+        return regressor(x), y
 
 
 def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
-    batch_size, lstm_dim, lin_dim):
+    batch_size, lstm_dim, lin_dim, sent_encoder_path=None,
+    encodings_path=None, encoder='lstm', keep=5, resume=False,
+    overwrite=False):
     """Train model.
+
+    With sent_encoder_path, freeze a trained sentence encoder, encode the
+    corpus once, and train only the regressor.
     """
-    train = Corpus(train_path, train_skim)
+    # Each worker samples from its own shard.
+    with timers.stage('corpus_load'):
+        train = Corpus(train_path, train_skim, shard=True)
+
+    distributed.check_shard(len(train.grafs), batch_size)
+
+    encodings = None
+
+    if sent_encoder_path:
+
+        sent_encoder = load_model(sent_encoder_path)
+
+        lstm_dim = hparams(sent_encoder)['lstm_dim']
+
+        encodings = Encodings.load(
+            encodings_path or os.path.join(model_path, 'encodings.npy'),
+            train.grafs,
+            lambda grafs: encode_batch(Batch(grafs), sent_encoder),
+            sent_encoder_path, 2*lstm_dim,
+        )
+
+    else:
+        sent_encoder = sentence_encoder(encoder, SentenceEncoder, 300, lstm_dim)
 
-    sent_encoder = SentenceEncoder(300, lstm_dim)
     regressor = Regressor(2*lstm_dim, lin_dim)
 
-    params = (
-        list(sent_encoder.parameters()) +
-        list(regressor.parameters())
-    )
+    params = list(regressor.parameters())
+
+    if not encodings:
+        params += list(sent_encoder.parameters())
 
     optimizer = torch.optim.Adam(params, lr=lr)
 
     loss_func = nn.MSELoss()
 
-    if torch.cuda.is_available():
-        sent_encoder = sent_encoder.cuda()
-        regressor = regressor.cuda()
+    sent_encoder = device.move(sent_encoder)
+    regressor = device.move(regressor)
 
-    for epoch in range(epochs):
+    models = dict(
+        regressor=regressor,
+    )
 
-        print(f'\nEpoch {epoch}')
+    if not encodings:
+        models['sent_encoder'] = sent_encoder
+
+    checkpoints = Checkpoints(model_path, models, optimizer, keep, resume,
+        overwrite)
+
+    # Pick up after the latest checkpoint.
+    start = checkpoints.restore() if resume else 0
+
+    distributed.broadcast_params(params)
+
+    for epoch in range(start, epochs):
+
+        if distributed.is_main():
+            print(f'\nEpoch {epoch}')
 
         epoch_loss = 0
-        for _ in tqdm(range(epoch_size)):
+        steps = distributed.steps(epoch_size)
+
+        for _ in tqdm(steps, disable=not distributed.is_main()):
 
             optimizer.zero_grad()
 
             batch = train.random_batch(batch_size)
 
-            y_pred, y = train_batch(batch, sent_encoder, regressor)
+            sents = encodings.batch(batch.grafs) if encodings else None
+
+            y_pred, y = train_batch(batch, sent_encoder, regressor, sents)
 
             loss = loss_func(y_pred, y)
-            loss.backward()
 
-            optimizer.step()
+            with timers.stage('backward'):
+                loss.backward()
+
+            with timers.stage('allreduce'):
+                distributed.average_gradients(params)
+
+            with timers.stage('step'):
+                optimizer.step()
+
+            timers.count('steps')
+            timers.tick()
+
+            epoch_loss += loss.item()
+
+        epoch_loss, = distributed.reduce_sum(epoch_loss)
+
+        if distributed.is_main():
+
+            with timers.stage('checkpoint'):
+                checkpoints.save(epoch, epoch_loss / epoch_size)
+
+            print(epoch_loss / epoch_size)
+
+    checkpoints.close()
+
+    timers.flush()
+
+
+def score_perms(sents, perms, regressor):
+    """Score a population of orderings in a single packed regressor call.
+
+    Args:
+        sents (Variable): Encoded sentences, in input order.
+        perms (np.array): (k, n) candidate orderings.
+
+    Returns: np.array of predicted KT distances, lower is better.
+    """
+    perms = device.longs(np.array(perms))
+
+    x = list(sents[perms.view(-1)].view(len(perms), len(sents), -1))
+
+    timers.count('regressor_calls')
+    timers.count('perms_scored', len(perms))
+
+    return np.array(regressor(x).view(-1).data.tolist())
+
+
+def swap_neighbors(perm):
+    """All orderings one transposition away from a perm.
+    """
+    i, j = np.triu_indices(len(perm), 1)
+
+    neighbors = np.tile(perm, (len(i), 1))
+
+    rows = np.arange(len(i))
+    neighbors[rows, i] = perm[j]
+    neighbors[rows, j] = perm[i]
+
+    return neighbors
+
+
+def order_local_search(sents, regressor, restarts=5, max_iters=100):
+    """Steepest-descent over transpositions, from random starts.
+    """
+    n = len(sents)
+
+    best, best_score = np.arange(n), np.inf
+
+    for _ in range(restarts):
+
+        perm = np.random.permutation(n)
+        score = score_perms(sents, [perm], regressor)[0]
+
+        for _ in range(max_iters):
+
+            neighbors = swap_neighbors(perm)
+            scores = score_perms(sents, neighbors, regressor)
+
+            i = scores.argmin()
+
+            # Local minimum.
+            if scores[i] >= score:
+                break
+
+            perm, score = neighbors[i], scores[i]
+
+        if score < best_score:
+            best, best_score = perm, score
+
+    return best
+
+
+def order_crossover(p1, p2):
+    """Order crossover (OX) of two parent perms.
+    """
+    n = len(p1)
+
+    i, j = sorted(np.random.choice(n+1, 2, replace=False))
+
+    child = -np.ones(n, dtype=int)
+    child[i:j] = p1[i:j]
+
+    # Fill the rest in the order they appear in the other parent.
+    child[child < 0] = p2[~np.isin(p2, p1[i:j])]
+
+    return child
+
+
+def order_genetic(sents, regressor, pop_size=100, generations=50, elite=10,
+    mutation=0.2):
+    """Genetic search, scoring each generation in one regressor call.
+    """
+    n = len(sents)
+
+    pop = np.array([np.random.permutation(n) for _ in range(pop_size)])
+    scores = score_perms(sents, pop, regressor)
+
+    for _ in range(generations):
+
+        # Keep the fittest perms.
+        pop = pop[scores.argsort()]
+        parents = pop[:max(elite, 2)]
+
+        children = []
+        while len(children) < pop_size - elite:
+
+            i1, i2 = np.random.choice(len(parents), 2, replace=False)
+            child = order_crossover(parents[i1], parents[i2])
+
+            # Swap mutation.
+            if random.random() < mutation:
+                i, j = np.random.choice(n, 2, replace=False)
+                child[[i, j]] = child[[j, i]]
+
+            children.append(child)
+
+        pop = np.concatenate([pop[:elite], children])
+        scores = score_perms(sents, pop, regressor)
+
+    return pop[scores.argmin()]
+
+
+def order_random_walks(sents, regressor, walkers=50, steps=100):
+    """Parallel random walks; each walker takes a random swap if it helps.
+    """
+    n = len(sents)
+
+    pop = np.array([np.random.permutation(n) for _ in range(walkers)])
+    scores = score_perms(sents, pop, regressor)
+
+    rows = np.arange(walkers)
+
+    for _ in range(steps):
+
+        # Propose one random transposition per walker.
+        i = np.random.randint(n, size=walkers)
+        j = np.random.randint(n, size=walkers)
+
+        proposals = pop.copy()
+        proposals[rows, i] = pop[rows, j]
+        proposals[rows, j] = pop[rows, i]
+
+        new_scores = score_perms(sents, proposals, regressor)
+
+        # Accept improving moves.
+        better = new_scores < scores
+        pop[better] = proposals[better]
+        scores[better] = new_scores[better]
+
+    return pop[scores.argmin()]
+
+
+def exhaustive_order(sents, regressor):
+    """Score all orderings, take the lowest predicted KT distance.
+    """
+    def neg_score(perms):
+        return -score_perms(sents, perms, regressor)
+
+    # Inputs are padded to 30 sentences.
+    perm_bytes = 4 * 30 * sents.data.shape[1]
+
+    return exhaustive_search(len(sents), neg_score, perm_bytes)[0][0]
+
+
+DECODERS = {
+    'local': order_local_search,
+    'genetic': order_genetic,
+    'walks': order_random_walks,
+}
+
+
+def predict(test_path, sent_encoder_path, regressor_path, gp_path, test_skim,
+    decoder, map_source, map_target):
+    """Predict order.
+    """
+    with timers.stage('corpus_load'):
+        test = Corpus(test_path, test_skim)
+
+    sent_encoder = load_model(sent_encoder_path, {map_source: map_target})
+
+    regressor = load_model(regressor_path, {map_source: map_target})
+
+    search = DECODERS[decoder]
+
+    def decode(sents, regressor):
+        if len(sents) <= EXHAUSTIVE_SIZE:
+            return exhaustive_order(sents, regressor)
+        return search(sents, regressor)
+
+    gps = []
+    for batch in tqdm(test.batches(100)):
+
+        batch.shuffle()
+
+        # Encode sentence batch.
+        sents = encode_batch(batch, sent_encoder)
+
+        timers.count('sentences', len(sents))
+
+        # Re-group by paragraph.
+        unpacked = batch.unpack_sentences(sents)
+
+        for graf, sents in zip(batch.grafs, unpacked):
+
+            gold = [s.position for s in graf.sentences]
+
+            # Single sentence, nothing to order.
+            if len(sents) < 2:
+                gps.append((gold, gold))
+                continue
 
-            epoch_loss += loss.data[0]
+            with timers.stage('search'):
+                pred = decode(sents, regressor)
+            pred = np.argsort(pred).tolist()
 
-        checkpoint(model_path, 'sent_encoder', sent_encoder, epoch)
-        checkpoint(model_path, 'regressor', regressor, epoch)
+            gps.append((gold, pred))
 
-        print(epoch_loss / epoch_size)
+    write_gold_pred(gp_path, gps)
@@ -13,29 +13,39 @@ import math
 from tqdm import tqdm
 from itertools import islice
 from glob import glob
-from boltons.iterutils import pairwise, chunked_iter
+from boltons.iterutils import chunked_iter
 from scipy import stats
 
 from torch import nn
 from torch.nn.utils.rnn import pack_padded_sequence
-from torch.autograd import Variable
 from torch.nn import functional as F
 
-from sent_order.utils import checkpoint, pad_and_pack
+from sent_order.utils import pad_and_pack
+from sent_order.nbest import write_gold_pred, write_nbest
 from sent_order.vectors import LazyVectors
-from sent_order.cuda import ftype, itype
+from sent_order import device, distributed, timers
+from sent_order.checkpoints import Checkpoints, load_model
+from sent_order.encoders import sentence_encoder
+from sent_order.search import exhaustive_search, EXHAUSTIVE_SIZE
+from sent_order.long_docs import order_long
 
 
 vectors = LazyVectors.read()
 
 
-def read_abstracts(path):
-    """Parse abstract JSON lines.
+def read_lines(path):
+    """Unparsed abstract JSON lines.
     """
     for path in glob(os.path.join(path, '*.json')):
         with open(path) as fh:
-            for line in fh:
-                yield Abstract.from_line(line)
+            yield from fh
+
+
+def read_abstracts(path):
+    """Parse abstract JSON lines.
+    """
+    for line in read_lines(path):
+        yield Abstract.from_line(line)
 
 
 @attr.s
@@ -44,19 +54,10 @@ class Sentence:
     position = attr.ib()
     tokens = attr.ib()
 
-    def tensor(self, dim=300):
-        """Stack word vectors.
+    def tensor(self):
+        """Stack word vectors, in the storage dtype.
         """
-        x = [
-            vectors[t] if t in vectors else np.zeros(dim)
-            for t in self.tokens
-        ]
-
-        x = np.array(x)
-        x = torch.from_numpy(x)
-        x = x.float()
-
-        return x
+        return vectors.embed(self.tokens)
 
 
 @attr.s
@@ -84,11 +85,12 @@ class Batch:
     def packed_sentence_tensor(self, size=50):
         """Pack sentence tensors.
         """
-        sents = [
-            Variable(s.tensor()).type(ftype)
-            for a in self.abstracts
-            for s in a.sentences
-        ]
+        with timers.stage('embed'):
+            sents = [
+                device.move(s.tensor())
+                for a in self.abstracts
+                for s in a.sentences
+            ]
 
         return pad_and_pack(sents, size)
 
@@ -110,15 +112,25 @@ class Batch:
 
 class Corpus:
 
-    def __init__(self, path, skim=None):
+    def __init__(self, path, skim=None, shard=False):
         """Load abstracts into memory.
+
+        Args:
+            shard (bool): Keep this rank's share of the skim, and only
+                parse those lines.
         """
-        reader = read_abstracts(path)
+        lines = read_lines(path)
 
         if skim:
-            reader = islice(reader, skim)
+            lines = islice(lines, skim)
 
-        self.abstracts = list(tqdm(reader, total=skim))
+        if shard:
+            lines = distributed.shard(lines)
+
+        self.abstracts = [
+            Abstract.from_line(line)
+            for line in tqdm(lines, total=None if shard else skim)
+        ]
 
     def random_batch(self, size):
         """Query random batch.
@@ -173,32 +185,46 @@ def train_batch(batch, s_encoder, classifier):
     x, reorder = batch.packed_sentence_tensor()
 
     # Encode sentences.
-    sents = s_encoder(x, reorder)
+    with timers.stage('encode'):
+        sents = s_encoder(x, reorder)
+
+    timers.count('sentences', len(sents))
 
-    # Generate x / y pairs.
-    x, y = [], []
-    for ab in batch.unpack_sentences(sents):
-        for s1, s2 in pairwise(ab):
+    with timers.stage('examples'):
 
-            x.append(torch.cat([s1, s2]))
-            y.append(0)
+        sizes = np.array([len(ab.sentences) for ab in batch.abstracts])
 
-            x.append(torch.cat([s2, s1]))
-            y.append(1)
+        # Every sentence but the last in each abstract, and the next one.
+        s1 = np.setdiff1d(np.arange(sizes.sum()), np.cumsum(sizes)-1)
+        s2 = s1 + 1
 
-    x = torch.stack(x)
-    y = Variable(torch.LongTensor(y)).type(itype)
+        # Generate x / y pairs, in order / swapped, interleaved.
+        left = device.longs(np.stack([s1, s2], 1).ravel())
+        right = device.longs(np.stack([s2, s1], 1).ravel())
 
-    return classifier(x), y
+        x = torch.cat([sents[left], sents[right]], 1)
+
+        y = np.tile([0, 1], len(s1))
+        y = device.longs(y)
+
+    timers.count('examples', len(y))
+
+    with timers.stage('classifier'):
+        return classifier(x), y
 
 
 def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
-    batch_size, lstm_dim, lin_dim):
+    batch_size, lstm_dim, lin_dim, encoder='lstm', keep=5, resume=False,
+    overwrite=False):
     """Train model.
     """
-    train = Corpus(train_path, train_skim)
+    # Each worker samples from its own shard.
+    with timers.stage('corpus_load'):
+        train = Corpus(train_path, train_skim, shard=True)
+
+    distributed.check_shard(len(train.abstracts), batch_size)
 
-    s_encoder = Encoder(300, lstm_dim)
+    s_encoder = sentence_encoder(encoder, Encoder, 300, lstm_dim)
     classifier = Classifier(4*lstm_dim, lin_dim)
 
     params = (
@@ -210,17 +236,32 @@ def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
 
     loss_func = nn.NLLLoss()
 
-    if torch.cuda.is_available():
-        s_encoder = s_encoder.cuda()
-        classifier = classifier.cuda()
+    s_encoder = device.move(s_encoder)
+    classifier = device.move(classifier)
 
-    for epoch in range(epochs):
+    models = dict(
+        s_encoder=s_encoder,
+        classifier=classifier,
+    )
+
+    checkpoints = Checkpoints(model_path, models, optimizer, keep, resume,
+        overwrite)
+
+    # Pick up after the latest checkpoint.
+    start = checkpoints.restore() if resume else 0
+
+    distributed.broadcast_params(params)
+
+    for epoch in range(start, epochs):
 
-        print(f'\nEpoch {epoch}')
+        if distributed.is_main():
+            print(f'\nEpoch {epoch}')
 
         epoch_loss, c, t = 0, 0, 0
 
-        for _ in tqdm(range(epoch_size)):
+        steps = distributed.steps(epoch_size)
+
+        for _ in tqdm(steps, disable=not distributed.is_main()):
 
             optimizer.zero_grad()
 
@@ -229,11 +270,20 @@ def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
             y_pred, y = train_batch(batch, s_encoder, classifier)
 
             loss = loss_func(y_pred, y)
-            loss.backward()
 
-            optimizer.step()
+            with timers.stage('backward'):
+                loss.backward()
+
+            with timers.stage('allreduce'):
+                distributed.average_gradients(params)
+
+            with timers.stage('step'):
+                optimizer.step()
 
-            epoch_loss += loss.data[0]
+            timers.count('steps')
+            timers.tick()
+
+            epoch_loss += loss.item()
 
             # EVAL
 
@@ -245,16 +295,71 @@ def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
             c += matches.sum()
             t += len(matches)
 
-        checkpoint(model_path, 's_encoder', s_encoder, epoch)
-        checkpoint(model_path, 'classifier', classifier, epoch)
+        epoch_loss, c, t = distributed.reduce_sum(epoch_loss, c, t)
+
+        if distributed.is_main():
+
+            with timers.stage('checkpoint'):
+                checkpoints.save(epoch, epoch_loss / epoch_size)
+
+            print(epoch_loss / epoch_size)
+            print(c / t)
+
+    checkpoints.close()
+
+    timers.flush()
+
+
+def pair_scores(ab, classifier):
+    """Score every ordered pair of sentences in one classifier call.
+
+    Returns: (n, n) array, log-prob that sentence i directly precedes j.
+    """
+    n = len(ab)
+
+    i, j = np.divmod(np.arange(n*n), n)
 
-        print(epoch_loss / epoch_size)
-        print(c / t)
+    i = device.longs(i)
+    j = device.longs(j)
 
+    x = device.floats(torch.cat([ab[i], ab[j]], 1))
 
-def beam_search(ab, classifier, beam_size=100):
+    y = classifier(x).view(n*n, 2)
+    timers.count('classifier_calls')
+
+    return np.array(y[:,0].data.tolist()).reshape(n, n)
+
+
+def perm_scorer(ab, classifier):
+    """Build a scorer for full orderings from the pair score matrix.
+
+    Returns: score function, approximate bytes per perm
+    """
+    scores = pair_scores(ab, classifier)
+
+    def score_perms(perms):
+        return scores[perms[:,:-1], perms[:,1:]].sum(1)
+
+    return score_perms, 16*len(ab)
+
+
+def exhaustive_order(ab, classifier, nbest=1):
+    """Score all orderings against the pair score matrix.
+    """
+    score_perms, perm_bytes = perm_scorer(ab, classifier)
+
+    return exhaustive_search(len(ab), score_perms, perm_bytes, nbest=nbest)
+
+
+def beam_search(ab, classifier, beam_size=100,
+    exhaustive_size=EXHAUSTIVE_SIZE, nbest=1):
     """Beam search.
+
+    Returns: [(path, score)], the top nbest, best first
     """
+    if len(ab) <= exhaustive_size:
+        return exhaustive_order(ab, classifier, nbest)
+
     beam = [((i,), 0) for i in range(len(ab))]
 
     for _ in range(len(ab)-1):
@@ -267,15 +372,19 @@ def beam_search(ab, classifier, beam_size=100):
                 if i not in path:
                     new_beam.append(((*path, i), score))
 
+        timers.count('beam_expansions', len(new_beam))
+
         # Get input tensors from final two sents.
         x = torch.stack([
             torch.cat([ab[p[-2]], ab[p[-1]]])
             for p, _ in new_beam
         ])
 
-        x = x.type(ftype)
+        x = device.floats(x)
 
-        y = classifier(x)
+        # Keep rows when there's a single candidate.
+        y = classifier(x).view(len(new_beam), 2)
+        timers.count('classifier_calls')
 
         # Update scores.
         new_beam = [
@@ -289,33 +398,60 @@ def beam_search(ab, classifier, beam_size=100):
         # Keep N highest scoring paths.
         beam = new_beam[:beam_size]
 
-    return beam[0][0]
+    return [(path, float(score)) for path, score in beam[:nbest]]
+
+
+def long_search(ab, classifier, **kwargs):
+    """Order a long document with chunked search and local refinement.
+
+    Returns: [(path, score)], 1-best only
+    """
+    def score_pairs(i, j):
+
+        i = device.longs(i)
+        j = device.longs(j)
+
+        x = device.floats(torch.cat([ab[i], ab[j]], 1))
+
+        y = classifier(x).view(len(i), 2)
+        timers.count('classifier_calls')
+
+        return np.array(y[:,0].data.tolist())
+
+    path = order_long(np.array(ab.data.tolist()), score_pairs, **kwargs)
+
+    score = score_pairs(path[:-1], path[1:]).sum()
+
+    return [(tuple(path), float(score))]
 
 
 def predict(test_path, s_encoder_path, classifier_path, gp_path, test_skim,
-    map_source, map_target):
+    nbest, nbest_path, long_size, map_source, map_target):
     """Predict order.
     """
-    test = Corpus(test_path, test_skim)
+    # Long-document search finds a single order.
+    if long_size and nbest > 1:
+        raise ValueError('--long_size only supports 1-best output.')
 
-    s_encoder = torch.load(
-        s_encoder_path,
-        map_location={map_source: map_target},
-    )
+    with timers.stage('corpus_load'):
+        test = Corpus(test_path, test_skim)
 
-    classifier = torch.load(
-        classifier_path,
-        map_location={map_source: map_target},
-    )
+    s_encoder = load_model(s_encoder_path, {map_source: map_target})
+
+    classifier = load_model(classifier_path, {map_source: map_target})
 
-    gps = []
+    gps, nbests = [], []
     for i, batch in enumerate(tqdm(test.batches(100))):
 
         batch.shuffle()
 
         # Encode sentence batch.
         sent_batch, reorder = batch.packed_sentence_tensor()
-        sent_batch = s_encoder(sent_batch, reorder)
+
+        with timers.stage('encode'):
+            sent_batch = s_encoder(sent_batch, reorder)
+
+        timers.count('sentences', len(sent_batch))
 
         # Re-group by abstract.
         unpacked = batch.unpack_sentences(sent_batch)
@@ -324,15 +460,29 @@ def predict(test_path, s_encoder_path, classifier_path, gp_path, test_skim,
 
             gold = [s.position for s in ab.sentences]
 
-            pred = beam_search(sents, classifier)
+            with timers.stage('search'):
+
+                if long_size and len(sents) > long_size:
+                    paths = long_search(sents, classifier)
+
+                else:
+                    paths = beam_search(sents, classifier, nbest=nbest)
+
+            nbests.append([
+                (np.argsort(path).tolist(), score)
+                for path, score in paths
+            ])
+
+            pred = paths[0][0]
             pred = np.argsort(pred).tolist()
 
             gps.append((gold, pred))
 
         # TODO|dev
         if i % 100 == 0:
-            with open(gp_path, 'w') as fh:
-                ujson.dump(gps, fh)
+            write_gold_pred(gp_path, gps)
+
+    write_gold_pred(gp_path, gps)
 
-    with open(gp_path, 'w') as fh:
-        ujson.dump(gps, fh)
+    if nbest_path:
+        write_nbest(nbest_path, [g for g, _ in gps], nbests)
@@ -18,24 +18,34 @@ from scipy import stats
 
 from torch import nn
 from torch.nn.utils.rnn import pack_padded_sequence
-from torch.autograd import Variable
 from torch.nn import functional as F
 
-from sent_order.utils import checkpoint, pad_and_pack
+from sent_order.utils import pad_and_pack, pack, shuffled_spans
+from sent_order.nbest import write_gold_pred, write_nbest
 from sent_order.vectors import LazyVectors
-from sent_order.cuda import ftype, itype
+from sent_order import device, distributed, timers
+from sent_order.checkpoints import Checkpoints, hparams, load_model
+from sent_order.encoders import sentence_encoder
+from sent_order.encodings import Encodings
+from sent_order.search import exhaustive_search, EXHAUSTIVE_SIZE
 
 
 vectors = LazyVectors.read()
 
 
-def read_abstracts(path):
-    """Parse abstract JSON lines.
+def read_lines(path):
+    """Unparsed abstract JSON lines.
     """
     for path in glob(os.path.join(path, '*.json')):
         with open(path) as fh:
-            for line in fh:
-                yield Abstract.from_line(line)
+            yield from fh
+
+
+def read_abstracts(path):
+    """Parse abstract JSON lines.
+    """
+    for line in read_lines(path):
+        yield Abstract.from_line(line)
 
 
 @attr.s
@@ -44,19 +54,10 @@ class Sentence:
     position = attr.ib()
     tokens = attr.ib()
 
-    def tensor(self, dim=300):
-        """Stack word vectors.
+    def tensor(self):
+        """Stack word vectors, in the storage dtype.
         """
-        x = [
-            vectors[t] if t in vectors else np.zeros(dim)
-            for t in self.tokens
-        ]
-
-        x = np.array(x)
-        x = torch.from_numpy(x)
-        x = x.float()
-
-        return x
+        return vectors.embed(self.tokens)
 
 
 @attr.s
@@ -84,11 +85,12 @@ class Batch:
     def packed_sentence_tensor(self, size=50):
         """Pack sentence tensors.
         """
-        sents = [
-            Variable(s.tensor()).type(ftype)
-            for a in self.abstracts
-            for s in a.sentences
-        ]
+        with timers.stage('embed'):
+            sents = [
+                device.move(s.tensor())
+                for a in self.abstracts
+                for s in a.sentences
+            ]
 
         return pad_and_pack(sents, size)
 
@@ -110,15 +112,25 @@ class Batch:
 
 class Corpus:
 
-    def __init__(self, path, skim=None):
+    def __init__(self, path, skim=None, shard=False):
         """Load abstracts into memory.
+
+        Args:
+            shard (bool): Keep this rank's share of the skim, and only
+                parse those lines.
         """
-        reader = read_abstracts(path)
+        lines = read_lines(path)
 
         if skim:
-            reader = islice(reader, skim)
+            lines = islice(lines, skim)
 
-        self.abstracts = list(tqdm(reader, total=skim))
+        if shard:
+            lines = distributed.shard(lines)
+
+        self.abstracts = [
+            Abstract.from_line(line)
+            for line in tqdm(lines, total=None if shard else skim)
+        ]
 
     def random_batch(self, size):
         """Query random batch.
@@ -167,109 +179,227 @@ class Classifier(nn.Module):
         return y.squeeze()
 
 
-def train_batch(batch, s_encoder, r_encoder, classifier):
-    """Train the batch.
+def example_indexes(sizes, right_size=30):
+    """Index arrays for every (candidate, context, right) training example.
+
+    Args:
+        sizes (list of int): Sentence count for each abstract.
+        right_size (int): Max length of the shuffled right context.
+
+    Returns: dict of index / value arrays, pointing into the flat sentence
+    batch, where index sum(sizes) is a zero row.
+    """
+    sizes = np.array(sizes)
+    zero = sizes.sum()
+
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    # One context per abstract, per position but the last.
+    steps = np.maximum(sizes-1, 0)
+    ab = np.repeat(np.arange(len(sizes)), steps)
+    i = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+
+    n = sizes[ab]
+    start = starts[ab]
+
+    # Right context size.
+    r = n - i
+
+    # Previous 2 sentences, or the zero row.
+    minus1 = np.where(i > 0, start+i-1, zero)
+    minus2 = np.where(i > 1, start+i-2, zero)
+
+    # The correct next sentence, and a random later one.
+    first = start + i
+    other = start + i + 1 + (np.random.rand(len(i)) * (r-1)).astype(int)
+
+    # Shuffled right contexts.
+    right, right_sizes = shuffled_spans(start+i, r, right_size, zero)
+
+    return dict(
+        first=first,
+        other=other,
+        minus1=minus1,
+        minus2=minus2,
+        index=i,
+        ratio=i / (n-1),
+        right=right,
+        right_sizes=right_sizes,
+    )
+
+
+def encode_batch(batch, s_encoder):
+    """Encode the batch's sentences.
     """
     x, reorder = batch.packed_sentence_tensor()
 
-    # Encode sentences.
-    sents = s_encoder(x, reorder)
+    with timers.stage('encode'):
+        return s_encoder(x, reorder)
 
-    # Generate x / y pairs.
-    examples = []
-    for ab in batch.unpack_sentences(sents):
-        for i in range(len(ab)-1):
 
-            right = ab[i:]
+def train_batch(batch, s_encoder, r_encoder, classifier, sents=None,
+    idx=None):
+    """Train the batch.
 
-            zeros = Variable(torch.zeros(ab.data.shape[1])).type(ftype)
+    Pass precomputed sentence encodings to skip the sentence encoder, and
+    example indexes to reuse sampled examples.
+    """
+    # Encode sentences.
+    if sents is None:
+        sents = encode_batch(batch, s_encoder)
 
-            # Previous 2 sentences.
-            minus1 = ab[i-1] if i > 0 else zeros
-            minus2 = ab[i-2] if i > 1 else zeros
+    timers.count('sentences', len(sents))
 
-            # Shuffle right.
-            perm = torch.randperm(len(right)).type(itype)
-            shuffled_right = right[perm]
+    # Add a zero row, for missing previous sentences and right padding.
+    zeros = device.floats(torch.zeros(1, sents.data.shape[1]))
+    sents = torch.cat([sents, zeros])
 
-            # Raw position index, 0 <-> 1 ratio.
-            index = Variable(torch.Tensor([i])).type(ftype)
-            ratio = Variable(torch.Tensor([i / (len(ab)-1)])).type(ftype)
+    if idx is None:
+        with timers.stage('examples'):
+            idx = example_indexes([
+                len(ab.sentences) for ab in batch.abstracts
+            ])
 
-            context = torch.cat([minus1, minus2, index, ratio])
+    def gather(x, idx):
+        return x[device.longs(idx)]
 
-            first = right[0]
-            other = random.choice(right[1:])
+    def column(values):
+        return device.floats(values).view(-1, 1)
 
-            # Candidate + [n-1, n-2, 0-1]
-            first = torch.cat([first, context])
-            other = torch.cat([other, context])
+    # Encode shuffled rights, once per context.
+    rights = gather(sents, idx['right'].ravel())
+    rights = rights.view(*idx['right'].shape, -1)
+    rights, reorder = pack(rights, idx['right_sizes'].tolist())
 
-            # First / not-first.
-            examples.append((first, shuffled_right, 0))
-            examples.append((other, shuffled_right, 1))
+    with timers.stage('right_encode'):
+        rights = r_encoder(rights, reorder)
 
-    sents, rights, ys = zip(*examples)
+    # [n-1, n-2, index, 0-1, right]
+    context = torch.cat([
+        gather(sents, idx['minus1']),
+        gather(sents, idx['minus2']),
+        column(idx['index']),
+        column(idx['ratio']),
+        rights,
+    ], 1)
 
-    # Encode rights.
-    rights, reorder = pad_and_pack(rights, 30)
-    rights = r_encoder(rights, reorder)
+    # First / not-first, interleaved.
+    cands = np.stack([idx['first'], idx['other']], 1).ravel()
+    contexts = np.repeat(np.arange(len(idx['first'])), 2)
 
-    # <sent, right>
-    x = zip(sents, rights)
-    x = list(map(torch.cat, x))
-    x = torch.stack(x)
+    x = torch.cat([gather(sents, cands), gather(context, contexts)], 1)
 
-    y = Variable(torch.LongTensor(ys)).type(itype)
+    y = np.tile([0, 1], len(idx['first']))
+    y = device.longs(y)
 
-    return classifier(x), y
+    timers.count('examples', len(y))
+
+    with timers.stage('classifier'):
+        return classifier(x), y
 
 
 def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
-    batch_size, lstm_dim, lin_dim):
+    batch_size, lstm_dim, lin_dim, s_encoder_path=None, encodings_path=None,
+    encoder='lstm', keep=5, resume=False, overwrite=False):
     """Train model.
+
+    With s_encoder_path, freeze a trained sentence encoder, encode the corpus
+    once, and train only the right encoder and classifier.
     """
-    train = Corpus(train_path, train_skim)
+    # Each worker samples from its own shard.
+    with timers.stage('corpus_load'):
+        train = Corpus(train_path, train_skim, shard=True)
+
+    distributed.check_shard(len(train.abstracts), batch_size)
+
+    encodings = None
+
+    if s_encoder_path:
+
+        s_encoder = load_model(s_encoder_path)
+
+        lstm_dim = hparams(s_encoder)['lstm_dim']
+
+        encodings = Encodings.load(
+            encodings_path or os.path.join(model_path, 'encodings.npy'),
+            train.abstracts,
+            lambda abstracts: encode_batch(Batch(abstracts), s_encoder),
+            s_encoder_path, 2*lstm_dim,
+        )
+
+    else:
+        s_encoder = sentence_encoder(encoder, Encoder, 300, lstm_dim)
 
-    s_encoder = Encoder(300, lstm_dim)
     r_encoder = Encoder(2*lstm_dim, lstm_dim)
     classifier = Classifier(8*lstm_dim+2, lin_dim)
 
     params = (
-        list(s_encoder.parameters()) +
         list(r_encoder.parameters()) +
         list(classifier.parameters())
     )
 
+    if not encodings:
+        params += list(s_encoder.parameters())
+
     optimizer = torch.optim.Adam(params, lr=lr)
 
     loss_func = nn.NLLLoss()
 
-    if torch.cuda.is_available():
-        s_encoder = s_encoder.cuda()
-        r_encoder = r_encoder.cuda()
-        classifier = classifier.cuda()
+    s_encoder = device.move(s_encoder)
+    r_encoder = device.move(r_encoder)
+    classifier = device.move(classifier)
 
-    for epoch in range(epochs):
+    models = dict(
+        r_encoder=r_encoder,
+        classifier=classifier,
+    )
 
-        print(f'\nEpoch {epoch}')
+    if not encodings:
+        models['s_encoder'] = s_encoder
+
+    checkpoints = Checkpoints(model_path, models, optimizer, keep, resume,
+        overwrite)
+
+    # Pick up after the latest checkpoint.
+    start = checkpoints.restore() if resume else 0
+
+    distributed.broadcast_params(params)
+
+    for epoch in range(start, epochs):
+
+        if distributed.is_main():
+            print(f'\nEpoch {epoch}')
 
         epoch_loss, c, t = 0, 0, 0
 
-        for _ in tqdm(range(epoch_size)):
+        steps = distributed.steps(epoch_size)
+
+        for _ in tqdm(steps, disable=not distributed.is_main()):
 
             optimizer.zero_grad()
 
             batch = train.random_batch(batch_size)
 
-            y_pred, y = train_batch(batch, s_encoder, r_encoder, classifier)
+            sents = encodings.batch(batch.abstracts) if encodings else None
+
+            y_pred, y = train_batch(batch, s_encoder, r_encoder, classifier,
+                sents)
 
             loss = loss_func(y_pred, y)
-            loss.backward()
 
-            optimizer.step()
+            with timers.stage('backward'):
+                loss.backward()
+
+            with timers.stage('allreduce'):
+                distributed.average_gradients(params)
+
+            with timers.stage('step'):
+                optimizer.step()
 
-            epoch_loss += loss.data[0]
+            timers.count('steps')
+            timers.tick()
+
+            epoch_loss += loss.item()
 
             # EVAL
 
@@ -281,12 +411,19 @@ def train(train_path, model_path, train_skim, lr, epochs, epoch_size,
             c += matches.sum()
             t += len(matches)
 
-        checkpoint(model_path, 's_encoder', s_encoder, epoch)
-        checkpoint(model_path, 'r_encoder', r_encoder, epoch)
-        checkpoint(model_path, 'classifier', classifier, epoch)
+        epoch_loss, c, t = distributed.reduce_sum(epoch_loss, c, t)
+
+        if distributed.is_main():
+
+            with timers.stage('checkpoint'):
+                checkpoints.save(epoch, epoch_loss / epoch_size)
 
-        print(epoch_loss / epoch_size)
-        print(c / t)
+            print(epoch_loss / epoch_size)
+            print(c / t)
+
+    checkpoints.close()
+
+    timers.flush()
 
 
 def order_greedy(ab, r_encoder, classifier):
@@ -304,17 +441,17 @@ def order_greedy(ab, r_encoder, classifier):
         ]
 
         # Right context.
-        right = ab[torch.LongTensor(right_idx).type(itype)]
+        right = ab[device.longs(right_idx)]
 
-        zeros = Variable(torch.zeros(ab.data.shape[1])).type(ftype)
+        zeros = device.floats(torch.zeros(ab.data.shape[1]))
 
         # Previous 2 sentences.
         minus1 = ab[i-1] if i > 0 else zeros
         minus2 = ab[i-2] if i > 1 else zeros
 
         # Raw position index, 0 <-> 1 ratio.
-        index = Variable(torch.Tensor([i])).type(ftype)
-        ratio = Variable(torch.Tensor([i / (len(ab)-1)])).type(ftype)
+        index = device.floats([i])
+        ratio = device.floats([i / (len(ab)-1)])
 
         # Encoded right context.
         right_enc, reorder = pad_and_pack([right], 30)
@@ -329,6 +466,8 @@ def order_greedy(ab, r_encoder, classifier):
         ])
 
         preds = classifier(x).view(len(x), 2)
+        timers.count('classifier_calls')
+
         preds = np.array(preds.data.tolist())
 
         pred = right_idx.pop(np.argmax(preds[:,0]))
@@ -337,53 +476,165 @@ def order_greedy(ab, r_encoder, classifier):
     return order
 
 
-def order_beam_search(ab, r_encoder, classifier, beam_size=100):
-    """Beam search.
+def perm_scorer(ab, r_encoder, classifier):
+    """Build a scorer for full orderings, summing the score at each step.
+
+    Returns: score function, approximate bytes per perm
     """
-    beam = [((), 0)]
+    n = len(ab)
 
-    for i in range(len(ab)):
+    # Encode the right context for every non-empty subset, in one call.
+    masks = np.arange(1, 2**n)
+    rights = [
+        ab[device.longs(np.flatnonzero(m >> np.arange(n) & 1))]
+        for m in masks
+    ]
 
-        new_beam, x = [], []
+    rights, reorder = pad_and_pack(rights, 30)
+    rights = r_encoder(rights, reorder)
 
-        for order, score in beam:
+    # Zero row for missing previous sentences.
+    zeros = device.floats(torch.zeros(1, ab.data.shape[1]))
+    abz = torch.cat([ab, zeros])
 
-            right_idx = [
-                j for j in range(len(ab))
-                if j not in order
-            ]
+    steps = np.arange(n)
+
+    # Raw position index, 0 <-> 1 ratio.
+    index = device.floats(steps).view(-1, 1)
+    ratio = device.floats(steps / max(n-1, 1)).view(-1, 1)
+
+    def gather(x, idx):
+        return x[device.longs(idx.flatten())]
+
+    def score_perms(perms):
+
+        k = len(perms)
 
-            # Right context.
-            right = ab[torch.LongTensor(right_idx).type(itype)]
+        # Previous 2 sentences, or the zero row.
+        minus1 = np.full((k, n), n)
+        minus1[:,1:] = perms[:,:-1]
 
-            zeros = Variable(torch.zeros(ab.data.shape[1])).type(ftype)
+        minus2 = np.full((k, n), n)
+        minus2[:,2:] = perms[:,:-2]
 
-            # Previous 2 sentences.
-            minus1 = ab[order[-1]] if i > 0 else zeros
-            minus2 = ab[order[-2]] if i > 1 else zeros
+        # Bitmask of the sentences left at each step.
+        right = np.cumsum((1 << perms)[:,::-1], 1)[:,::-1] - 1
 
-            # Raw position index, 0 <-> 1 ratio.
-            index = Variable(torch.Tensor([i])).type(ftype)
-            ratio = Variable(torch.Tensor([i / (len(ab)-1)])).type(ftype)
+        x = torch.cat([
+            gather(abz, perms),
+            gather(abz, minus1),
+            gather(abz, minus2),
+            index.repeat(k, 1),
+            ratio.repeat(k, 1),
+            gather(rights, right),
+        ], 1)
 
-            # Encoded right context.
-            right_enc, reorder = pad_and_pack([right], 30)
-            right_enc = r_encoder(right_enc, reorder)
+        y = classifier(x).view(k*n, 2)
+        timers.count('classifier_calls')
 
-            context = torch.cat([minus1, minus2, index, ratio, right_enc[0]])
+        return np.array(y[:,0].data.tolist()).reshape(k, n).sum(1)
+
+    return score_perms, 4 * n * (4*ab.data.shape[1]+2)
+
+
+def exhaustive_order(ab, r_encoder, classifier, nbest=1):
+    """Score all orderings, summing the classifier score at each step.
+    """
+    score_perms, perm_bytes = perm_scorer(ab, r_encoder, classifier)
+
+    return exhaustive_search(len(ab), score_perms, perm_bytes, nbest=nbest)
+
+
+def score_paths(ab, paths, r_encoder, classifier):
+    """Score the last sentence in each of a set of same-length paths.
+
+    Right contexts are encoded once per distinct prefix, in one call.
+
+    Returns: np.array of step scores.
+    """
+    n = len(ab)
+    i = len(paths[0]) - 1
+
+    prefixes = {}
+    for path in paths:
+        prefixes.setdefault(path[:-1], len(prefixes))
+
+    # Right context for each prefix.
+    rights = [
+        ab[device.longs([
+            j for j in range(n)
+            if j not in prefix
+        ])]
+        for prefix in prefixes
+    ]
+
+    rights, reorder = pad_and_pack(rights, 30)
+    rights = r_encoder(rights, reorder)
 
-            for r in right_idx:
-                new_beam.append(((*order, r), score))
-                x.append(torch.cat([ab[r], context]))
+    # Zero row for missing previous sentences.
+    zeros = device.floats(torch.zeros(1, ab.data.shape[1]))
+    abz = torch.cat([ab, zeros])
 
-        x = torch.stack(x)
+    def gather(x, idx):
+        return x[device.longs(idx)]
 
-        y = classifier(x)
+    # Previous 2 sentences.
+    minus1 = [p[-2] if i > 0 else n for p in paths]
+    minus2 = [p[-3] if i > 1 else n for p in paths]
+
+    # Raw position index, 0 <-> 1 ratio.
+    index = device.floats([i])
+    ratio = device.floats([i / max(n-1, 1)])
+
+    x = torch.cat([
+        gather(abz, [p[-1] for p in paths]),
+        gather(abz, minus1),
+        gather(abz, minus2),
+        index.repeat(len(paths)).view(-1, 1),
+        ratio.repeat(len(paths)).view(-1, 1),
+        gather(rights, [prefixes[p[:-1]] for p in paths]),
+    ], 1)
+
+    y = classifier(x).view(len(paths), 2)
+    timers.count('classifier_calls')
+
+    return np.array(y[:,0].data.tolist())
+
+
+def order_beam_search(ab, r_encoder, classifier, beam_size=100,
+    exhaustive_size=EXHAUSTIVE_SIZE, nbest=1):
+    """Beam search.
+
+    Returns: [(path, score)], the top nbest, best first
+    """
+    if len(ab) <= exhaustive_size:
+        return exhaustive_order(ab, r_encoder, classifier, nbest)
+
+    beam = [((), 0)]
+
+    for _ in range(len(ab)):
+
+        # Get new path candidates.
+        new_beam = [
+            ((*path, r), score)
+            for path, score in beam
+            for r in range(len(ab))
+            if r not in path
+        ]
+
+        timers.count('beam_expansions', len(new_beam))
+
+        scores = score_paths(
+            ab,
+            [path for path, _ in new_beam],
+            r_encoder,
+            classifier,
+        )
 
         # Update scores.
         new_beam = [
-            (path, score + new_score.data[0])
-            for (path, score), new_score in zip(new_beam, y)
+            (path, score + new_score)
+            for (path, score), new_score in zip(new_beam, scores)
         ]
 
         # Sort by score.
@@ -392,38 +643,34 @@ def order_beam_search(ab, r_encoder, classifier, beam_size=100):
         # Keep N highest scoring paths.
         beam = new_beam[:beam_size]
 
-    return beam[0][0]
+    return [(path, float(score)) for path, score in beam[:nbest]]
 
 
 def predict(test_path, s_encoder_path, r_encoder_path, classifier_path,
-    gp_path, test_skim, map_source, map_target):
+    gp_path, test_skim, nbest, nbest_path, map_source, map_target):
     """Predict order.
     """
-    test = Corpus(test_path, test_skim)
+    with timers.stage('corpus_load'):
+        test = Corpus(test_path, test_skim)
 
-    s_encoder = torch.load(
-        s_encoder_path,
-        map_location={map_source: map_target},
-    )
+    s_encoder = load_model(s_encoder_path, {map_source: map_target})
 
-    r_encoder = torch.load(
-        r_encoder_path,
-        map_location={map_source: map_target},
-    )
+    r_encoder = load_model(r_encoder_path, {map_source: map_target})
 
-    classifier = torch.load(
-        classifier_path,
-        map_location={map_source: map_target},
-    )
+    classifier = load_model(classifier_path, {map_source: map_target})
 
-    gps = []
+    gps, nbests = [], []
     for i, batch in enumerate(tqdm(test.batches(10))):
 
         batch.shuffle()
 
         # Encode sentence batch.
         sent_batch, reorder = batch.packed_sentence_tensor()
-        sent_batch = s_encoder(sent_batch, reorder)
+
+        with timers.stage('encode'):
+            sent_batch = s_encoder(sent_batch, reorder)
+
+        timers.count('sentences', len(sent_batch))
 
         # Re-group by abstract.
         unpacked = batch.unpack_sentences(sent_batch)
@@ -433,7 +680,16 @@ def predict(test_path, s_encoder_path, r_encoder_path, classifier_path,
             gold = [s.position for s in ab.sentences]
 
             # Predict.
-            pred = order_beam_search(sents, r_encoder, classifier)
+            with timers.stage('search'):
+                paths = order_beam_search(sents, r_encoder, classifier,
+                    nbest=nbest)
+
+            nbests.append([
+                (np.argsort(path).tolist(), score)
+                for path, score in paths
+            ])
+
+            pred = paths[0][0]
             pred = np.argsort(pred).tolist()
 
             print(pred, gold)
@@ -442,8 +698,9 @@ def predict(test_path, s_encoder_path, r_encoder_path, classifier_path,
 
         # TODO|dev
         if i % 100 == 0:
-            with open(gp_path, 'w') as fh:
-                ujson.dump(gps, fh)
+            write_gold_pred(gp_path, gps)
+
+    write_gold_pred(gp_path, gps)
 
-    with open(gp_path, 'w') as fh:
-        ujson.dump(gps, fh)
+    if nbest_path:
+        write_nbest(nbest_path, [g for g, _ in gps], nbests)
@@ -0,0 +1,98 @@
+
+
+import numpy as np
+
+import ujson
+import zipfile
+
+
+def write_gold_pred(path, gps):
+    """Write (gold, pred) pairs as JSON lines, for streaming metrics.
+    """
+    with open(path, 'w') as fh:
+        for gold, pred in gps:
+            fh.write(ujson.dumps([gold, pred]) + '\n')
+
+
+def write_nbest(path, golds, nbests):
+    """Write n-best predictions as flat arrays.
+
+    Args:
+        golds (list): Gold positions for each abstract.
+        nbests (list): (pred, score) pairs for each abstract.
+    """
+    np.savez_compressed(
+        path,
+        sizes=np.array([len(g) for g in golds], dtype=np.int32),
+        counts=np.array([len(nb) for nb in nbests], dtype=np.int32),
+        gold=np.array([i for g in golds for i in g], dtype=np.int16),
+        preds=np.array([
+            i for nb in nbests for pred, _ in nb for i in pred
+        ], dtype=np.int16),
+        scores=np.array([
+            score for nb in nbests for _, score in nb
+        ], dtype=np.float32),
+    )
+
+
+class ArrayStream:
+
+    """Sequential reads from one array in an .npz, without loading it.
+    """
+
+    def __init__(self, zf, name):
+        self.fh = zf.open(f'{name}.npy')
+
+        version = np.lib.format.read_magic(self.fh)
+
+        read_header = {
+            (1, 0): np.lib.format.read_array_header_1_0,
+            (2, 0): np.lib.format.read_array_header_2_0,
+        }[version]
+
+        _, _, self.dtype = read_header(self.fh)
+
+    def read(self, n):
+        """The next n values.
+        """
+        data = self.fh.read(int(n) * self.dtype.itemsize)
+        return np.frombuffer(data, self.dtype)
+
+
+def read_nbest(path, chunk_size=10000):
+    """Iterate n-best predictions, decompressing chunk_size abstracts at a
+    time.
+
+    Yields: gold, (k, n) pred array, k scores
+    """
+    with zipfile.ZipFile(path) as zf:
+
+        sizes, counts, golds, preds, scores = [
+            ArrayStream(zf, name)
+            for name in ('sizes', 'counts', 'gold', 'preds', 'scores')
+        ]
+
+        while True:
+
+            ns = sizes.read(chunk_size).astype(np.int64)
+            ks = counts.read(chunk_size).astype(np.int64)
+
+            if not len(ns):
+                break
+
+            chunk_golds = golds.read(ns.sum())
+            chunk_preds = preds.read((ns * ks).sum())
+            chunk_scores = scores.read(ks.sum())
+
+            gold_offsets = np.concatenate([[0], np.cumsum(ns)])
+            pred_offsets = np.concatenate([[0], np.cumsum(ns * ks)])
+            score_offsets = np.concatenate([[0], np.cumsum(ks)])
+
+            for i, (n, k) in enumerate(zip(ns, ks)):
+
+                yield (
+                    chunk_golds[gold_offsets[i]:gold_offsets[i+1]],
+                    chunk_preds[pred_offsets[i]:pred_offsets[i+1]]
+                        .reshape(k, n),
+                    chunk_scores[score_offsets[i]:score_offsets[i+1]],
+                )
@@ -5,6 +5,9 @@ import numpy as np
 import math
 import random
 
+from functools import lru_cache
+from itertools import permutations
+
 
 def max_perm_dist(size):
     """Maximum KT distance for sequence of given size.
@@ -12,30 +15,103 @@ def max_perm_dist(size):
     return int(size * (size-1) / 2)
 
 
-def random_perm_at_dist(size, dist):
-    """Generate a random permutation at a given swap distance.
+@lru_cache(maxsize=None)
+def mahonian_table(size):
+    """Cumulative Mahonian numbers, for each prefix of a Lehmer code.
+
+    Returns: table[m][s] = number of perms of m items with < s inversions.
+    """
+    max_dist = max_perm_dist(size)
+
+    # 0 items: one (empty) perm, with 0 inversions.
+    table = [[0] + [1] * (max_dist+1)]
+
+    for m in range(1, size+1):
+
+        prev = table[-1]
+
+        # Digit m-1 of the code adds 0..m-1 inversions.
+        counts = [
+            prev[s+1] - prev[max(s-m+1, 0)]
+            for s in range(max_dist+1)
+        ]
+
+        cumulative = [0]
+        for count in counts:
+            cumulative.append(cumulative[-1] + count)
+
+        table.append(cumulative)
+
+    return table
+
+
+def decode_lehmer(code):
+    """Map a Lehmer code to a perm in O(n log n), with a Fenwick tree over
+    the items not yet placed.
     """
-    perm = list(range(size))
+    size = len(code)
 
-    # Left indexes of correctly-ordered pairs.
-    ordered = set(range(size-1))
+    tree = [0] * (size+1)
+    for i in range(1, size+1):
+        tree[i] += 1
+        if i + (i & -i) <= size:
+            tree[i + (i & -i)] += tree[i]
 
-    for _ in range(dist):
+    step = 1 << size.bit_length()
 
-        i1 = random.sample(ordered, 1)[0]
-        i2 = i1 + 1
+    perm = []
+    for c in code:
 
-        perm[i1], perm[i2] = perm[i2], perm[i1]
+        # Find the (c+1)-th remaining item.
+        idx, rem, bit = 0, c+1, step
+        while bit:
+            if idx + bit <= size and tree[idx + bit] < rem:
+                idx += bit
+                rem -= tree[idx]
+            bit >>= 1
 
-        ordered.remove(i1)
+        perm.append(idx)
 
-        if i2+1 < len(perm) and perm[i2] < perm[i2+1]:
-            ordered.add(i2)
+        # Remove it.
+        i = idx+1
+        while i <= size:
+            tree[i] -= 1
+            i += i & -i
 
-        if i1 > 0 and perm[i1-1] < perm[i1]:
-            ordered.add(i1-1)
+    return perm
 
-    return tuple(perm)
+
+def random_perm_at_dist(size, dist):
+    """Sample a perm uniformly from all perms with exactly `dist` inversions.
+
+    Draws a Lehmer code digit by digit, weighting each digit by the number
+    of completions, then decodes it.
+    """
+    table = mahonian_table(size)
+
+    code = []
+    for i in range(size):
+
+        # Digit i can take values 0..m-1, with m-1 digits after it.
+        m = size - i
+        prev = table[m-1]
+
+        total = prev[dist+1] - prev[max(dist-m+1, 0)]
+        r = random.randrange(total)
+
+        # Smallest digit d with prev[dist+1] - prev[dist-d] > r.
+        lo, hi = 0, min(m-1, dist)
+        while lo < hi:
+            d = (lo + hi) // 2
+            if prev[dist+1] - prev[dist-d] > r:
+                hi = d
+            else:
+                lo = d+1
+
+        code.append(lo)
+        dist -= lo
+
+    return tuple(decode_lehmer(code))
 
 
 def sample_uniform_perms(size, skim=0.25, maxn=10):
@@ -75,3 +151,58 @@ def sample_perms_at_dist(size, offset, maxn=10):
     kt = sample_dist / max_dist
 
     return set(perms), kt
+
+
+@lru_cache(maxsize=None)
+def perm_table(size):
+    """All perms of a given size, as a read-only (size!, size) index array.
+    """
+    table = np.array(list(permutations(range(size))), dtype=np.int64)
+    table = table.reshape(math.factorial(size), size)
+
+    table.flags.writeable = False
+
+    return table
+
+
+def sample_uniform_perms_array(size, skim=0.25, maxn=10):
+    """Sample perms uniformly distributed across a skimmed KT interval.
+
+    Returns: (k, size) int array of perms, k KT distance ratios
+    """
+    max_dist = max_perm_dist(size)
+
+    max_sample_dist = math.ceil(max_dist * skim)
+
+    # At most, 1 sample for each possible distance.
+    n = min(maxn, max_sample_dist+1)
+
+    dists = np.linspace(0, max_sample_dist, n).round().astype(int)
+
+    perms = np.array([
+        random_perm_at_dist(size, d)
+        for d in dists
+    ], dtype=np.int64).reshape(n, size)
+
+    return perms, dists / max(max_dist, 1)
+
+
+def sample_perms_at_dist_array(size, offset, maxn=10):
+    """Sample distinct perms at a given KT ratio offset.
+
+    Returns: (k, size) int array of perms, k KT distance ratios
+    """
+    max_dist = max_perm_dist(size)
+
+    sample_dist = round(max_dist * offset)
+
+    perms = np.array([
+        random_perm_at_dist(size, sample_dist)
+        for _ in range(maxn)
+    ], dtype=np.int64).reshape(maxn, size)
+
+    perms = np.unique(perms, axis=0)
+
+    kts = np.full(len(perms), sample_dist / max(max_dist, 1))
+
+    return perms, kts
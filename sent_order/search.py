@@ -0,0 +1,56 @@
+
+
+import numpy as np
+
+from .perms import perm_table
+from . import timers
+
+
+# Exhaustive search is exact, and faster than beam search, up to here.
+EXHAUSTIVE_SIZE = 7
+
+# Memory ceiling for a single chunk of scorer inputs.
+MAX_BYTES = 2**28
+
+
+def exhaustive_search(size, score_perms, perm_bytes, max_bytes=MAX_BYTES,
+    nbest=1):
+    """Score every ordering of a set of sentences, in chunked batches.
+
+    Args:
+        size (int): Number of sentences.
+        score_perms (func): (k, size) perm array -> k scores, higher is better.
+        perm_bytes (int): Approximate scorer input size for a single perm.
+        max_bytes (int): Memory ceiling for each chunk.
+        nbest (int): Number of (perm, score) pairs to return.
+
+    Returns: [(perm tuple, score)], best first
+    """
+    perms = perm_table(size)
+
+    chunk_size = max(1, max_bytes // max(1, perm_bytes))
+
+    # Running top-k perm indexes and scores.
+    top_idx = np.zeros(0, dtype=int)
+    top_scores = np.zeros(0)
+
+    for start in range(0, len(perms), chunk_size):
+
+        chunk = perms[start:start+chunk_size]
+
+        scores = np.asarray(score_perms(chunk), dtype=float)
+        timers.count('perms_scored', len(chunk))
+
+        top_idx = np.concatenate([top_idx, start + np.arange(len(chunk))])
+        top_scores = np.concatenate([top_scores, scores])
+
+        if len(top_scores) > nbest:
+            keep = np.argpartition(-top_scores, nbest-1)[:nbest]
+            top_idx, top_scores = top_idx[keep], top_scores[keep]
+
+    rank = np.argsort(-top_scores, kind='stable')
+
+    return [
+        (tuple(perms[i].tolist()), float(score))
+        for i, score in zip(top_idx[rank], top_scores[rank])
+    ]
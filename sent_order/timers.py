@@ -0,0 +1,201 @@
+
+
+import os
+import time
+import atexit
+import ujson
+
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+
+# Set a path to turn on stats; .prom -> Prometheus text, else JSON lines.
+STATS_PATH = os.environ.get('SENT_ORDER_STATS')
+
+STATS_INTERVAL = float(os.environ.get('SENT_ORDER_STATS_INTERVAL', 30))
+
+# Rates reported for these counters.
+RATES = ('examples', 'sentences', 'steps')
+
+NULL = nullcontext()
+
+
+def rank():
+    """Worker rank, set by distributed.launch.
+    """
+    return int(os.environ.get('RANK', 0))
+
+
+class Stats:
+
+    def __init__(self, path=None, interval=STATS_INTERVAL):
+        """Named stage timers and counters, emitted periodically.
+        """
+        self.path = path
+        self.interval = interval
+
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+        self.start = self.last = time.monotonic()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block.
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def tick(self):
+        """Emit, if the interval has passed.
+        """
+        if time.monotonic() - self.last >= self.interval:
+            self.emit()
+
+    def snapshot(self):
+        """Cumulative timers, counters, and rates.
+        """
+        elapsed = time.monotonic() - self.start
+
+        padded = self.counters.get('padded_tokens')
+
+        return dict(
+            rank=rank(),
+            time=time.time(),
+            elapsed=elapsed,
+            stages={
+                name: dict(seconds=seconds, calls=self.calls[name])
+                for name, seconds in self.seconds.items()
+            },
+            counters=dict(self.counters),
+            rates={
+                f'{name}/s': self.counters[name] / elapsed
+                for name in RATES
+                if name in self.counters
+            },
+            padding_ratio=(
+                1 - self.counters['tokens'] / padded
+                if padded else None
+            ),
+        )
+
+    def prometheus(self, snapshot):
+        """Render a snapshot as Prometheus text.
+        """
+        lines = [
+            '# TYPE sent_order_stage_seconds_total counter',
+            *(
+                f'sent_order_stage_seconds_total{{stage="{name}"}} '
+                f'{stage["seconds"]}'
+                for name, stage in snapshot['stages'].items()
+            ),
+            '# TYPE sent_order_stage_calls_total counter',
+            *(
+                f'sent_order_stage_calls_total{{stage="{name}"}} '
+                f'{stage["calls"]}'
+                for name, stage in snapshot['stages'].items()
+            ),
+            '# TYPE sent_order_count_total counter',
+            *(
+                f'sent_order_count_total{{name="{name}"}} {value}'
+                for name, value in snapshot['counters'].items()
+            ),
+            '# TYPE sent_order_rate gauge',
+            *(
+                f'sent_order_rate{{name="{name}"}} {value}'
+                for name, value in snapshot['rates'].items()
+            ),
+        ]
+
+        if snapshot['padding_ratio'] is not None:
+            lines += [
+                '# TYPE sent_order_padding_ratio gauge',
+                f'sent_order_padding_ratio {snapshot["padding_ratio"]}',
+            ]
+
+        return '\n'.join(lines) + '\n'
+
+    def emit(self):
+        """Append a JSON line, or rewrite the Prometheus file.
+        """
+        self.last = time.monotonic()
+
+        snapshot = self.snapshot()
+
+        if self.path.endswith('.prom'):
+
+            path = self.path
+
+            # One file per worker.
+            if rank():
+                path = f'{path[:-5]}.{rank()}.prom'
+
+            with open(f'{path}.tmp', 'w') as fh:
+                fh.write(self.prometheus(snapshot))
+
+            os.replace(f'{path}.tmp', path)
+
+        else:
+            with open(self.path, 'a') as fh:
+                fh.write(ujson.dumps(snapshot) + '\n')
+
+
+STATS = None
+
+
+def configure(path, interval=STATS_INTERVAL):
+    """Turn on stats, written to a path.
+    """
+    global STATS
+    STATS = Stats(path, interval) if path else None
+
+
+def stage(name):
+    """Time a block, or do nothing when stats are off.
+    """
+    return STATS.stage(name) if STATS else NULL
+
+
+def count(name, n=1):
+    if STATS:
+        STATS.count(name, n)
+
+
+def tick():
+    if STATS:
+        STATS.tick()
+
+
+def flush():
+    if STATS:
+        STATS.emit()
+
+
+@contextmanager
+def collect():
+    """Count into a fresh, unwritten Stats, whatever the config.
+    """
+    global STATS
+
+    prev, STATS = STATS, Stats()
+
+    try:
+        yield STATS
+
+    finally:
+        STATS = prev
+
+
+configure(STATS_PATH)
+
+atexit.register(flush)
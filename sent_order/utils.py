@@ -2,24 +2,16 @@
 
 import numpy as np
 
-import os
 import random
 import torch
 
-from collections import OrderedDict
-
 from torch.nn.utils.rnn import pack_padded_sequence
 from torch.autograd import Variable
 
-from .cuda import ftype, itype
-
+from . import device, timers
 
-def checkpoint(root, key, model, epoch=0):
-    """Save model checkpoint.
-    """
-    os.makedirs(root, exist_ok=True)
-    path = os.path.join(root, f'{key}.{epoch}.bin')
-    torch.save(model, path)
+# Moved to metrics, which doesn't import torch.
+from .metrics import sort_by_key
 
 
 def pad(variable, size):
@@ -59,6 +51,9 @@ def pad_and_stack(variables, size):
     """
     padded, sizes = zip(*[pad(v, size) for v in variables])
 
+    timers.count('tokens', sum(sizes))
+    timers.count('padded_tokens', len(sizes) * size)
+
     return torch.stack(padded), sizes
 
 
@@ -74,8 +69,9 @@ def pack(batch, sizes, batch_first=True):
     # Get indexes for sorted sizes.
     size_sort = np.argsort(sizes)[::-1].tolist()
 
-    # Sort the tensor by size.
-    batch = batch[torch.LongTensor(size_sort).type(itype)]
+    # Sort the tensor by size. Upcast half-precision embeddings here, at
+    # the LSTM input.
+    batch = device.floats(batch[device.longs(size_sort)])
 
     # Sort sizes descending.
     sizes = np.array(sizes)[size_sort].tolist()
@@ -83,7 +79,7 @@ def pack(batch, sizes, batch_first=True):
     batch = pack_padded_sequence(batch, sizes, batch_first)
 
     # Indexes to restore original order.
-    reorder = torch.LongTensor(np.argsort(size_sort)).type(itype)
+    reorder = device.longs(np.argsort(size_sort))
 
     return batch, reorder
 
@@ -94,14 +90,33 @@ def pad_and_pack(variables, pad_size):
     Args:
         tensors (list): Variable-length tensors.
     """
-    padded, sizes = pad_and_stack(variables, pad_size)
+    with timers.stage('pad_and_pack'):
+        padded, sizes = pad_and_stack(variables, pad_size)
+        return pack(padded, sizes)
 
-    return pack(padded, sizes)
 
+def shuffled_spans(starts, sizes, max_size, pad_index):
+    """Shuffle contiguous index spans, truncate and pad them.
 
-def sort_by_key(d, desc=False):
-    """Sort dictionary by key.
+    Args:
+        starts (np.array): First index of each span.
+        sizes (np.array): Length of each span.
+        max_size (int): Truncate shuffled spans to this length.
+        pad_index (int): Index for padding slots.
+
+    Returns: (spans, <= max_size) index array, truncated sizes
     """
-    items = sorted(d.items(), key=lambda x: x[0], reverse=desc)
+    width = sizes.max()
+
+    # Sort random keys, with padding slots last.
+    keys = np.random.rand(len(sizes), width)
+    keys[np.arange(width) >= sizes[:,None]] = np.inf
+    shuffle = keys.argsort(1)[:,:max_size]
+
+    spans = np.where(
+        shuffle < sizes[:,None],
+        starts[:,None] + shuffle,
+        pad_index,
+    )
 
-    return OrderedDict(items)
+    return spans, np.minimum(sizes, max_size)
@@ -1,34 +1,93 @@
 
 
+import numpy as np
+
 import os
 import attr
 
+from functools import lru_cache
 from cached_property import cached_property
-from gensim.models import KeyedVectors
 
 
 VECTORS_PATH = os.path.join(os.path.dirname(__file__), 'data/vectors.bin')
 
+# Storage dtype - float16, bfloat16, or float32. Upcast when packed.
+VECTORS_DTYPE = 'float16'
+
+# Rows converted at a time, when building the matrix.
+CHUNK_SIZE = 10000
+
 
 @attr.s
 class LazyVectors:
 
     path = attr.ib()
 
+    dtype = attr.ib(default=VECTORS_DTYPE)
+
     @classmethod
     def read(cls):
-        return cls(VECTORS_PATH)
+        """Read the default vectors, or SENT_ORDER_VECTORS if set.
+
+        Models share one copy per path and dtype.
+        """
+        return shared_vectors(
+            cls,
+            os.environ.get('SENT_ORDER_VECTORS', VECTORS_PATH),
+            os.environ.get('SENT_ORDER_VECTORS_DTYPE', VECTORS_DTYPE),
+        )
 
     @cached_property
-    def model(self):
-        return KeyedVectors.load(self.path)
+    def table(self):
+        """Load vectors, convert to the storage dtype.
+
+        Returns: token -> row, (vocab + 1, dim) tensor with a zero OOV row.
+        """
+        import torch
+        from gensim.models import KeyedVectors
+
+        model = KeyedVectors.load(self.path, mmap='r')
+
+        vectors = model.vectors
+        vocab_size, dim = vectors.shape
+
+        matrix = torch.zeros(vocab_size+1, dim,
+            dtype=getattr(torch, self.dtype))
+
+        # Convert in chunks, never holding a full float32 copy.
+        for i in range(0, vocab_size, CHUNK_SIZE):
+            chunk = np.array(vectors[i:i+CHUNK_SIZE], dtype=np.float32)
+            matrix[i:i+len(chunk)] = torch.from_numpy(chunk)
+
+        return model.key_to_index, matrix
+
+    @property
+    def index(self):
+        return self.table[0]
+
+    @property
+    def matrix(self):
+        return self.table[1]
 
     @property
     def dim(self):
-        return self.model.vector_size
+        return self.matrix.shape[1]
+
+    def embed(self, tokens):
+        """Gather rows for a list of tokens, zeros for OOV.
+
+        Returns: (len(tokens), dim) tensor, in the storage dtype.
+        """
+        oov = len(self.index)
+        return self.matrix[[self.index.get(t, oov) for t in tokens]]
 
     def __getitem__(self, key):
-        return self.model[key]
+        return self.matrix[self.index[key]]
 
     def __contains__(self, key):
-        return key in self.model
+        return key in self.index
+
+
+@lru_cache()
+def shared_vectors(cls, path, dtype):
+    return cls(path, dtype)
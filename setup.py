@@ -12,4 +12,9 @@ setup(
     author='David McClure',
     author_email='dclure@mit.edu',
     packages=find_packages(),
+    entry_points={
+        'console_scripts': [
+            'sent-order = sent_order.cli:cli',
+        ],
+    },
 )
@@ -0,0 +1,57 @@
+
+
+from sent_order import benchmark
+
+
+def test_corpus_reproducible(tmpdir):
+
+    def corpus(name, seed):
+        root = str(tmpdir.join(name))
+        benchmark.write_corpus(root, abstracts=50, seed=seed)
+        return tmpdir.join(name, 'abstracts.json').read()
+
+    assert corpus('a', 0) == corpus('b', 0)
+    assert corpus('a', 0) != corpus('c', 1)
+
+    lines = corpus('a', 0).splitlines()
+    assert len(lines) == 50
+
+
+def test_time_call_and_compare():
+
+    calls = []
+
+    stats = benchmark.time_call(lambda: calls.append(1), repeats=4, warmup=2)
+
+    assert len(calls) == 6
+    assert stats['repeats'] == 4
+    assert stats['min'] <= stats['median']
+
+    old = dict(results=dict(a=dict(median=2.), b=dict(median=1.)))
+    new = dict(results=dict(a=dict(median=1.), c=dict(median=1.)))
+
+    assert benchmark.compare(old, new) == dict(a=(2., 1., 0.5))
+
+
+def test_scaling():
+
+    rows = list(benchmark.scaling(sizes=(4, 6), beams=(1, 1000), samples=2,
+        exact_max=5, lstm_dim=4, lin_dim=4))
+
+    by_key = {(r['model'], r['decoder'], r['n'], r['beam_size']): r
+        for r in rows}
+
+    # Exact solvers only up to exact_max.
+    assert ('pairs', 'exhaustive', 4, None) in by_key
+    assert ('pairs', 'exhaustive', 6, None) not in by_key
+    assert by_key['pairs', 'beam_search', 6, 1000]['kt_vs_exact'] is None
+
+    # A beam wider than n! is exact.
+    for model, decoder in [('pairs', 'beam_search'),
+        ('pick_next', 'order_beam_search')]:
+
+        row = by_key[model, decoder, 4, 1000]
+
+        assert row['kt_vs_exact'] == 1
+        assert row['beam_expansions'] > 0
+        assert row['classifier_calls'] > 0
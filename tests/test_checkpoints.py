@@ -0,0 +1,103 @@
+
+
+import pytest
+import torch
+
+from sent_order.models.pairs import Classifier, Encoder
+from sent_order.encoders import CNNEncoder
+from sent_order.checkpoints import Checkpoints, hparams, model_state, \
+    atomic_save, load_model, export
+
+
+def checkpoints(root, **kwargs):
+    model = Classifier(4, 3)
+    optimizer = torch.optim.Adam(model.parameters())
+    return Checkpoints(root, dict(classifier=model), optimizer, **kwargs)
+
+
+def test_resume(tmpdir):
+
+    ck = checkpoints(str(tmpdir))
+
+    # One step, so Adam has state.
+    model = ck.models['classifier']
+    model(torch.randn(5, 4)).sum().backward()
+    ck.optimizer.step()
+
+    ck.save(0, 1.0)
+    ck.close()
+
+    resumed = checkpoints(str(tmpdir), resume=True)
+    assert resumed.restore() == 1
+    resumed.close()
+
+    for p, q in zip(model.parameters(),
+        resumed.models['classifier'].parameters()):
+        assert torch.equal(p, q)
+
+    state = ck.optimizer.state_dict()['state']
+    resumed_state = resumed.optimizer.state_dict()['state']
+
+    assert state.keys() == resumed_state.keys()
+
+    for i in state:
+        assert torch.equal(state[i]['exp_avg'], resumed_state[i]['exp_avg'])
+
+
+def test_refuse_previous_run(tmpdir):
+
+    ck = checkpoints(str(tmpdir))
+    ck.save(0, 1.0)
+    ck.close()
+
+    with pytest.raises(ValueError):
+        checkpoints(str(tmpdir))
+
+    ck = checkpoints(str(tmpdir), overwrite=True)
+    ck.close()
+
+    assert not tmpdir.join('checkpoints.json').exists()
+    assert not tmpdir.join('classifier.0.pt').exists()
+
+
+def test_state_dict_round_trip(tmpdir):
+
+    # Inferred hparams (LSTM, lin1), and explicit ones.
+    modules = [Encoder(6, 3), Classifier(4, 3), CNNEncoder(6, 3)]
+
+    for i, module in enumerate(modules):
+
+        path = str(tmpdir.join(f'{i}.pt'))
+        atomic_save(model_state(module), path)
+
+        loaded = load_model(path)
+
+        assert type(loaded) is type(module)
+        assert hparams(loaded) == hparams(module)
+
+        state, loaded_state = module.state_dict(), loaded.state_dict()
+
+        assert state.keys() == loaded_state.keys()
+
+        for key in state:
+            assert torch.equal(state[key], loaded_state[key])
+
+
+def test_export_pickled(tmpdir):
+
+    module = Classifier(4, 3)
+
+    pickled = str(tmpdir.join('pickled.pt'))
+    torch.save(module, pickled)
+
+    # Whole-module pickles need an explicit, trusted export.
+    with pytest.raises(ValueError):
+        load_model(pickled)
+
+    exported = str(tmpdir.join('exported.pt'))
+    export(pickled, exported)
+
+    x = torch.randn(2, 4)
+
+    with torch.no_grad():
+        assert torch.equal(load_model(exported)(x), module(x))
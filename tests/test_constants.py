@@ -0,0 +1,12 @@
+
+
+from sent_order.constants import KT_DECODERS, SENT_ENCODERS, DISTILL_MODELS
+from sent_order.models import kt_regression
+from sent_order.encoders import ENCODERS
+from sent_order.distill import TASKS
+
+
+def test_registries():
+    assert set(KT_DECODERS) == set(kt_regression.DECODERS)
+    assert set(SENT_ENCODERS) == {'lstm', *ENCODERS}
+    assert set(DISTILL_MODELS) == set(TASKS)
@@ -0,0 +1,35 @@
+
+
+from sent_order.device import Device, parse_cpus
+
+
+def test_parse_cpus():
+    assert parse_cpus('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpus('5') == [5]
+
+
+def test_split():
+
+    device = Device('cpu', threads=8, cores='0-7')
+
+    shares = [device.split(rank, 3) for rank in range(3)]
+
+    # Disjoint, covering every pinned core.
+    cores = [c for share in shares for c in share.cores]
+    assert sorted(cores) == list(range(8))
+
+    assert all(share.threads == 2 for share in shares)
+
+    # Threads default to the share size.
+    share = Device('cpu', cores='0-7').split(0, 3)
+    assert share.threads == len(share.cores) == 3
+
+
+def test_split_more_workers_than_cpus():
+
+    device = Device('cpu', cores='0-1')
+
+    shares = [device.split(rank, 3) for rank in range(3)]
+
+    assert [share.cores for share in shares] == [[0], [1], [0]]
+    assert all(share.threads == 1 for share in shares)
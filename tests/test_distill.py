@@ -0,0 +1,48 @@
+
+
+import pytest
+import torch
+
+from torch import nn
+from torch.nn import functional as F
+
+from sent_order import distill
+from sent_order.benchmark import write_corpus
+from sent_order.checkpoints import Checkpoints
+from sent_order.models import pairs
+
+
+def test_distill_loss_alpha_1():
+
+    y_pred = F.log_softmax(torch.randn(6, 2), 1)
+    soft = F.log_softmax(torch.randn(6, 2), 1)
+    y = torch.tensor([0, 1, 1, 0, 1, 0])
+
+    loss = distill.distill_loss(y_pred, soft, y, temperature=2, alpha=1)
+
+    assert torch.isclose(loss, nn.NLLLoss()(y_pred, y))
+
+
+def test_student_not_smaller(tmpdir):
+
+    corpus_path = str(tmpdir.join('corpus'))
+    write_corpus(corpus_path, abstracts=20)
+
+    teacher_path = str(tmpdir.join('teacher'))
+
+    teacher = dict(
+        s_encoder=pairs.Encoder(300, 4),
+        classifier=pairs.Classifier(16, 4),
+    )
+
+    params = [p for m in teacher.values() for p in m.parameters()]
+
+    checkpoints = Checkpoints(teacher_path, teacher,
+        torch.optim.Adam(params))
+
+    checkpoints.save(0, 1.0)
+    checkpoints.close()
+
+    with pytest.raises(ValueError, match='Student has'):
+        distill.train(corpus_path, str(tmpdir.join('student')), 'pairs',
+            teacher_path, None, 1e-3, 1, 1, 10, lstm_dim=8, lin_dim=8)
@@ -0,0 +1,80 @@
+
+
+import pytest
+import torch
+import ujson
+
+from sent_order import distributed
+from sent_order.benchmark import write_corpus
+from sent_order.models import pairs
+
+
+@pytest.fixture
+def rank_1_of_3(monkeypatch):
+    monkeypatch.setattr(distributed, 'rank', lambda: 1)
+    monkeypatch.setattr(distributed, 'world_size', lambda: 3)
+
+
+def test_shard_corpus(tmpdir, rank_1_of_3):
+
+    root = str(tmpdir.join('corpus'))
+    write_corpus(root, abstracts=10)
+
+    corpus = pairs.Corpus(root)
+    shard = pairs.Corpus(root, 8, shard=True)
+
+    assert shard.abstracts == corpus.abstracts[1:8:3]
+
+
+def test_check_shard(rank_1_of_3):
+
+    distributed.check_shard(20, 20)
+
+    with pytest.raises(ValueError):
+        distributed.check_shard(19, 20)
+
+
+def all_reduce_worker(path):
+    """Reduce rank-dependent values, write what this rank sees.
+    """
+    rank = distributed.rank()
+
+    # Rank 1 starts with other weights, and leaves b unused.
+    a = torch.nn.Parameter(torch.full((2,), float(rank)))
+    b = torch.nn.Parameter(torch.zeros(3))
+
+    distributed.broadcast_params([a, b])
+
+    a.grad = torch.full((2,), float(rank + 1))
+
+    if rank == 0:
+        b.grad = torch.full((3,), 4.)
+
+    distributed.average_gradients([a, b])
+
+    with open(f'{path}.{rank}', 'w') as fh:
+        ujson.dump(dict(
+            a=a.tolist(),
+            a_grad=a.grad.tolist(),
+            b_grad=b.grad.tolist(),
+            total=distributed.reduce_sum(rank + 1, 10),
+        ), fh)
+
+
+def test_gloo_all_reduce(tmpdir):
+
+    path = str(tmpdir.join('out'))
+
+    distributed.launch(all_reduce_worker, 2, path)
+
+    for rank in (0, 1):
+
+        with open(f'{path}.{rank}') as fh:
+            out = ujson.load(fh)
+
+        assert out == dict(
+            a=[0, 0],
+            a_grad=[1.5, 1.5],
+            b_grad=[2, 2, 2],
+            total=[3, 20],
+        )
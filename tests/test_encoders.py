@@ -0,0 +1,45 @@
+
+
+import pytest
+import torch
+
+from sent_order.encoders import PooledEncoder, CNNEncoder, sentence_encoder
+from sent_order.models import pairs
+from sent_order.utils import pack, pad_and_stack
+
+
+@pytest.mark.parametrize('cls', [PooledEncoder, CNNEncoder])
+def test_padding_invariant(cls):
+
+    torch.manual_seed(0)
+
+    encoder = cls(6, 5)
+
+    sents = [torch.randn(n, 6) for n in (4, 1, 7)]
+
+    with torch.no_grad():
+
+        alone = torch.cat([encoder([s]) for s in sents])
+
+        # List input, padded to 30.
+        listed = encoder(sents)
+
+        # Packed input, like the BiLSTM encoders.
+        padded, sizes = pad_and_stack(sents, 30)
+        packed = encoder(*pack(padded, sizes))
+
+    assert listed.shape == (3, 10)
+    assert torch.allclose(listed, alone, atol=1e-6)
+    assert torch.allclose(packed, alone, atol=1e-6)
+
+
+def test_sentence_encoder():
+
+    assert isinstance(sentence_encoder('lstm', pairs.Encoder, 6, 5),
+        pairs.Encoder)
+
+    assert isinstance(sentence_encoder('cnn', pairs.Encoder, 6, 5),
+        CNNEncoder)
+
+    with pytest.raises(ValueError):
+        sentence_encoder('gru', pairs.Encoder, 6, 5)
@@ -0,0 +1,60 @@
+
+
+import numpy as np
+
+import torch
+import attr
+
+from sent_order.encodings import Encodings
+
+
+@attr.s
+class Sentence:
+    position = attr.ib()
+
+
+@attr.s
+class Unit:
+    sentences = attr.ib()
+
+
+def unit(n):
+    return Unit([Sentence(i) for i in range(n)])
+
+
+def test_rewrite_stale(tmpdir):
+
+    path = str(tmpdir.join('encodings.npy'))
+
+    encoder_path = str(tmpdir.join('s_encoder.pt'))
+    tmpdir.join('s_encoder.pt').write('')
+
+    calls = []
+
+    def encode(dim):
+        def func(units):
+            calls.append(dim)
+            size = sum(len(u.sentences) for u in units)
+            return torch.full((size, dim), float(dim))
+        return func
+
+    units = [unit(2), unit(3)]
+
+    encodings = Encodings.load(path, units, encode(4), encoder_path, 4)
+    assert encodings.array.shape == (5, 4)
+    assert calls == [4]
+
+    # Same corpus and encoder, reuse the file.
+    Encodings.load(path, units, encode(4), encoder_path, 4)
+    assert calls == [4]
+
+    # Another corpus.
+    units = [unit(2), unit(4)]
+    encodings = Encodings.load(path, units, encode(4), encoder_path, 4)
+    assert encodings.array.shape == (6, 4)
+    assert calls == [4, 4]
+
+    # Another encoder size.
+    encodings = Encodings.load(path, units, encode(8), encoder_path, 8)
+    assert encodings.array.shape == (6, 8)
+    assert np.all(encodings.array == 8)
@@ -0,0 +1,41 @@
+
+
+import numpy as np
+import torch
+
+from sent_order.models import pairs, pick_next
+from sent_order.models.ensemble import Ensemble
+
+
+def test_single_model_matches():
+
+    torch.manual_seed(0)
+
+    classifier = pairs.Classifier(8, 4)
+    r_encoder = pick_next.Encoder(4, 2)
+    next_classifier = pick_next.Classifier(18, 4)
+
+    pairs_only = Ensemble(pairs=(None, classifier))
+    pick_next_only = Ensemble(pick_next=(None, r_encoder, next_classifier))
+
+    # Exhaustive, then beam search.
+    for n in (5, 9):
+
+        ab = torch.randn(n, 4)
+
+        with torch.no_grad():
+            searches = [
+                (
+                    pairs_only.beam_search(dict(pairs=ab), 10),
+                    pairs.beam_search(ab, classifier, 10),
+                ),
+                (
+                    pick_next_only.beam_search(dict(pick_next=ab), 10),
+                    pick_next.order_beam_search(ab, r_encoder,
+                        next_classifier, 10),
+                ),
+            ]
+
+        for [(path, score)], [(model_path, model_score)] in searches:
+            assert path == model_path
+            assert np.isclose(score, model_score, atol=1e-4)
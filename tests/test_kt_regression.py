@@ -0,0 +1,77 @@
+
+
+import numpy as np
+import random
+import torch
+
+from sent_order.models import kt_regression
+
+
+def inversions_regressor(x):
+    """Predict the number of inversions in each ordering of scalar sents.
+    """
+    values = torch.stack(x)[:,:,0]
+    pairs = values[:,:,None] > values[:,None,:]
+    return torch.triu(pairs, 1).sum((1, 2)).float()
+
+
+def test_decoders_find_optimum():
+
+    np.random.seed(0)
+    random.seed(0)
+
+    # Sentence i belongs at target[i].
+    target = np.array([3, 0, 4, 1, 2])
+    sents = torch.tensor(target, dtype=torch.float).view(-1, 1)
+
+    decoders = dict(
+        kt_regression.DECODERS,
+        exhaustive=kt_regression.exhaustive_order,
+    )
+
+    for name, decoder in decoders.items():
+        perm = decoder(sents, inversions_regressor)
+        assert list(perm) == np.argsort(target).tolist(), name
+
+
+def test_swap_neighbors():
+
+    perm = np.array([2, 0, 3, 1])
+    neighbors = kt_regression.swap_neighbors(perm)
+
+    assert len({tuple(p) for p in neighbors}) == 6
+
+    # Each differs from perm in exactly two slots.
+    assert ((neighbors != perm).sum(1) == 2).all()
+
+
+def test_train_batch_gathers_perms():
+
+    random.seed(0)
+
+    sizes = [3, 1, 5]
+
+    batch = kt_regression.Batch([
+        kt_regression.Paragraph([None] * size)
+        for size in sizes
+    ])
+
+    # Each sentence encodes its own batch index.
+    sents = torch.arange(sum(sizes), dtype=torch.float).view(-1, 1)
+
+    x, y = kt_regression.train_batch(batch, None, lambda x: x, sents)
+
+    starts = dict(zip(sizes, np.cumsum([0] + sizes)))
+
+    for graf, kt in zip(x, y.tolist()):
+
+        idx = graf.view(-1).long().numpy()
+        n, start = len(idx), starts[len(idx)]
+
+        # A perm of one graf's own sentences, at the labeled distance.
+        assert sorted(idx - start) == list(range(n))
+
+        inversions = sum(
+            idx[i] > idx[j] for i in range(n) for j in range(i+1, n))
+
+        assert np.isclose(inversions, kt * max(n*(n-1)/2, 1))
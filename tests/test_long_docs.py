@@ -0,0 +1,50 @@
+
+
+import numpy as np
+
+from sent_order.long_docs import PairScores, local_search, order_long
+
+
+def chain_scorer(scored):
+    """Score 0 for j right after i, else -1. Log the pairs asked for.
+    """
+    def score_pairs(i, j):
+        scored.extend(zip(i.tolist(), j.tolist()))
+        return np.where(j == i+1, 0., -1.)
+    return score_pairs
+
+
+def test_order_long_recovers_chain():
+
+    rng = np.random.RandomState(0)
+
+    n = 40
+
+    # Encodings drift with position, like topics through a document.
+    encoded = np.arange(n)[:,None] + 0.1 * rng.randn(n, 8)
+
+    scored = []
+    order = order_long(encoded, chain_scorer(scored), chunk_size=8)
+
+    assert order == list(range(n))
+
+    # Lazy: each pair scored once, far fewer than all n^2.
+    assert len(scored) == len(set(scored))
+    assert len(scored) < n*n / 2
+
+
+def test_local_search_improves():
+
+    rng = np.random.RandomState(0)
+
+    n = 30
+    scores = PairScores(chain_scorer([]), n)
+
+    start = rng.permutation(n)
+    order = np.array(local_search(start, scores))
+
+    def total(o):
+        return scores[o[:-1], o[1:]].sum()
+
+    assert sorted(order) == list(range(n))
+    assert total(order) >= total(start)
@@ -0,0 +1,176 @@
+
+
+import numpy as np
+import ujson
+
+from sent_order.nbest import write_gold_pred
+from sent_order.metrics import Metrics, MetricsAccumulator, bootstrap_ratios, \
+    kendall_taus, count_inversions_broadcast, count_inversions_fenwick
+
+
+GOLD_PRED = [
+    ([0, 1, 2], [0, 2, 1]),
+    ([0, 1], [0, 1]),
+    ([0, 1, 2, 3], [3, 2, 1, 0]),
+]
+
+
+def test_jsonl_and_legacy_json(tmpdir):
+
+    jsonl_path = str(tmpdir.join('gp.json'))
+    write_gold_pred(jsonl_path, GOLD_PRED)
+
+    json_path = str(tmpdir.join('legacy.json'))
+
+    with open(json_path, 'w') as fh:
+        ujson.dump(GOLD_PRED, fh)
+
+    jsonl = MetricsAccumulator.from_files([jsonl_path])
+    json = MetricsAccumulator.from_files([json_path])
+
+    assert jsonl.len_counts == {2: 1, 3: 1, 4: 1}
+    for field in MetricsAccumulator.fields:
+        assert np.allclose(jsonl.sums[field], json.sums[field])
+
+
+def test_bootstrap_ci_empty():
+
+    low, high = Metrics([]).bootstrap_ci('perfect', replicates=10)
+    assert np.isnan(low) and np.isnan(high)
+
+    # Single sentences have no KT.
+    low, high = Metrics([([0], [0])]).bootstrap_ci('kt', replicates=10)
+    assert np.isnan(low) and np.isnan(high)
+
+
+def test_bootstrap_ratios_empty():
+    assert np.isnan(bootstrap_ratios(np.zeros(0), np.zeros(0), 5)).all()
+
+
+def test_from_file(tmpdir):
+
+    jsonl_path = str(tmpdir.join('gp.json'))
+    write_gold_pred(jsonl_path, GOLD_PRED)
+
+    json_path = str(tmpdir.join('legacy.json'))
+
+    with open(json_path, 'w') as fh:
+        ujson.dump(GOLD_PRED, fh)
+
+    for path in (jsonl_path, json_path):
+        m = Metrics.from_file(path)
+        assert [tuple(gp) for gp in m.gold_pred] == GOLD_PRED
+
+
+def test_single_sentence_kt(tmpdir):
+
+    gold_pred = GOLD_PRED + [([0], [0])]
+
+    # (1/3 + 1 - 1) / 3
+    kt = 1/9
+
+    m = Metrics(gold_pred)
+    assert np.isclose(m.overall_kt(), kt)
+    assert np.isnan(m.avg_kt_by_len()[1])
+
+    acc = MetricsAccumulator()
+    acc.update(gold_pred)
+    assert np.isclose(acc.overall_kt(), kt)
+    assert np.isnan(acc.avg_kt_by_len()[1])
+    assert acc.avg_kt_by_len()[2] == 1
+
+    # Sums saved before kt_count.
+    path = str(tmpdir.join('sums.npz'))
+    sums = {f: v for f, v in acc.sums.items() if f != 'kt_count'}
+    sums['kt'][1] = np.nan
+    np.savez(path, **sums)
+
+    assert np.isclose(MetricsAccumulator.load(path).overall_kt(), kt)
+
+
+def test_kendall_taus_ties():
+
+    from scipy import stats
+
+    gold = np.array([[0, 1, 2, 3], [0, 1, 2, 3]])
+    pred = np.array([[1, 0, 2, 3], [0, 0, 2, 1]])
+
+    taus = kendall_taus(gold, pred)
+
+    assert np.isclose(taus[0], 2/3)
+    assert np.isclose(taus[1], stats.kendalltau(gold[1], pred[1])[0])
+
+
+def test_inversions_and_taus():
+
+    from scipy import stats
+
+    rng = np.random.RandomState(0)
+
+    for n in (2, 7, 80):
+
+        gold = np.array([rng.permutation(n) for _ in range(20)])
+        pred = np.array([rng.permutation(n) for _ in range(20)])
+
+        brute = [
+            sum(p[i] > p[j] for i in range(n) for j in range(i+1, n))
+            for p in pred
+        ]
+
+        assert count_inversions_broadcast(pred).tolist() == brute
+        assert count_inversions_fenwick(pred).tolist() == brute
+
+        assert np.allclose(kendall_taus(gold, pred), [
+            stats.kendalltau(g, p)[0] for g, p in zip(gold, pred)
+        ])
+
+
+def naive_lcs(pred_in_gold_order):
+    """O(n^2) longest increasing subsequence.
+    """
+    best = []
+    for i, v in enumerate(pred_in_gold_order):
+        best.append(1 + max(
+            [b for b, u in zip(best, pred_in_gold_order) if u < v],
+            default=0,
+        ))
+    return max(best, default=0)
+
+
+def test_columnar_metrics():
+
+    rng = np.random.RandomState(0)
+
+    gold_pred = []
+    for _ in range(50):
+        n = rng.randint(1, 9)
+        gold_pred.append((
+            rng.permutation(n).tolist(),
+            rng.permutation(n).tolist(),
+        ))
+
+    m = Metrics(gold_pred)
+
+    for i, (gold, pred) in enumerate(gold_pred):
+
+        n = len(gold)
+        correct = sum(g == p for g, p in zip(gold, pred))
+
+        assert m.lengths[i] == n
+        assert m.correct[i] == correct
+        assert m.perfect[i] == (correct == n)
+
+        by_gold = [p for _, p in sorted(zip(gold, pred))]
+        assert m.lcs[i] == naive_lcs(by_gold)
+
+        assert m.first_correct[i] == (by_gold[0] == 0)
+        assert m.last_correct[i] == (by_gold[-1] == n-1)
+
+    # Streamed sums give the same report.
+    acc = MetricsAccumulator()
+    acc.update(gold_pred)
+
+    assert np.isclose(acc.overall_kt(), m.overall_kt())
+    assert np.isclose(acc.overall_lcs_pct(), m.overall_lcs_pct())
+    assert np.isclose(acc.overall_positional_accuracy_pct(),
+        m.overall_positional_accuracy_pct())
@@ -0,0 +1,32 @@
+
+
+import numpy as np
+
+from sent_order.nbest import write_nbest, read_nbest
+
+
+def test_round_trip(tmpdir):
+
+    path = str(tmpdir.join('nbest.npz'))
+
+    golds = [[0, 1, 2], [1, 0], [3, 0, 2, 1]]
+
+    nbests = [
+        [([0, 1, 2], -0.5), ([1, 0, 2], -1.5)],
+        [([1, 0], -0.25)],
+        [([3, 0, 2, 1], -2), ([0, 1, 2, 3], -3), ([3, 2, 1, 0], -4)],
+    ]
+
+    write_nbest(path, golds, nbests)
+
+    # Chunks smaller than, and larger than, the file.
+    for chunk_size in (1, 2, 100):
+
+        rows = list(read_nbest(path, chunk_size))
+
+        assert len(rows) == len(golds)
+
+        for (gold, preds, scores), g, nb in zip(rows, golds, nbests):
+            assert gold.tolist() == g
+            assert preds.tolist() == [pred for pred, _ in nb]
+            assert np.allclose(scores, [score for _, score in nb])
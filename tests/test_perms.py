@@ -0,0 +1,76 @@
+
+
+import random
+
+from collections import Counter
+from itertools import permutations, product
+
+from sent_order.perms import mahonian_table, decode_lehmer, \
+    random_perm_at_dist, sample_uniform_perms_array, \
+    sample_perms_at_dist_array
+
+
+def inversions(perm):
+    return sum(
+        perm[i] > perm[j]
+        for i in range(len(perm))
+        for j in range(i+1, len(perm))
+    )
+
+
+def test_mahonian_table():
+
+    counts = Counter(inversions(p) for p in permutations(range(5)))
+
+    table = mahonian_table(5)[5]
+
+    for d in range(11):
+        assert table[d+1] - table[d] == counts[d]
+
+
+def test_decode_lehmer():
+
+    codes = list(product(*[range(m) for m in range(4, 0, -1)]))
+    perms = [tuple(decode_lehmer(code)) for code in codes]
+
+    assert sorted(perms) == list(permutations(range(4)))
+
+    for code, perm in zip(codes, perms):
+        assert inversions(perm) == sum(code)
+
+
+def test_random_perm_at_dist_uniform():
+
+    random.seed(0)
+
+    # 5 items, 3 inversions: 15 perms.
+    samples = Counter(random_perm_at_dist(5, 3) for _ in range(3750))
+
+    assert len(samples) == 15
+    assert all(inversions(p) == 3 for p in samples)
+
+    # Expect 250 each; 6 standard deviations is about 92.
+    assert all(abs(c - 250) < 95 for c in samples.values())
+
+
+def test_array_samplers():
+
+    random.seed(0)
+
+    perms, kts = sample_uniform_perms_array(6, skim=0.5, maxn=5)
+
+    assert perms.shape == (5, 6)
+
+    for perm, kt in zip(perms, kts):
+        assert sorted(perm) == list(range(6))
+        assert inversions(perm) == kt * 15
+
+    perms, kts = sample_perms_at_dist_array(6, 0.2, maxn=20)
+
+    assert len({tuple(p) for p in perms}) == len(perms)
+    assert all(inversions(p) == 3 for p in perms)
+    assert (kts == 0.2).all()
+
+    # Single sentences have nothing to permute.
+    perms, kts = sample_perms_at_dist_array(1, 0.5)
+    assert (perms == 0).all() and (kts == 0).all()
@@ -0,0 +1,44 @@
+
+
+import numpy as np
+
+from sent_order.models import pick_next
+
+
+def test_example_indexes():
+
+    np.random.seed(0)
+
+    sizes = [4, 1, 3, 40]
+    zero = sum(sizes)
+
+    idx = pick_next.example_indexes(sizes, right_size=30)
+
+    # One example per position but the last, in abstract order.
+    expected = [
+        (start, n, i)
+        for start, n in zip(np.cumsum([0] + sizes), sizes)
+        for i in range(n-1)
+    ]
+
+    assert len(idx['first']) == len(expected)
+
+    for k, (start, n, i) in enumerate(expected):
+
+        assert idx['first'][k] == start + i
+        assert start + i < idx['other'][k] < start + n
+
+        assert idx['minus1'][k] == (start + i-1 if i > 0 else zero)
+        assert idx['minus2'][k] == (start + i-2 if i > 1 else zero)
+
+        assert idx['index'][k] == i
+        assert np.isclose(idx['ratio'][k], i / (n-1))
+
+        # A shuffled sample of the remaining sentences, then padding.
+        size = min(n - i, 30)
+        right = idx['right'][k]
+
+        assert idx['right_sizes'][k] == size
+        assert len(set(right[:size])) == size
+        assert set(right[:size]) <= set(range(start + i, start + n))
+        assert (right[size:] == zero).all()
@@ -0,0 +1,80 @@
+
+
+import numpy as np
+import torch
+
+from itertools import permutations
+
+from sent_order.search import exhaustive_search
+from sent_order.models import pairs, pick_next
+
+
+def test_exhaustive_top_k():
+
+    scores = np.random.RandomState(0).randn(5, 5)
+
+    def score_perms(perms):
+        return scores[perms[:,:-1], perms[:,1:]].sum(1)
+
+    brute = sorted(
+        (
+            (perm, sum(scores[i, j] for i, j in zip(perm, perm[1:])))
+            for perm in permutations(range(5))
+        ),
+        key=lambda p: p[1],
+        reverse=True,
+    )
+
+    # Chunks of 7 perms, so the top-k carries across chunks.
+    top = exhaustive_search(5, score_perms, 1, max_bytes=7, nbest=10)
+
+    assert [perm for perm, _ in top] == [perm for perm, _ in brute[:10]]
+    assert np.allclose([s for _, s in top], [s for _, s in brute[:10]])
+
+    assert exhaustive_search(5, score_perms, 1) == top[:1]
+
+
+def test_beam_search_shape():
+
+    classifier = pairs.Classifier(8, 4)
+
+    # Exhaustive and beam paths return the same shape.
+    for exhaustive_size in (0, 10):
+
+        with torch.no_grad():
+            paths = pairs.beam_search(torch.randn(4, 4), classifier,
+                exhaustive_size=exhaustive_size)
+
+        assert len(paths) == 1
+        path, score = paths[0]
+        assert sorted(path) == [0, 1, 2, 3]
+        assert isinstance(score, float)
+
+
+def test_exhaustive_matches_full_beam():
+
+    torch.manual_seed(0)
+
+    ab = torch.randn(5, 4)
+
+    classifier = pairs.Classifier(8, 4)
+    r_encoder = pick_next.Encoder(4, 2)
+    next_classifier = pick_next.Classifier(18, 4)
+
+    # A beam holding every partial path is exact.
+    with torch.no_grad():
+        searches = [
+            (
+                pairs.exhaustive_order(ab, classifier),
+                pairs.beam_search(ab, classifier, 120, 0),
+            ),
+            (
+                pick_next.exhaustive_order(ab, r_encoder, next_classifier),
+                pick_next.order_beam_search(ab, r_encoder, next_classifier,
+                    120, 0),
+            ),
+        ]
+
+    for [(exact, exact_score)], [(beam, beam_score)] in searches:
+        assert exact == beam
+        assert np.isclose(exact_score, beam_score, atol=1e-4)
@@ -0,0 +1,64 @@
+
+
+import pytest
+import ujson
+
+from sent_order import timers
+
+
+@pytest.fixture(autouse=True)
+def stats_off():
+    timers.configure(None)
+    yield
+    timers.configure(None)
+
+
+def run_steps():
+    for _ in range(3):
+        with timers.stage('step'):
+            timers.count('examples', 10)
+
+
+def test_jsonl(tmpdir):
+
+    path = str(tmpdir.join('stats.jsonl'))
+    timers.configure(path)
+
+    run_steps()
+    timers.flush()
+    timers.flush()
+
+    with open(path) as fh:
+        lines = [ujson.loads(line) for line in fh]
+
+    assert len(lines) == 2
+    assert lines[-1]['stages']['step']['calls'] == 3
+    assert lines[-1]['counters'] == dict(examples=30)
+    assert 'examples/s' in lines[-1]['rates']
+
+
+def test_prometheus(tmpdir):
+
+    path = str(tmpdir.join('stats.prom'))
+    timers.configure(path)
+
+    run_steps()
+    timers.flush()
+
+    text = tmpdir.join('stats.prom').read()
+
+    assert 'sent_order_stage_calls_total{stage="step"} 3' in text
+    assert 'sent_order_count_total{name="examples"} 30' in text
+
+
+def test_off_and_collect():
+
+    # No-ops when off.
+    run_steps()
+    assert timers.STATS is None
+
+    with timers.collect() as stats:
+        run_steps()
+
+    assert stats.counters == dict(examples=30)
+    assert timers.STATS is None
@@ -0,0 +1,73 @@
+
+
+import numpy as np
+import torch
+import attr
+
+from torch.nn.utils.rnn import pad_packed_sequence
+
+from sent_order.models import pairs, context_regression
+
+
+SIZES = [3, 1, 4]
+
+
+@attr.s
+class Abstract:
+    sentences = attr.ib()
+
+
+class FakeBatch:
+
+    """Sentence counts only; encoders see each sentence's batch index.
+    """
+
+    def __init__(self, sizes):
+        self.abstracts = [Abstract([None] * n) for n in sizes]
+
+    def packed_sentence_tensor(self):
+        return None, None
+
+
+def sentence_indexes():
+    return torch.arange(sum(SIZES), dtype=torch.float).view(-1, 1)
+
+
+class SumEncoder:
+
+    def encode_packed(self, x, reorder):
+        """Sum of the sentence indexes in each graf.
+        """
+        x, _ = pad_packed_sequence(x, batch_first=True)
+        return x.sum(1)[reorder]
+
+
+def test_pairs_examples():
+
+    x, y = pairs.train_batch(FakeBatch(SIZES),
+        lambda x, reorder: sentence_indexes(), lambda x: x)
+
+    # Adjacent pairs within each abstract, in order then swapped.
+    expected = []
+    for i in (0, 1, 4, 5, 6):
+        expected += [[i, i+1], [i+1, i]]
+
+    assert x.tolist() == expected
+    assert y.tolist() == [0, 1] * 5
+
+
+def test_context_regression_examples():
+
+    y, x = context_regression.train_batch(FakeBatch(SIZES), None,
+        SumEncoder(), lambda x: x, sentence_indexes())
+
+    starts = np.cumsum([0] + SIZES)
+
+    expected_x, expected_y = [], []
+    for start, n in zip(starts, SIZES):
+        for i in range(n):
+            expected_x.append([sum(range(start, start+n)), start+i])
+            expected_y.append(i / max(n-1, 1))
+
+    assert x.tolist() == expected_x
+    assert np.allclose(y.tolist(), expected_y)
@@ -0,0 +1,32 @@
+
+
+import numpy as np
+import torch
+
+from sent_order.vectors import LazyVectors
+from sent_order.benchmark import write_vectors
+from sent_order.utils import pack
+
+
+def test_half_precision(tmpdir):
+
+    path = str(tmpdir.join('vectors.bin'))
+    write_vectors(path, vocab_size=20, dim=8)
+
+    full = LazyVectors(path, 'float32')
+
+    for dtype in ('float16', 'bfloat16'):
+
+        vectors = LazyVectors(path, dtype)
+
+        x = vectors.embed(['w3', 'oov', 'w7'])
+
+        assert x.dtype == getattr(torch, dtype)
+        assert (x[1] == 0).all()
+
+        assert np.allclose(x.float(), full.embed(['w3', 'oov', 'w7']),
+            rtol=1e-2, atol=1e-2)
+
+        # Upcast at the LSTM input.
+        packed, _ = pack(x[None].repeat(2, 1, 1), [3, 2])
+        assert packed.data.dtype == torch.float